@@ -1,3 +1,9 @@
-import pkg_resources
+try:
+    from importlib.metadata import version
+except ImportError:  # Python < 3.8, pkg_resources is considerably slower to import
+    from pkg_resources import get_distribution
 
-VERSION = pkg_resources.get_distribution('compose-dump').version
+    def version(name):
+        return get_distribution(name).version
+
+VERSION = version('compose-dump')
@@ -1,15 +1,23 @@
 from collections import OrderedDict
 from collections.abc import Mapping, Sequence
+from contextlib import ExitStack
 from datetime import datetime
+from functools import partial
 from io import StringIO
+import json
 import logging
 import os
-from pathlib import Path, PurePath
+from pathlib import Path, PurePath, PurePosixPath
 from platform import node as gethostname
 import sys
+from threading import Lock
+from types import SimpleNamespace
 
-from compose.cli.command import get_config_path_from_options, get_project
+from compose import config as compose_config
+from compose.cli.command import get_client, get_config_path_from_options, get_project_name
 from compose.config.config import ConfigFile
+from compose.const import API_VERSIONS
+from compose.project import Project
 from compose.service import NoSuchImageError
 try:
     from compose.version import ComposeVersion
@@ -18,27 +26,53 @@ except ImportError:
 import yaml
 
 from compose_dump import VERSION
-from compose_dump.utils import get_container_for_service, get_container_with_project_volume, hash_string, locates_in, \
-    setup_loghandler, PathSet
+from compose_dump.checksums import CHECKSUM_ALGORITHM, summarize_checksums
+from compose_dump.exclusions import BACKUPIGNORE, DOCKERIGNORE, read_exclusions
+from compose_dump.hooks import exec_output, parse_hooks, run_hook
+from compose_dump.incremental import find_previous_dump, is_unchanged, load_dump_metadata, set_stored_digests, \
+    walk_entries
+from compose_dump.lookups import DockerLookups
+from compose_dump.metrics import Metrics
+from compose_dump.reader import INVENTORY_NAME, MANIFEST_NAME
+from compose_dump.pausing import PauseScheduler
+from compose_dump.snapshots import init_snapshotter
+from compose_dump.utils import get_local_mountpoint, get_project_volume_names, get_services_using_path, \
+    get_services_using_project_volume, hash_string, locates_in, setup_loghandler, worker_pool, PathSet, \
+    ThreadLogFilter
 from compose_dump.storage import init_storage
+from compose_dump.tarstream import archive_tree, scan_archive
+from compose_dump.transfers import ensure_image, get_archive, helper_archive, Transfers
 
 
 log = logging.getLogger('compose-compose_dump')
 
+# guards the clients that are shared between the dumps of a batch
+clients_lock = Lock()
+
+
+# libyaml's emitter is much faster with the checksums of many files in a manifest
+Dumper = getattr(yaml, 'CDumper', yaml.Dumper)
+
 
 def dict_representer(dumper, data):
     return dumper.represent_dict(data.items())
-yaml.add_representer(OrderedDict, dict_representer)  # noqa: E305
+yaml.add_representer(OrderedDict, dict_representer, Dumper=Dumper)  # noqa: E305
 
 
 def create_dump(ctx):
     manifest_log = StringIO()
     manifest_handler = logging.StreamHandler(manifest_log)
     setup_loghandler(manifest_handler, ctx.options['verbose'])
+    # dumps of a batch run concurrently, each manifest only logs its own dump's records
+    manifest_handler.addFilter(ThreadLogFilter())
     log.addHandler(manifest_handler)
+    try:
+        _create_dump(ctx, manifest_log)
+    finally:
+        log.removeHandler(manifest_handler)
 
-    scopes = ctx.options['scopes']
 
+def _create_dump(ctx, manifest_log):
     meta = ctx.manifest['meta'] = OrderedDict()
     meta['invocation_time'] = datetime.now().isoformat()
     meta['finish_time'] = None
@@ -49,38 +83,116 @@ def create_dump(ctx):
     meta['gid'] = os.getgid()
     meta['version'] = VERSION
 
-    init_storage(ctx)
-
-    base_dir = str(ctx.options['project_dir'])
-    config_path = get_config_path_from_options(
-        base_dir, {'--file': ctx.options['compose_files']}, ctx.environment)
-    ctx.project = \
-        get_project(base_dir, config_path=config_path,
-                    project_name=ctx.options['project_name'],
-                    verbose=ctx.options['verbose'], host=None, tls_config=None, environment=ctx.environment)
+    ctx.metrics = Metrics(progress=ctx.options.get('progress', False),
+                          metrics_file=ctx.options.get('metrics_file'), name=ctx.options['project_name'])
+    try:
+        init_snapshot(ctx)
+        init_storage(ctx)
+        try:
+            store_dump(ctx, manifest_log)
+            ctx.storage.finalize()
+        except BaseException:
+            # an archive that isn't complete is left as it is, an upload of it is aborted
+            ctx.storage.abort()
+            raise
+    finally:
+        ctx.metrics.close()
+
+
+def store_dump(ctx, manifest_log):
+    # stores everything but finalizes the storage
+    scopes = ctx.options['scopes']
+    meta = ctx.manifest['meta']
+    init_inventory(ctx)
+    init_project(ctx)
 
     if 'config' in scopes:
         store_config(ctx)
 
     if 'mounted' in scopes or 'volumes' in scopes:
-        if not ctx.options['no_pause']:
-            ctx.project.pause(service_names=ctx.options['services'])
+        ctx.pauses = PauseScheduler(ctx)
+        ctx.metrics.paused_time = ctx.pauses.paused_time
+        init_snapshotter(ctx)
         store_volumes(ctx)
-        if not ctx.options['no_pause']:
-            ctx.project.unpause(service_names=ctx.options['services'])
+        ctx.manifest['downtimes'] = ctx.pauses.downtimes
 
     meta['finish_time'] = datetime.now().isoformat()
 
+    if ctx.inventory is not None:
+        with ctx.metrics.measure('inventory', INVENTORY_NAME):
+            ctx.storage.write_file(json.dumps(ctx.inventory), INVENTORY_NAME)
+        meta['inventory'] = INVENTORY_NAME
+
+    ctx.manifest['checksums'] = summarize_checksums(ctx.storage.checksums)
+    ctx.manifest['timings'] = ctx.metrics.timings
+
     normalize_manifest_mapping(ctx.manifest)
     manifest_log.seek(0)
 
-    doc = yaml.dump(ctx.manifest, default_flow_style=False)
+    doc = yaml.dump(ctx.manifest, Dumper=Dumper, default_flow_style=False)
     doc += '---\n'
-    doc += yaml.dump([x.strip() for x in manifest_log.readlines() if x], default_style='"')
+    doc += yaml.dump([x.strip() for x in manifest_log.readlines() if x], Dumper=Dumper, default_style='"')
+
+    ctx.storage.write_file(doc, MANIFEST_NAME)
+
+
+def init_project(ctx):
+    # like compose's get_project, but Docker clients are reused from ctx.clients when the dumps
+    # of a batch connect to the same daemon with the same API version
+    base_dir = str(ctx.options['project_dir'])
+    environment = ctx.environment
+    config_path = get_config_path_from_options(
+        base_dir, {'--file': ctx.options['compose_files']}, environment)
+    config_details = compose_config.find(base_dir, config_path, environment)
+    project_name = get_project_name(config_details.working_dir, ctx.options['project_name'], environment)
+    config_data = compose_config.load(config_details)
+
+    api_version = environment.get('COMPOSE_API_VERSION', API_VERSIONS[config_data.version])
+    key = (api_version,) + tuple(environment.get(x) for x in ('DOCKER_HOST', 'DOCKER_TLS_VERIFY', 'DOCKER_CERT_PATH'))
+    clients = getattr(ctx, 'clients', {})
+    with clients_lock:
+        if key not in clients:
+            clients[key] = get_client(environment=environment, verbose=ctx.options['verbose'],
+                                      version=api_version, tls_config=None, host=None)
+    ctx.project = Project.from_config(project_name, config_data, clients[key])
+
+
+def init_snapshot(ctx):
+    # unchanged files are linked to the previous dump of the project in the target folder
+    ctx.snapshot_base = None
+    if not ctx.options.get('snapshot'):
+        return
+
+    previous = find_previous_dump(ctx.options['target'], ctx.options['project_name'])
+    if previous is None:
+        log.info('Found no previous dump to link to, all files are copied.')
+        return
+    path, manifest = previous
+    if not manifest.get('checksums') or manifest['checksums']['algorithm'] != CHECKSUM_ALGORITHM:
+        log.warning('The dump %s records no usable checksums, all files are copied.' % path)
+        return
+    log.debug('Linking unchanged files to %s' % path)
+    ctx.snapshot_base = SimpleNamespace(path=path, checksums=manifest['checksums']['files'])
+    ctx.manifest['meta']['snapshot_base'] = path
+
 
-    ctx.storage.write_file(doc, 'Manifest.yml')
+def init_inventory(ctx):
+    ctx.inventory = ctx.previous_inventory = None
+    if not ctx.options.get('inventory'):
+        return
 
-    ctx.storage.finalize()
+    ctx.inventory = OrderedDict((('mounted', {}), ('volumes', {})))
+    since = ctx.options.get('since')
+    if since is None:
+        return
+
+    previous_manifest, ctx.previous_inventory = load_dump_metadata(since, ctx.options.get('encryption_key_file'))
+    ctx.manifest['meta']['since'] = OrderedDict((
+        ('path', since),
+        ('invocation_time', previous_manifest['meta']['invocation_time'])
+    ))
+    if ctx.previous_inventory is None:
+        log.warning('The dump %s has no inventory, all data is stored.' % since)
 
 
 ####
@@ -176,14 +288,15 @@ def put_config_file(ctx, filepath, considered_files):
         return
 
     if locates_in(filepath, project_dir):
-        ctx.storage.put_file(filepath, dst, namespace='config')
+        with ctx.metrics.measure('config', str(dst / filepath.name)):
+            ctx.storage.put_file(filepath, dst, namespace='config')
     considered_files.add(filepath)
 
 
 def store_build_contexts(ctx):
     project_dir = ctx.options['project_dir']
-    # create set of paths to copy to avoid duplicated copies
-    config_dirs = set()
+    # maps the paths to copy to the Dockerfiles in them to avoid duplicated copies
+    config_dirs = {}
 
     for service in ctx.project.services:
         if service.name not in ctx.options['services']:
@@ -195,10 +308,15 @@ def store_build_contexts(ctx):
         context = build_options.get('context')
         if context:
             dst = Path(context).relative_to(project_dir)
-            config_dirs.add((project_dir / context, dst))
+            dockerfiles = config_dirs.setdefault((project_dir / context, dst), set())
+            dockerfiles.add(build_options.get('dockerfile', 'Dockerfile'))
 
-    for config_dir in config_dirs:
-        ctx.storage.put_folder(config_dir[0], config_dir[1], namespace='config')
+    for (path, dst), dockerfiles in config_dirs.items():
+        # like Docker, the Dockerfile and the ignore files are stored even if they match a pattern
+        exclusions = get_exclusions(ctx, path, (DOCKERIGNORE, BACKUPIGNORE), keep=dockerfiles)
+        with ctx.metrics.measure('build context', str(dst)):
+            ctx.storage.put_folder(path, dst, namespace='config', exclusions=exclusions)
+        record_exclusions(ctx, 'config/%s' % dst, exclusions)
 
 
 ####
@@ -210,35 +328,163 @@ def store_volumes(ctx):
     volume_index['mounted'] = []
     volume_index['services'] = {}
     mounted_paths = PathSet()
+    ctx.lookups = DockerLookups(ctx.project, ctx.options['services'])
+
+    # hooks are executed while the services run
+    init_hooks(ctx)
+    run_hooks(ctx, 'pre')
+    store_dumps(ctx)
+
+    if 'volumes' in ctx.options['scopes'] and ctx.options.get('helper_image'):
+        ensure_image(ctx.project.client, ctx.options['helper_image'])
+
+    snapshots = OrderedDict()
+    # the snapshots that have been taken are released even if the dump fails
+    try:
+        with ctx.pauses.project_window():
+            with Transfers(ctx) as transfers:
+                if 'volumes' in ctx.options['scopes']:
+                    store_project_volumes(ctx, transfers)
+                store_services_volumes(ctx, transfers, mounted_paths)
+            if 'mounted' in ctx.options['scopes']:
+                if ctx.snapshotter is None:
+                    store_mounted_volumes(ctx, mounted_paths)
+                else:
+                    take_snapshots(ctx, mounted_paths, snapshots)
+
+        # the snapshots are stored while the services run
+        if snapshots:
+            store_mounted_volumes(ctx, mounted_paths, snapshots)
+    finally:
+        for path, snapshot in snapshots.items():
+            ctx.snapshotter.release(path, snapshot)
+
+    run_hooks(ctx, 'post')
+
+
+def init_hooks(ctx):
+    # collects the hooks that the selected services declare with labels
+    ctx.hooks = OrderedDict()
+    if ctx.options.get('no_hooks'):
+        return
+    for service in ctx.project.services:
+        if service.name not in ctx.options['services']:
+            continue
+        hooks = parse_hooks(service.options.get('labels'))
+        if hooks is None:
+            continue
+        container = ctx.lookups.container_for_service(service.name)
+        if container is None or not ctx.lookups.is_running(container):
+            log.critical('No running container for service %s found, its hooks are skipped.' % service.name)
+            continue
+        hooks.container = container
+        ctx.hooks[service.name] = hooks
 
-    if 'volumes' in ctx.options['scopes']:
-        store_project_volumes(ctx)
-    store_services_volumes(ctx, mounted_paths)
-    if 'mounted' in ctx.options['scopes']:
-        store_mounted_volumes(ctx, mounted_paths)
+
+def run_hooks(ctx, stage):
+    # runs the 'pre' or 'post' commands of all services concurrently
+    commands = [(x, getattr(y, stage), y.container) for x, y in ctx.hooks.items() if getattr(y, stage)]
+    if not commands:
+        return
+
+    def run(service_name, command, container):
+        with ctx.metrics.measure('hook', '%s/%s' % (service_name, stage)):
+            run_hook(ctx.project.client, container.id, command, 'The %s hook of %s' % (stage, service_name))
+
+    with worker_pool(len(commands)) as pool:
+        futures = [pool.submit(run, *x) for x in commands]
+    for future in futures:
+        future.result()
 
 
-def store_project_volumes(ctx):
+def store_dumps(ctx):
+    # streams the output of the services' dump commands into the dump, at least one service at a time
+    services = [x for x in ctx.hooks.items() if x[1].dumps]
+    if not services:
+        return
+    index = ctx.manifest['dumps'] = OrderedDict()
+    with Transfers(ctx, jobs=max(ctx.options.get('jobs', 1), len(services))) as transfers:
+        for service_name, hooks in services:
+            service_index = index[service_name] = OrderedDict()
+            for name, command in hooks.dumps.items():
+                source = partial(exec_output, ctx.project.client, hooks.container.id, command,
+                                 'The dump %s of %s' % (name, service_name))
+                transfers.submit(source, name, 'dumps/' + service_name, service_index, name,
+                                 metadata={'service': service_name, 'command': command}, kind='dump')
+
+
+def is_replaced(ctx, service_name, path):
+    # whether a service's dumps replace the volume that it mounts at path
+    return service_name in ctx.hooks and path in ctx.hooks[service_name].replaces
+
+
+def take_snapshots(ctx, mounted_paths, snapshots):
+    # snapshots of the mounted folders are taken while the services that use them are paused, files are
+    # stored right away
+    files = []
+    for path in sorted(mounted_paths):
+        path = Path(path)
+        if not path.is_dir():
+            files.append(path)
+            continue
+        dst = path.relative_to(ctx.options['project_dir'])
+        with ctx.metrics.measure('snapshot', str(dst)), \
+                ctx.pauses.volume_window(get_services_using_path(ctx.project, path)):
+            snapshots[path] = ctx.snapshotter.take(path)
+        log.debug('Took a snapshot of %s at %s' % (path, snapshots[path]))
+    store_mounted_volumes(ctx, files)
+
+
+def store_project_volumes(ctx, transfers):
     for name, volume in ctx.project.volumes.volumes.items():
         if volume.external:
             continue
-        if not volume.exists():
+        if not ctx.lookups.volume_exists(volume):
             log.critical("Project volume %s doesn't exist." % name)
             continue
+        elif is_replaced_project_volume(ctx, name):
+            log.info('Skipping project volume %s, it is replaced by dumps.' % name)
+            continue
         else:
-            container, path = get_container_with_project_volume(ctx.project, name)
+            container, path = ctx.lookups.container_with_volume(volume)
             if container is None:
                 log.critical('Found no container that uses project volume %s' % name)
                 continue
-            bits, stat = ctx.project.client.get_archive(container.id, path)
-            archive_name = name + '.tar'
-            if hasattr(bits, 'stream'):  # TODO: obsolete with docker-compose>1.19.0 (e.g. docker-py>=3.0.0)
-                bits = bits.stream
-            ctx.storage.write_file(bits, archive_name, namespace='volumes/project')
-            ctx.manifest['volumes']['project'][name] = archive_name
-
-
-def store_services_volumes(ctx, mounted_paths):
+            source = volume_source(ctx, container, path)
+            source = inventoried_archive(ctx, source, 'project/%s.tar' % name)
+            # services that use volumes_from mount it as well
+            services = sorted(set(get_services_using_project_volume(ctx.project, name) +
+                                  ctx.lookups.services_using_volume(volume)))
+            transfers.submit(source, name + '.tar', 'volumes/project', ctx.manifest['volumes']['project'], name,
+                             services=services, metadata={'volume': name})
+
+
+def volume_source(ctx, container, path):
+    # returns a callable that returns a tar stream of the volume at path in container, with the
+    # read_local_volumes option it's read from the volume's folder on this host if that is accessible, with
+    # helper_image it's archived by a container of that image, otherwise by the Docker daemon
+    client = ctx.project.client
+    if ctx.options.get('read_local_volumes'):
+        mountpoint = get_local_mountpoint(client, ctx.lookups.mounts(container), path)
+        if mountpoint is not None:
+            log.debug('Reading the volume at %s of %s from %s' % (path, container.name, mountpoint))
+            return partial(archive_tree, mountpoint, PurePosixPath(path).name)
+        log.debug('The volume at %s of %s is not read from its folder, it is not accessible.'
+                  % (path, container.name))
+    if ctx.options.get('helper_image'):
+        return partial(helper_archive, client, container.id, path, ctx.options['helper_image'])
+    return partial(get_archive, client, container.id, path)
+
+
+def is_replaced_project_volume(ctx, name):
+    # whether the dumps of all services that mount a project volume replace it
+    volume_names = get_project_volume_names(ctx.project, name)
+    mounts = [(x.name, v.internal) for x in ctx.project.services for v in x.options.get('volumes', ())
+              if v.external in volume_names]
+    return bool(mounts) and all(is_replaced(ctx, x, y) for x, y in mounts)
+
+
+def store_services_volumes(ctx, transfers, mounted_paths):
     for service in ctx.project.services:
         if service.name not in ctx.options['services']:
             continue
@@ -248,7 +494,9 @@ def store_services_volumes(ctx, mounted_paths):
 
         # figure out what should be saved
         for volume in service.options.get('volumes', ()):
-            if volume.external in ctx.project.volumes.volumes:
+            if is_replaced(ctx, service.name, volume.internal):
+                pass
+            elif volume.external in ctx.project.volumes.volumes:
                 pass
             elif volume.external is None:
                 internal_volumes.add(volume.internal)
@@ -258,36 +506,102 @@ def store_services_volumes(ctx, mounted_paths):
 
         # collect extra volumes from service image
         try:
-            image = service.image()
+            image = ctx.lookups.image(service)
         except NoSuchImageError as e:
             log.critical('%s: %s' % (service.name, e))
         else:
             image_volumes = image.get('Config', {})['Volumes'] or ()
             for volume in image_volumes:
-                if volume not in considered_paths:  # not if encountered before
+                if volume not in considered_paths and not is_replaced(ctx, service.name, volume):
                     internal_volumes.add(volume)
 
         if 'volumes' in ctx.options['scopes']:
             index = ctx.manifest['volumes']['services'][service.name] = {}
-            container = get_container_for_service(service)
+            container = ctx.lookups.container_for_service(service.name)
             if container is None:
                 log.critical('No container for service %s found.' % service.name)
                 continue
-            for path in internal_volumes:
+            for path in sorted(internal_volumes):
                 archive_name = hash_string(service.name.upper() + path) + '.tar'
-                bits, stat = ctx.project.client.get_archive(container.id, path)
-                if hasattr(bits, 'stream'):  # TODO: obsolete with docker-compose>1.19.0 (e.g. docker-py>=3.0.0)
-                    bits = bits.stream
-                ctx.storage.write_file(bits, archive_name, namespace='volumes/services')
-                index[path] = archive_name
+                source = volume_source(ctx, container, path)
+                source = inventoried_archive(ctx, source, 'services/' + archive_name)
+                transfers.submit(source, archive_name, 'volumes/services', index, path, services=(service.name,),
+                                 metadata={'service': service.name, 'path': path})
 
 
-def store_mounted_volumes(ctx, mounted_paths):
-    for path in mounted_paths:
-        path = Path(path)
-        dst = path.relative_to(ctx.options['project_dir'])
-        if path.is_dir():
-            ctx.storage.put_folder(path, dst, namespace='volumes/mounted')
+def store_mounted_volumes(ctx, mounted_paths, snapshots=None):
+    # snapshots maps paths to the snapshots that are stored instead, these don't require pauses
+    for path in sorted(Path(x) for x in mounted_paths):
+        if snapshots:
+            if path not in snapshots:
+                continue
+            src, window = snapshots[path], ExitStack()
         else:
-            ctx.storage.put_file(path, dst.parent, namespace='volumes/mounted')
+            src, window = path, ctx.pauses.volume_window(get_services_using_path(ctx.project, path))
+        dst = path.relative_to(ctx.options['project_dir'])
+        with ctx.metrics.measure('mounted', str(dst)), window:
+            if ctx.inventory is not None and ctx.previous_inventory is not None:
+                store_mounted_volume_changes(ctx, src, dst)
+            else:
+                if src.is_dir():
+                    exclusions = get_exclusions(ctx, src, (BACKUPIGNORE,))
+                    ctx.storage.put_folder(src, dst, namespace='volumes/mounted', exclusions=exclusions)
+                    record_exclusions(ctx, 'volumes/mounted/%s' % dst, exclusions)
+                else:
+                    ctx.storage.put_file(src, dst.parent, namespace='volumes/mounted')
+                if ctx.inventory is not None:
+                    exclusions = get_exclusions(ctx, src, (BACKUPIGNORE,)) if src.is_dir() else None
+                    files = []
+                    for item, name, entry in walk_entries(src, dst, exclusions):
+                        if entry['type'] == 'file':
+                            files.append((item, 'volumes/mounted/%s' % name, entry))
+                        ctx.inventory['mounted'][str(name)] = entry
+                    # the files' contents were hashed while they were stored
+                    set_stored_digests(ctx.storage.checksums, files)
         ctx.manifest['volumes']['mounted'].append(dst)
+
+
+def store_mounted_volume_changes(ctx, path, dst):
+    # only files whose content differs from the previous dump's are stored, everything else is restored from
+    # the inventory and the dumps it refers to
+    previous = ctx.previous_inventory['mounted']
+    exclusions = get_exclusions(ctx, path, (BACKUPIGNORE,)) if path.is_dir() else None
+    stored = []
+    for src, name, entry in walk_entries(path, dst, exclusions):
+        name = str(name)
+        ctx.inventory['mounted'][name] = entry
+        if entry['type'] != 'file':
+            continue
+        if is_unchanged(src, entry, previous.get(name), ctx.options.get('trust_mtime')):
+            entry['stored'] = False
+        else:
+            ctx.storage.put_file(src, Path(name).parent, namespace='volumes/mounted', follow_symlinks=False)
+            stored.append((src, 'volumes/mounted/' + name, entry))
+    # the files' contents were hashed while they were stored
+    set_stored_digests(ctx.storage.checksums, stored)
+    record_exclusions(ctx, 'volumes/mounted/%s' % dst, exclusions)
+
+
+def get_exclusions(ctx, folder, ignore_files, keep=()):
+    # returns the Exclusions that folder's ignore files define or None
+    if ctx.options.get('no_ignore_files'):
+        return None
+    return read_exclusions(folder, ignore_files, keep)
+
+
+def record_exclusions(ctx, key, exclusions):
+    if exclusions is None:
+        return
+    log.debug('Excluded %i paths with %i bytes from %s' % (exclusions.paths, exclusions.bytes, key))
+    ctx.manifest.setdefault('exclusions', OrderedDict())[key] = exclusions.as_dict()
+
+
+def inventoried_archive(ctx, source, key):
+    if ctx.inventory is None:
+        return source
+    members = ctx.inventory['volumes'][key] = {}
+    if ctx.previous_inventory is None:
+        previous = None
+    else:
+        previous = ctx.previous_inventory['volumes'].get(key)
+    return lambda: scan_archive(source(), members, previous)
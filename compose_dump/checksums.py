@@ -0,0 +1,50 @@
+from collections import OrderedDict
+from hashlib import blake2b
+
+
+# the algorithm of the digests that are recorded in a dump's manifest
+CHECKSUM_ALGORITHM = 'blake2b-256'
+
+
+def hash_object():
+    return blake2b(digest_size=32)
+
+
+def summarize_checksums(checksums):
+    # returns the manifest's checksums section, the dump's digest covers the digests, sizes and names of all files
+    files = OrderedDict(sorted(checksums.items()))
+    dump_hash = hash_object()
+    for name, checksum in files.items():
+        dump_hash.update(('%s %i %s\n' % (checksum['digest'], checksum['size'], name)).encode())
+    return OrderedDict((('algorithm', CHECKSUM_ALGORITHM), ('digest', dump_hash.hexdigest()), ('files', files)))
+
+
+class Checksum:
+    # the digest and size of data that is passed to update in pieces, counter is called with each piece's size
+
+    def __init__(self, counter=None):
+        self.hash = hash_object()
+        self.size = 0
+        self.counter = counter
+
+    def update(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        if self.counter is not None:
+            self.counter(len(data))
+
+    def as_dict(self):
+        return OrderedDict((('digest', self.hash.hexdigest()), ('size', self.size)))
+
+
+class HashingReader:
+    # wraps a readable file object, everything that's read from it is passed to checksum
+
+    def __init__(self, fileobj, checksum):
+        self.fileobj = fileobj
+        self.checksum = checksum
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.checksum.update(data)
+        return data
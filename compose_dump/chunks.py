@@ -0,0 +1,86 @@
+from hashlib import blake2b
+import os
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from zlib import crc32
+
+
+# Chunk boundaries are content-defined at any byte offset, hence data that is inserted into or removed from an
+# archive or a file only affects the adjacent chunks. A boundary follows a window of WINDOW_SIZE bytes whose
+# CRC32 matches BOUNDARY_MASK. Rather than hashing the window at each offset, which is too slow in Python,
+# only windows that end with ANCHOR in a projection of each byte to one bit are hashed. The projection is
+# computed with bytes.translate and the anchors are found with bytes.find, both at native speed.
+WINDOW_SIZE = 48
+# maps each byte to 0 or 1, half of the bytes to each
+PROJECTION = bytes(blake2b(bytes((x,))).digest()[0] & 1 for x in range(256))
+ANCHOR = b'\x01\x00\x01\x01\x00\x01\x00\x00'  # on average at every 256th offset
+BOUNDARY_MASK = 0xfff  # on average every 4096th anchor, making an expected chunk size of ~1.25 MiB
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 ** 2
+
+
+def split_chunks(chunks):
+    # re-chunks an iterable of bytes at content-defined boundaries
+    buffer = bytearray()
+    position = 0  # the first offset in buffer that may be a boundary and hasn't been checked
+    for data in chunks:
+        buffer += data
+        while True:
+            boundary = find_boundary(buffer, position)
+            if boundary is None:
+                position = len(buffer) + 1
+                break
+            yield bytes(buffer[:boundary])
+            del buffer[:boundary]
+            position = 0
+    if buffer:
+        yield bytes(buffer)
+
+
+def find_boundary(buffer, start):
+    # returns the first boundary in buffer at or after the offset start, MAX_CHUNK_SIZE if buffer is at least
+    # that large and has no boundary before, None otherwise
+    start = max(start, MIN_CHUNK_SIZE)
+    end = min(len(buffer), MAX_CHUNK_SIZE)
+    offset = start - len(ANCHOR)
+    projection = buffer[offset:end].translate(PROJECTION)
+    view = memoryview(buffer)
+    try:
+        index = projection.find(ANCHOR)
+        while index >= 0:
+            boundary = offset + index + len(ANCHOR)
+            if crc32(view[boundary - WINDOW_SIZE:boundary]) & BOUNDARY_MASK == BOUNDARY_MASK:
+                return boundary
+            index = projection.find(ANCHOR, index + 1)
+    finally:
+        view.release()
+    if len(buffer) >= MAX_CHUNK_SIZE:
+        return MAX_CHUNK_SIZE
+    return None
+
+
+class ChunkRepository:
+    # stores chunks once in files that are named by the BLAKE2 digest of their content
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.chunks_path = self.path / 'chunks'
+        self.chunks_path.mkdir(parents=True, exist_ok=True)
+
+    def chunk_path(self, digest):
+        return self.chunks_path / digest[:2] / digest
+
+    def put(self, chunk):
+        # returns the chunk's digest and whether it has been written
+        digest = blake2b(chunk, digest_size=32).hexdigest()
+        path = self.chunk_path(digest)
+        if path.exists():
+            return digest, False
+        path.parent.mkdir(exist_ok=True)
+        with NamedTemporaryFile(dir=str(path.parent), delete=False) as f:
+            f.write(chunk)
+        os.replace(f.name, str(path))  # concurrent writers of the same chunk are harmless
+        return digest, True
+
+    def get(self, digest):
+        return self.chunk_path(digest).read_bytes()
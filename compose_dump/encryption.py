@@ -0,0 +1,205 @@
+import hashlib
+import hmac
+import io
+import logging
+import os
+from pathlib import Path
+import struct
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+except ImportError:
+    ChaCha20Poly1305 = InvalidTag = None
+
+
+# An encrypted archive begins with this magic, a random salt and the parameters of scrypt that derives the
+# key from the secret in a key file. The data follows in chunks of the plaintext's size as 4 bytes and the
+# plaintext that is encrypted and authenticated with ChaCha20-Poly1305, the size is authenticated as well and
+# so is the header in the chunks of the first segment. Archives with other parameters of scrypt are rejected,
+# as these determine the memory and time that the key's derivation takes.
+# The nonces consist of the chunks' numbers and a flag for the last chunk, like with the STREAM construction
+# of age, so chunks can't be reordered, dropped or truncated unnoticed.
+# The writing of an interrupted archive resumes from a checkpoint, while the interrupted run may have written
+# chunks beyond it with the following nonces already. Hence a resumed run begins a new segment, marked by
+# SEGMENT_MARKER in place of a size and a random salt, whose chunks are counted from zero again and are
+# encrypted with a subkey. It's derived from the archive's key, the salt, the segment's number and the number
+# of chunks in the previous segment, so a key and a nonce are never used twice and segments can't be cut.
+ENCRYPTION_MAGIC = b'COMPOSE-DUMP-AEAD\x01'
+ENCRYPTION_CHUNK_SIZE = 64 * 1024
+SEGMENT_MARKER = 0xffffffff
+SALT_SIZE = 16
+# the binary logarithm of n, r and p
+SCRYPT_PARAMETERS = (15, 8, 1)
+TAG_SIZE = 16
+
+
+log = logging.getLogger('compose-compose_dump')
+
+
+def read_secret(path):
+    secret = Path(path).read_bytes().strip()
+    if not secret:
+        log.error('The key file %s is empty.' % path)
+        raise SystemExit(1)
+    return secret
+
+
+def derive_key(secret, salt, log_n, r, p):
+    return hashlib.scrypt(secret, salt=salt, n=2 ** log_n, r=r, p=p, maxmem=256 * r * 2 ** log_n, dklen=32)
+
+
+def segment_key(key, salt, segment, previous_chunks):
+    data = b'COMPOSE-DUMP-SEGMENT' + salt + segment.to_bytes(4, 'big') + previous_chunks.to_bytes(8, 'big')
+    return hmac.new(key, data, hashlib.sha256).digest()
+
+
+def nonce(number, last):
+    return number.to_bytes(11, 'big') + (b'\x01' if last else b'\x00')
+
+
+class EncryptingWriter(io.RawIOBase):
+    # A writable file object that encrypts the written data to fileobj. flush encrypts the buffered data as a
+    # chunk, close writes the last chunk. With state, as returned by the state method after a flush, the
+    # encryption continues an archive that has been written up to that point with a new segment.
+
+    def __init__(self, fileobj, secret, state=None):
+        self.fileobj = fileobj
+        self.buffer = bytearray()
+        self.position = 0
+        self.number = 0
+        if state is None:
+            self.salt = os.urandom(SALT_SIZE)
+            self.segment = 0
+            self.header = ENCRYPTION_MAGIC + self.salt + bytes(SCRYPT_PARAMETERS)
+            fileobj.write(self.header)
+            key = derive_key(secret, self.salt, *SCRYPT_PARAMETERS)
+        else:
+            self.salt = bytes.fromhex(state['salt'])
+            self.segment = state['segment'] + 1
+            self.header = b''
+            segment_salt = os.urandom(SALT_SIZE)
+            fileobj.write(struct.pack('>I', SEGMENT_MARKER) + segment_salt)
+            key = segment_key(derive_key(secret, self.salt, *SCRYPT_PARAMETERS), segment_salt, self.segment,
+                              state['chunks'])
+        self.cipher = ChaCha20Poly1305(key)
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def state(self):
+        return {'salt': self.salt.hex(), 'segment': self.segment, 'chunks': self.number}
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= ENCRYPTION_CHUNK_SIZE:
+            chunk = bytes(self.buffer[:ENCRYPTION_CHUNK_SIZE])
+            del self.buffer[:ENCRYPTION_CHUNK_SIZE]
+            self._write_chunk(chunk)
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            chunk, self.buffer = bytes(self.buffer), bytearray()
+            self._write_chunk(chunk)
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            chunk, self.buffer = bytes(self.buffer), bytearray()
+            self._write_chunk(chunk, last=True)
+            self.fileobj.flush()
+        finally:
+            super().close()
+
+    def _write_chunk(self, chunk, last=False):
+        size = struct.pack('>I', len(chunk))
+        self.fileobj.write(size + self.cipher.encrypt(nonce(self.number, last), chunk, self.header + size))
+        self.number += 1
+
+
+class DecryptingReader(io.RawIOBase):
+    # a readable file object with the decrypted contents of an encrypted archive that fileobj reads
+
+    def __init__(self, fileobj, secret):
+        self.fileobj = fileobj
+        header = self._read(len(ENCRYPTION_MAGIC) + SALT_SIZE + len(SCRYPT_PARAMETERS))
+        if not header.startswith(ENCRYPTION_MAGIC):
+            log.error('The archive is not encrypted with a supported format.')
+            raise SystemExit(1)
+        if tuple(header[-len(SCRYPT_PARAMETERS):]) != SCRYPT_PARAMETERS:
+            log.error("The archive's key derivation parameters aren't supported, it's altered or was written by "
+                      "another version.")
+            raise SystemExit(1)
+        salt = header[len(ENCRYPTION_MAGIC):-len(SCRYPT_PARAMETERS)]
+        self.key = derive_key(secret, salt, *SCRYPT_PARAMETERS)
+        self.cipher = ChaCha20Poly1305(self.key)
+        self.header = header
+        self.segment = 0
+        self.number = 0
+        self.size = self._read(4)
+        self.plaintext = memoryview(b'')
+        self.complete = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.plaintext:
+            if not self.size:
+                if not self.complete:
+                    log.error('The encrypted archive is truncated.')
+                    raise SystemExit(1)
+                return 0
+            self.plaintext = memoryview(self._decrypt_next())
+        size = min(len(buffer), len(self.plaintext))
+        buffer[:size] = self.plaintext[:size]
+        self.plaintext = self.plaintext[size:]
+        return size
+
+    def _decrypt_next(self):
+        # the last chunk is the one that the end of the data follows
+        while self.size == struct.pack('>I', SEGMENT_MARKER):
+            self._next_segment()
+        if not self.size:
+            log.error('The encrypted archive is truncated.')
+            raise SystemExit(1)
+        size = self.size
+        if struct.unpack('>I', size)[0] > ENCRYPTION_CHUNK_SIZE:
+            log.error('The encrypted archive is altered.')
+            raise SystemExit(1)
+        ciphertext = self._read(struct.unpack('>I', size)[0] + TAG_SIZE)
+        self.size = self._read(4)
+        last = not self.size
+        try:
+            plaintext = self.cipher.decrypt(nonce(self.number, last), ciphertext, self.header + size)
+        except InvalidTag:
+            log.error("The archive can't be decrypted, the key is wrong or the data is truncated or altered.")
+            raise SystemExit(1)
+        self.number += 1
+        self.complete = last
+        return plaintext
+
+    def _next_segment(self):
+        salt = self._read(SALT_SIZE)
+        if len(salt) < SALT_SIZE:
+            log.error('The encrypted archive is truncated.')
+            raise SystemExit(1)
+        self.segment += 1
+        self.header = b''
+        self.cipher = ChaCha20Poly1305(segment_key(self.key, salt, self.segment, self.number))
+        self.number = 0
+        self.size = self._read(4)
+
+    def _read(self, size):
+        data = self.fileobj.read(size)
+        if len(data) < size and data:
+            log.error('The encrypted archive is truncated.')
+            raise SystemExit(1)
+        return data
@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import posixpath
+import re
+
+
+# the names of files whose patterns exclude paths from stored folders
+BACKUPIGNORE = '.backupignore'
+DOCKERIGNORE = '.dockerignore'
+
+
+def translate(pattern):
+    # returns a regular expression for a pattern with the syntax of Go's filepath.Match and '**' for any
+    # number of folders, like Docker interprets the patterns in a .dockerignore file
+    result, i, n = '', 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            if i < n and pattern[i] == '*':
+                i += 1
+                if i < n and pattern[i] == '/':
+                    i += 1
+                    result += '(?:.*/)?'
+                else:
+                    result += '.*'
+            else:
+                result += '[^/]*'
+        elif c == '?':
+            result += '[^/]'
+        elif c == '[':
+            j = pattern.find(']', i + 1)
+            if j == -1:
+                result += re.escape(c)
+            else:
+                content = pattern[i:j]
+                if content.startswith('^'):
+                    content = '^/' + content[1:]
+                result += '[%s]' % content
+                i = j + 1
+        elif c == '\\' and i < n:
+            result += re.escape(pattern[i])
+            i += 1
+        else:
+            result += re.escape(c)
+    return result
+
+
+class Exclusions:
+    # Matches the paths below a folder, relative to it and with forward slashes, against the patterns of
+    # ignore files. As in .dockerignore files, the last matching pattern decides and patterns that start
+    # with '!' include paths again, a pattern that matches a folder also matches everything below it.
+    # The number of excluded paths and the sizes of excluded files are counted, the contents of excluded
+    # folders are never scanned.
+
+    def __init__(self, patterns, ignore_files=(), keep=()):
+        self.ignore_files = list(ignore_files)
+        # paths that are never excluded
+        self.keep = set(keep)
+        self.rules = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            negated = pattern.startswith('!')
+            if negated:
+                pattern = pattern[1:].strip()
+            pattern = posixpath.normpath(pattern).lstrip('/')
+            if pattern in ('', '.'):
+                continue
+            regex = re.compile(translate(pattern) + '(?:/.*)?', re.DOTALL)
+            parts = [re.compile(translate(x), re.DOTALL) if '**' not in x else None for x in pattern.split('/')]
+            self.rules.append((regex, negated, parts))
+        # without exceptions, the patterns are matched at once
+        if any(x[1] for x in self.rules):
+            self.combined = None
+        else:
+            self.combined = re.compile('|'.join('(?:%s)' % x[0].pattern for x in self.rules) or '(?!)', re.DOTALL)
+        self.paths = 0
+        self.bytes = 0
+
+    def excludes(self, name):
+        if name in self.keep:
+            return False
+        if self.combined is not None:
+            return self.combined.fullmatch(name) is not None
+        excluded = False
+        for regex, negated, _ in self.rules:
+            if regex.fullmatch(name):
+                excluded = not negated
+        return excluded
+
+    def may_include_below(self, name):
+        # whether an exception may include a path below the excluded folder name
+        parts = name.split('/')
+        for _, negated, pattern_parts in self.rules:
+            if not negated:
+                continue
+            for part, pattern_part in zip(parts, pattern_parts):
+                if pattern_part is None:
+                    return True
+                if not pattern_part.fullmatch(part):
+                    break
+            else:
+                if len(pattern_parts) > len(parts):
+                    return True
+        return False
+
+    def record(self, size):
+        self.paths += 1
+        self.bytes += size
+
+    def as_dict(self):
+        return OrderedDict((('ignore_files', self.ignore_files), ('paths', self.paths), ('bytes', self.bytes)))
+
+
+def read_exclusions(folder, ignore_files, keep=()):
+    # returns the Exclusions of the named ignore files in folder or None if there are none
+    patterns, found = [], []
+    for name in ignore_files:
+        path = folder / name
+        if path.is_file():
+            patterns.extend(path.read_text().splitlines())
+            found.append(name)
+    if not found:
+        return None
+    return Exclusions(patterns, found, keep=tuple(found) + tuple(keep))
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+import logging
+import struct
+from types import SimpleNamespace
+
+from compose_dump.utils import PathSet
+
+
+# the labels of services that declare hooks
+LABEL_PREFIX = 'compose-dump.'
+DUMP_LABEL_PREFIX = LABEL_PREFIX + 'dump.'
+PRE_LABEL = LABEL_PREFIX + 'pre'
+POST_LABEL = LABEL_PREFIX + 'post'
+REPLACES_LABEL = LABEL_PREFIX + 'replaces'
+# the amount of a failed command's stderr that is logged
+STDERR_MAX_SIZE = 4096
+# the largest amount of a frame's payload that is read at once
+FRAME_READ_SIZE = 64 * 1024
+
+
+log = logging.getLogger('compose-compose_dump')
+
+
+def parse_hooks(labels):
+    # returns the pre and post commands, the dump commands by the names of their output files and the
+    # container paths that the dumps replace from a service's labels or None if there are no hooks
+    if isinstance(labels, list):
+        labels = dict(x.split('=', 1) if '=' in x else (x, '') for x in labels)
+    labels = labels or {}
+    dumps = OrderedDict(sorted((k[len(DUMP_LABEL_PREFIX):], v) for k, v in labels.items()
+                               if k.startswith(DUMP_LABEL_PREFIX) and len(k) > len(DUMP_LABEL_PREFIX)))
+    pre, post = labels.get(PRE_LABEL), labels.get(POST_LABEL)
+    if not dumps and pre is None and post is None:
+        return None
+    replaces = PathSet(x.strip() for x in labels.get(REPLACES_LABEL, '').split(',') if x.strip())
+    return SimpleNamespace(pre=pre, post=post, dumps=dumps, replaces=replaces)
+
+
+def demux_socket(sock):
+    # Yields pairs of stdout and stderr data from an attached socket of a container or an exec instance
+    # without a tty, like docker-py's demux option that requires docker-py 3.7. Docker multiplexes both
+    # streams in frames with an 8-byte header, which holds the stream's number and the payload's size.
+    _disable_timeout(sock)
+    try:
+        while True:
+            header = bytearray()
+            while len(header) < 8:
+                data = _receive(sock, 8 - len(header))
+                if not data:
+                    return
+                header += data
+            stream, size = struct.unpack('>BxxxL', header)
+            while size:
+                data = _receive(sock, min(size, FRAME_READ_SIZE))
+                if not data:
+                    return
+                size -= len(data)
+                yield (None, data) if stream == 2 else (data, None)
+    finally:
+        sock.close()
+
+
+def _receive(sock, size):
+    # the socket is either a socket or a SocketIO, depending on the connection and docker-py's version
+    return sock.recv(size) if hasattr(sock, 'recv') else sock.read(size)
+
+
+def _disable_timeout(sock):
+    # commands may run for longer than the client's timeout, like docker-py does for streams
+    for item in (sock, getattr(sock, '_sock', None)):
+        if hasattr(item, 'settimeout'):
+            item.settimeout(None)
+
+
+def exec_output(client, container_id, command, description):
+    # yields the stdout of a shell command that is executed in a container, a failure ends the program
+    exec_id = client.exec_create(container_id, ['sh', '-c', command])['Id']
+    stderr = bytearray()
+    for out, err in demux_socket(client.exec_start(exec_id, socket=True)):
+        if err:
+            stderr += err
+            del stderr[:-STDERR_MAX_SIZE]
+        if out:
+            yield out
+    exit_code = client.exec_inspect(exec_id)['ExitCode']
+    if exit_code:
+        log.error('%s failed with exit code %i: %s' %
+                  (description, exit_code, stderr.decode(errors='replace').strip()))
+        raise SystemExit(1)
+
+
+def run_hook(client, container_id, command, description):
+    # executes a command in a container and logs its output
+    output = b''.join(exec_output(client, container_id, command, description))
+    log.debug('%s: %s' % (description, output.decode(errors='replace').strip()))
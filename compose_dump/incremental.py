@@ -0,0 +1,88 @@
+import logging
+import os
+from pathlib import Path
+import stat
+
+from compose_dump.checksums import hash_object
+from compose_dump.reader import MANIFEST_NAME, open_dump, parse_manifest
+from compose_dump.storage import CHUNK_SIZE
+from compose_dump.treewalk import scan_tree
+
+
+log = logging.getLogger('compose-compose_dump')
+
+
+def load_dump_metadata(path, key_file=None):
+    # returns the manifest and the inventory (or None) of a dump
+    with open_dump(path, key_file) as dump:
+        if not dump.random_access:
+            for _ in dump:  # the metadata is stored at the end of an archive
+                pass
+    if dump.manifest is None:
+        log.error('%s is not a dump, it contains no %s.' % (path, MANIFEST_NAME))
+        raise SystemExit(1)
+    return dump.manifest, dump.inventory
+
+
+def find_previous_dump(folder, project_name):
+    # returns the path and manifest of the latest complete dump of a project in a folder of dumps or None,
+    # the manifest is written last, so its modification time tells the order
+    candidates = [x for x in Path(folder).iterdir() if (x / MANIFEST_NAME).is_file()]
+    candidates.sort(key=lambda x: (x / MANIFEST_NAME).stat().st_mtime, reverse=True)
+    for path in candidates:
+        manifest = parse_manifest((path / MANIFEST_NAME).read_bytes())
+        if manifest['meta']['options'].get('project_name') == project_name:
+            return path, manifest
+    return None
+
+
+def hash_file(path):
+    result = hash_object()
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            result.update(chunk)
+    return result.hexdigest()
+
+
+def entry_from_stat(path, stat_result):
+    mode = stat_result.st_mode
+    if stat.S_ISREG(mode):
+        return {'type': 'file', 'size': stat_result.st_size, 'mtime': stat_result.st_mtime, 'stored': True}
+    elif stat.S_ISDIR(mode):
+        return {'type': 'dir', 'mtime': stat_result.st_mtime}
+    elif stat.S_ISLNK(mode):
+        return {'type': 'symlink', 'linkname': os.readlink(str(path))}
+    else:
+        return {'type': 'other'}
+
+
+def walk_entries(path, name, exclusions=None):
+    # yields the source path, its name in the dump and an inventory entry for path and everything below it
+    for item_path, item_name, stat_result in scan_tree(path, name, exclusions=exclusions):
+        yield item_path, item_name, entry_from_stat(item_path, stat_result)
+
+
+def is_unchanged(path, entry, previous, trust_mtime=False):
+    # tells whether a file's content equals the previous entry's and takes its digest then. A file of the
+    # same size is hashed and compared, with trust_mtime a file with the same size and modification time is
+    # assumed to be unchanged without being read.
+    if previous is None or previous['type'] != 'file' or not previous.get('digest') or \
+            previous['size'] != entry['size']:
+        return False
+    if trust_mtime and previous['mtime'] == entry['mtime']:
+        entry['digest'] = previous['digest']
+        return True
+    entry['digest'] = hash_file(path)
+    return entry['digest'] == previous['digest']
+
+
+def set_stored_digests(checksums, items):
+    # sets the digests of the entries of stored files from a storage's checksums, items are the paths, the
+    # names in the dump and the entries of the files. A file is only hashed if it wasn't stored with the size
+    # of its entry, because it changed meanwhile.
+    for path, name, entry in items:
+        checksum = checksums.get(name)
+        if checksum is not None and checksum['size'] == entry['size']:
+            entry['digest'] = checksum['digest']
+        else:
+            entry['digest'] = hash_file(path)
@@ -0,0 +1,136 @@
+from collections import Counter
+import re
+
+from compose.const import LABEL_ONE_OFF, LABEL_PROJECT, LABEL_SERVICE
+from compose.container import Container
+from compose.service import NoSuchImageError
+from docker.errors import ImageNotFound
+
+from compose_dump.utils import get_volume_names, worker_pool
+
+
+# the number of images that are inspected concurrently
+IMAGE_THREADS = 8
+
+
+class DockerLookups:
+    # Answers a dump's questions about the project's containers, images and volumes from memory. The
+    # containers of the project and all volumes are listed with one request each when they're first needed.
+    # Listed images lack their configuration, so the images of the services are inspected concurrently,
+    # each once. The answers reflect the state at that time, hence an instance serves one run.
+
+    def __init__(self, project, service_names):
+        self.project = project
+        self.client = project.client
+        self.service_names = service_names
+        # maps service names to their containers in the order of preference, volume names to mounts, container
+        # ids to the listing's data of a container, the names of volumes to the listing's data and image names
+        # to inspections
+        self._containers = self._volume_mounts = self._summaries = self._volumes = self._images = None
+        # counts how often containers were chosen to read a volume from
+        self.reads = Counter()
+
+    def container_for_service(self, service_name):
+        # like utils.get_container_for_service
+        containers = self.containers.get(service_name)
+        return containers[0] if containers else None
+
+    def container_with_volume(self, volume):
+        # returns a container that mounts a compose Volume and the path that it's mounted at or None twice.
+        # Stopped containers are preferred, reading from them competes with no service, and then the ones
+        # that were chosen least often before, so concurrent retrievals are spread over the containers.
+        candidates = [x for name in get_volume_names(volume) for x in self.volume_mounts.get(name, ())]
+        if not candidates:
+            return None, None
+        container, path = min(candidates, key=lambda x: (self.is_running(x[0]), self.reads[x[0].id]))
+        self.reads[container.id] += 1
+        return container, path
+
+    @property
+    def containers(self):
+        if self._containers is None:
+            self._list_containers()
+        return self._containers
+
+    @property
+    def volume_mounts(self):
+        # maps the names of volumes to the containers that mount them and the paths where, this includes
+        # the volumes that containers mount with volumes_from
+        if self._volume_mounts is None:
+            self._list_containers()
+        return self._volume_mounts
+
+    def _list_containers(self):
+        # a service's containers are preferred over its one-off containers, those with the project's name over
+        # those with the name that docker-compose used before 1.21, the daemon lists the newest ones first
+        legacy_name = re.sub(r'[_-]', '', self.project.name)
+        candidates = []
+        self._summaries = {}
+        for summary in self.client.containers(all=True, filters={'label': [LABEL_PROJECT]}):
+            labels = summary.get('Labels') or {}
+            if labels.get(LABEL_PROJECT) not in (self.project.name, legacy_name):
+                continue
+            container = Container.from_ps(self.client, summary)
+            if container is None:
+                continue
+            self._summaries[container.id] = summary
+            rank = (labels.get(LABEL_ONE_OFF) == 'True', labels[LABEL_PROJECT] != self.project.name)
+            candidates.append((rank, labels.get(LABEL_SERVICE), container))
+        self._containers = {}
+        self._volume_mounts = {}
+        for rank, service_name, container in sorted(candidates, key=lambda x: x[0]):
+            self._containers.setdefault(service_name, []).append(container)
+            for mount in self._summaries[container.id].get('Mounts') or ():
+                if mount.get('Type') == 'volume' and mount.get('Name'):
+                    self._volume_mounts.setdefault(mount['Name'], []).append((container, mount['Destination']))
+
+    def is_running(self, container):
+        # like Container.is_running, paused containers are running
+        return self._summary(container).get('State') in ('running', 'paused')
+
+    def mounts(self, container):
+        # the mounts of a container as listed, mappings with the keys Type, Name, Source, Destination and Driver
+        return self._summary(container).get('Mounts') or ()
+
+    def _summary(self, container):
+        if self._summaries is None:
+            self._list_containers()
+        return self._summaries[container.id]
+
+    def volume_exists(self, volume):
+        # like Volume.exists for a compose Volume
+        if self._volumes is None:
+            self._volumes = {x['Name']: x for x in self.client.volumes().get('Volumes') or ()}
+        return any(x in self._volumes for x in get_volume_names(volume))
+
+    def services_using_volume(self, volume):
+        # the names of the services whose containers mount a compose Volume
+        return sorted(set(self._summary(x)['Labels'].get(LABEL_SERVICE)
+                          for name in get_volume_names(volume) for x, _ in self.volume_mounts.get(name, ())))
+
+    def image(self, service):
+        # like Service.image
+        if self._images is None:
+            self._inspect_images()
+        if service.image_name not in self._images:
+            self._images[service.image_name] = self._inspect_image(service.image_name)
+        image = self._images[service.image_name]
+        if image is None:
+            raise NoSuchImageError("Image '%s' not found" % service.image_name)
+        return image
+
+    def _inspect_images(self):
+        names = sorted(set(x.image_name for x in self.project.services if x.name in self.service_names))
+        self._images = {}
+        if not names:
+            return
+        with worker_pool(min(len(names), IMAGE_THREADS)) as pool:
+            futures = [(x, pool.submit(self._inspect_image, x)) for x in names]
+        for name, future in futures:
+            self._images[name] = future.result()
+
+    def _inspect_image(self, name):
+        try:
+            return self.client.inspect_image(name)
+        except ImageNotFound:
+            return None
@@ -1,20 +1,27 @@
 import logging
 import os
+import re
 import sys
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from collections import OrderedDict
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path, PurePosixPath
+from platform import node as gethostname
+from threading import Lock
 from types import SimpleNamespace
 
-from compose import config as compose_config
-
 from compose_dump import VERSION
-from compose_dump.backup import create_dump
-from compose_dump.utils import setup_loghandler
+from compose_dump.pausing import PAUSE_MODES
+from compose_dump.snapshots import SNAPSHOT_MODES
+from compose_dump.utils import find_projects, setup_loghandler
+
+# compose, docker and yaml take long to import, they're only imported by the subcommands that use them
 
-COMPRESSIONS = ('bz2', 'gz',  'tar', 'xz')
-COMPRESSION_EXTENSIONS = tuple('.' + x for x in COMPRESSIONS)
+COMPRESSIONS = ('bz2', 'gz',  'tar', 'xz', 'zstd')
+COMPRESSION_EXTENSIONS = {'.bz2': 'bz2', '.gz': 'gz', '.tar': 'tar', '.xz': 'xz', '.zst': 'zstd'}
 SCOPES = ('config', 'mounted', 'volumes')
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
 
 
 ####
@@ -41,6 +48,21 @@ def directory_exists(path):
         raise SystemExit(1)
 
 
+def positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise ArgumentTypeError('must be 1 or greater')
+    return value
+
+
+def byte_size(value):
+    # a number of bytes with an optional binary unit, e.g. 512M or 4G
+    match = re.fullmatch(r'(\d+)([KMGT]?)', value.strip().upper())
+    if match is None or not int(match.group(1)):
+        raise ArgumentTypeError('must be a positive number of bytes with an optional unit K, M, G or T')
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
 ####
 
 
@@ -49,7 +71,9 @@ def parse_cli_args(args):
     parser.add_argument('--version', action='version', version=VERSION)
     subparsers = parser.add_subparsers()
     add_backup_parser(subparsers)
+    add_backup_all_parser(subparsers)
     add_restore_parser(subparsers)
+    add_verify_parser(subparsers)
     args = parser.parse_args(args)
     if not hasattr(args, 'action'):
         args.action = help
@@ -60,39 +84,158 @@ def add_backup_parser(subparsers):
     desc, hlp = backup.__doc__.split('####\n')
     parser = subparsers.add_parser('backup', description=desc.strip(), help=hlp.strip())
     parser.set_defaults(action=backup)
+    add_dump_arguments(parser)
+    parser.add_argument('-f', '--file', nargs='*', metavar='FILENAME',
+                        help='Specifies compose files.')
+    parser.add_argument('--project-dir', default=os.getcwd(), metavar='PATH',
+                        help="Specifies the project's root folder, defaults to the current "
+                             "directory.")
+    parser.add_argument('-p', '--project-name', help='Specifies an alternate project name.')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='Continue an interrupted dump that was split with --split-size from its last '
+                             'checkpoint, a new dump is begun if there is none.')
+    parser.add_argument('--since', metavar='PATH',
+                        help='A previous dump that was created with an inventory, only data that changed since '
+                             'is stored.')
+    parser.add_argument('--trust-mtime', action='store_true', default=False,
+                        help='With --since, files in mounted volumes with the same size and modification time '
+                             "as before are considered unchanged and aren't read.")
+    parser.add_argument('--target', '-t', metavar='PATH',
+                        help='Dump target, an s3://bucket/key URL uploads an archive, defaults to stdout.')
+    parser.add_argument('services', default=(), nargs='*', metavar='SERVICE',
+                        help='Restrict backup of build contexts and volumes to these services.')
+
+
+def add_backup_all_parser(subparsers):
+    desc, hlp = backup_all.__doc__.split('####\n')
+    parser = subparsers.add_parser('backup-all', description=desc.strip(), help=hlp.strip())
+    parser.set_defaults(action=backup_all)
+    add_dump_arguments(parser)
+    parser.add_argument('--combined', action='store_true', default=False,
+                        help='Write the dumps of all projects into one archive, each into a folder that is named '
+                             'per --target-pattern.')
+    parser.add_argument('--concurrency', type=positive_int, default=1, metavar='N',
+                        help='Number of projects that are dumped concurrently, defaults to 1.')
+    parser.add_argument('--root', required=True, metavar='PATH',
+                        help='The folder below which projects are looked for.')
+    parser.add_argument('--target', '-t', metavar='PATH',
+                        help='A directory that the dumps are stored in. With --combined the path of the archive '
+                             'or a directory to store it in, defaults to stdout.')
+
+
+def add_dump_arguments(parser):
+    # the options that the backup and backup-all commands have in common
     parser.add_argument('--config', action='store_true', default=False,
                         help='Include configuration files, including referenced files '
                              'and build-contexts.')
     parser.add_argument('-x', '--compression', choices=COMPRESSIONS,
                         help='Sets the compression when an archive file is written. '
                              'Can also be provided as file extension on the --target option.')
-    parser.add_argument('-f', '--file', nargs='*', metavar='FILENAME',
-                        help='Specifies compose files.')
+    parser.add_argument('--dedup', action='store_true', default=False,
+                        help='Store the dump in a repository of deduplicated chunks, --target must point to '
+                             "the repository's directory.")
+    parser.add_argument('--compression-level', type=int, metavar='LEVEL',
+                        help='The level for the chosen compression, defaults to the highest for bz2 and gz, '
+                             'to 6 for xz and 3 for zstd.')
+    parser.add_argument('--compression-threads', type=positive_int, default=1, metavar='N',
+                        help='Number of threads that compress blocks of an archive concurrently, defaults to 1.')
+    parser.add_argument('--encryption-key-file', metavar='PATH',
+                        help='Encrypt the archive with a key that is derived from the secret in this file.')
+    parser.add_argument('--fs-snapshots', choices=SNAPSHOT_MODES,
+                        help='Take snapshots of mounted folders while the services that use them are paused and '
+                             'store these afterwards, see the documentation for the modes.')
+    parser.add_argument('--fs-snapshot-command', metavar='COMMAND',
+                        help="The command that takes and releases snapshots with the 'command' mode.")
+    parser.add_argument('--helper-image', metavar='IMAGE',
+                        help='Archive container volumes with tar in short-lived containers of this image, e.g. '
+                             "busybox, instead of through Docker's archive API.")
+    parser.add_argument('--inventory', action='store_true', default=False,
+                        help='Record sizes, modification times and hashes of all files in mounted and container '
+                             'volumes, this is implied by --since.')
+    parser.add_argument('-j', '--jobs', type=positive_int, default=1, metavar='N',
+                        help='Number of volume archives that are retrieved concurrently, defaults to 1.')
     parser.add_argument('--mounted', action='store_true', default=False,
                         help='Include mounted volumes, skips paths outside project folder.')
+    parser.add_argument('--no-hooks', action='store_true', default=False,
+                        help="Don't execute the hooks that services declare with labels.")
+    parser.add_argument('--no-ignore-files', action='store_true', default=False,
+                        help="Don't exclude paths that match the patterns of .backupignore files in mounted "
+                             "folders and build contexts and of .dockerignore files in build contexts.")
     parser.add_argument('--no-pause', action='store_true', default=False,
                         help="Don't pause containers during backup")
-    parser.add_argument('--project-dir', default=os.getcwd(), metavar='PATH',
-                        help="Specifies the project's root folder, defaults to the current "
-                             "directory.")
-    parser.add_argument('-p', '--project-name', help='Specifies an alternate project name.')
+    parser.add_argument('--metrics-file', metavar='PATH',
+                        help='Append the timings of all operations to this file as JSON lines.')
+    parser.add_argument('--pause-mode', choices=PAUSE_MODES, default='project',
+                        help="Either pause all selected services while volumes are stored or only the services "
+                             "that use the volume that is currently stored. Defaults to 'project'.")
+    parser.add_argument('--progress', action='store_true', default=False,
+                        help='Show the amount of processed data and the throughput on stderr.')
+    parser.add_argument('--read-local-volumes', action='store_true', default=False,
+                        help="Read local volumes from their folders on the Docker host instead of through "
+                             "Docker's API where these are accessible, e.g. when running as root.")
+    parser.add_argument('--s3-endpoint', metavar='URL',
+                        help='The endpoint of an S3 compatible object store for an s3:// --target, defaults to '
+                             "AWS_ENDPOINT_URL or AWS' endpoint for the region.")
     parser.add_argument('--resolve-symlinks', action='store_true', default=False,
                         help='References to configuration files that are symlinks are stored as '
                              'files.')
-    parser.add_argument('--target', '-t', metavar='PATH', help='Dump target, defaults to stdout.')
+    parser.add_argument('--snapshot', action='store_true', default=False,
+                        help='Link files that are unchanged since the previous dump of a project in the --target '
+                             'directory to its files instead of copying them. Requires a folder target.')
+    parser.add_argument('--split-size', type=byte_size, metavar='SIZE',
+                        help='Write an archive in parts of this size, e.g. 4G, and record checkpoints to '
+                             'resume from.')
     parser.add_argument('--target-pattern', metavar='PATTERN', default='{host}__{name}__{path_hash}_{date}_{time}',
                         help='String template for the backup name. May include the placeholders {date}, {host},'
                              '{isodate}, {name}, {path_hash} and {time}.')
+    parser.add_argument('--upload-part-size', type=byte_size, metavar='SIZE',
+                        help='The size of the parts of an upload to an object store, defaults to 16M.')
+    parser.add_argument('--upload-threads', type=positive_int, metavar='N',
+                        help='Number of parts that are uploaded to an object store concurrently, defaults to 4.')
     parser.add_argument('--verbose', action='store_true', default=False,
                         help='Log debug messages.')
     parser.add_argument('--volumes', action='store_true', default=False,
                         help='Include container volumes.')
+
+
+def add_restore_parser(subparsers):
+    desc, hlp = restore.__doc__.split('####\n')
+    parser = subparsers.add_parser('restore', description=desc.strip(), help=hlp.strip())
+    parser.set_defaults(action=restore)
+    parser.add_argument('--config', action='store_true', default=False,
+                        help='Restore configuration files, including referenced files and build-contexts.')
+    parser.add_argument('--encryption-key-file', metavar='PATH',
+                        help='The file with the secret that an encrypted archive was written with.')
+    parser.add_argument('-f', '--file', nargs='*', metavar='FILENAME',
+                        help='Specifies compose files.')
+    parser.add_argument('-j', '--jobs', type=positive_int, default=1, metavar='N',
+                        help='Number of volume archives that are restored concurrently, defaults to 1.')
+    parser.add_argument('--mounted', action='store_true', default=False,
+                        help='Restore mounted volumes.')
+    parser.add_argument('--project-dir', default=os.getcwd(), metavar='PATH',
+                        help="Specifies the project's root folder, defaults to the current "
+                             "directory.")
+    parser.add_argument('-p', '--project-name', help='Specifies an alternate project name.')
+    parser.add_argument('--verbose', action='store_true', default=False,
+                        help='Log debug messages.')
+    parser.add_argument('--volumes', action='store_true', default=False,
+                        help='Restore container volumes.')
+    parser.add_argument('source', metavar='DUMP',
+                        help='A dump folder, an archive file or - to read an archive from stdin.')
     parser.add_argument('services', default=(), nargs='*', metavar='SERVICE',
-                        help='Restrict backup of build contexts and volumes to these services.')
+                        help='Restrict restoration of volumes to these services.')
 
 
-def add_restore_parser(parser):
-    pass
+def add_verify_parser(subparsers):
+    desc, hlp = verify.__doc__.split('####\n')
+    parser = subparsers.add_parser('verify', description=desc.strip(), help=hlp.strip())
+    parser.set_defaults(action=verify)
+    parser.add_argument('--encryption-key-file', metavar='PATH',
+                        help='The file with the secret that an encrypted archive was written with.')
+    parser.add_argument('--verbose', action='store_true', default=False,
+                        help='Log debug messages.')
+    parser.add_argument('source', metavar='DUMP',
+                        help='A dump folder, an archive file or - to read an archive from stdin.')
 
 
 ####
@@ -101,11 +244,9 @@ def add_restore_parser(parser):
 def help(args):
     print("""Backup and restore Docker-Compose projects.
 
-Use one of the subcommands `backup` or `restore`.
+Use one of the subcommands `backup`, `backup-all`, `restore` or `verify`.
 For help on each append the `--help` argument.
 
-Restoring is not implemented yet.
-
 Online documentation: http://compose-dump.rtfd.io/
 """)
 
@@ -123,6 +264,8 @@ def backup(args):
         $ compose-compose_dump backup -t /var/backups/docker-compose
     ####
     """
+    from compose_dump.backup import create_dump
+
     options = process_backup_options(vars(args).copy())
     config, config_details, environment = get_compose_context(options)
     log.debug('Invoking project compose_dump with these settings: %s' % options)
@@ -144,6 +287,35 @@ def process_backup_options(options):
                                os.getenv('COMPOSE_PROJECT_NAME') or
                                options['project_dir'].name)
 
+    if options['since'] is not None:
+        from compose_dump.streams import find_parts
+        options['since'] = Path(options['since']).resolve()
+        if not options['since'].exists() and not find_parts(options['since']):
+            log.error('%s does not exist.' % options['since'])
+            raise SystemExit(1)
+        options['inventory'] = True
+
+    options = process_dump_options(options)
+    if options['resume'] and options['split_size'] is None:
+        log.error('--resume requires --split-size.')
+        raise SystemExit(1)
+    if options['resume'] and options['inventory']:
+        log.error("Dumps with an inventory can't be resumed.")
+        raise SystemExit(1)
+    return options
+
+
+def process_dump_options(options):
+    from compose_dump.objectstore import is_s3_url
+    from compose_dump.streams import zstandard
+
+    if options['metrics_file'] is not None:
+        options['metrics_file'] = Path(options['metrics_file']).resolve()
+
+    if (options['fs_snapshots'] == 'command') != (options['fs_snapshot_command'] is not None):
+        log.error("--fs-snapshot-command must be given if and only if --fs-snapshots is 'command'.")
+        raise SystemExit(1)
+
     options['scopes'] = ()
     for scope in SCOPES:
         if options[scope]:
@@ -152,25 +324,281 @@ def process_backup_options(options):
     if not options['scopes']:
         options['scopes'] = SCOPES
 
-    if options['target'] is not None:
+    if options['dedup']:
+        if options['target'] is None or is_s3_url(options['target']) or options['compression'] is not None:
+            log.error('A chunk repository requires a --target directory and no compression.')
+            raise SystemExit(1)
+        if options['snapshot']:
+            log.error("Snapshots can't be stored in a chunk repository, it deduplicates all data anyway.")
+            raise SystemExit(1)
+        options['target'] = Path(options['target'])
+        directory_exists(options['target'])
+        options['target_type'] = 'chunks'
+        return options
+
+    if is_s3_url(options['target']):
+        # an object store only holds archives
+        if options['compression'] is None:
+            options['compression'] = COMPRESSION_EXTENSIONS.get(PurePosixPath(options['target']).suffix, 'tar')
+    elif options['target'] is not None:
         options['target'] = Path(options['target'])
         if options['compression'] is None and \
                 options['target'].suffix in COMPRESSION_EXTENSIONS:
-            options['compression'] = options['target'].suffix[1:]
+            options['compression'] = COMPRESSION_EXTENSIONS[options['target'].suffix]
     elif options['compression'] is None:
         options['compression'] = 'tar'
-    if options['compression']:
+    if options['compression'] == 'zstd' and zstandard is None:
+        log.error('The zstandard package is required for zstd compression.')
+        raise SystemExit(1)
+    if is_s3_url(options['target']):
+        options['target_type'] = 's3'
+    elif options['compression']:
         options['target_type'] = 'archive'
     else:
         directory_exists(options['target'])
         options['target_type'] = 'folder'
 
+    if options['target_type'] != 's3' and options['s3_endpoint'] is not None:
+        log.error('--s3-endpoint requires an s3:// URL as --target.')
+        raise SystemExit(1)
+    if options['encryption_key_file'] is not None and options['target_type'] not in ('archive', 's3'):
+        log.error('Encryption requires an archive as --target.')
+        raise SystemExit(1)
+    process_key_file_option(options)
+    if options['snapshot'] and options['target_type'] != 'folder':
+        log.error('Snapshots require a folder as --target and no compression.')
+        raise SystemExit(1)
+    if options['split_size'] is not None and (options['target_type'] != 'archive' or options['target'] is None):
+        log.error('--split-size requires an archive file or a directory to store it in as --target.')
+        raise SystemExit(1)
+
     return options
 
 
+def backup_all(args):
+    """
+    Backup all projects below a folder in one process.
+
+    Each folder below the root that contains a docker-compose.yml or
+    docker-compose.yaml is dumped as a project, hidden folders are skipped.
+
+    For example:
+
+        $ compose-dump backup-all --root /srv -t /var/backups/docker-compose
+    ####
+    """
+    from compose.config.errors import ConfigurationError
+    from compose_dump.objectstore import is_s3_url
+    from compose_dump.storage import ArchiveStorage, S3Storage
+
+    options = process_backup_all_options(vars(args).copy())
+    project_dirs = find_projects(options['root'])
+    if not project_dirs:
+        log.error('Found no projects below %s.' % options['root'])
+        raise SystemExit(1)
+    log.info('Found %i projects below %s.' % (len(project_dirs), options['root']))
+    log.debug('Invoking batch compose_dump with these settings: %s' % options)
+
+    # the Docker clients are shared by all dumps, the dumps' storages may share the batch's archive
+    batch = SimpleNamespace(options=options, clients={}, shared_storage=None, shared_lock=Lock())
+    if options['combined']:
+        batch.manifest = {'meta': {'invocation_time': datetime.now().isoformat(), 'host': gethostname()}}
+        storage_class = S3Storage if is_s3_url(options['target']) else ArchiveStorage
+        batch.shared_storage = storage_class(SimpleNamespace(
+            options=dict(options, project_name=options['root'].name, project_dir=options['root']),
+            manifest=batch.manifest))
+
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=options['concurrency'], thread_name_prefix='project') as executor:
+            futures = [(x, executor.submit(backup_project, batch, x)) for x in project_dirs]
+            try:
+                for project_dir, future in futures:
+                    try:
+                        future.result()
+                    except SystemExit:
+                        failed.append(project_dir)
+                    except ConfigurationError as e:
+                        log.error('%s: %s' % (project_dir, e.msg))
+                        failed.append(project_dir)
+                    except Exception as e:
+                        log.error('Failed to dump %s:' % project_dir)
+                        log.exception(e)
+                        failed.append(project_dir)
+            finally:
+                # when the batch is interrupted, the projects that haven't begun aren't dumped
+                for _, future in futures:
+                    future.cancel()
+        if batch.shared_storage is not None:
+            batch.shared_storage.finalize()
+    except BaseException:
+        # like the storage of a dump that fails, the combined archive is left incomplete
+        if batch.shared_storage is not None:
+            batch.shared_storage.abort()
+        raise
+    if failed:
+        log.error('Failed to dump: %s' % ', '.join(str(x) for x in failed))
+        raise SystemExit(1)
+
+
+def process_backup_all_options(options):
+    from compose_dump.objectstore import is_s3_url
+
+    del options['action']
+
+    options['root'] = Path(options['root']).resolve()
+    directory_exists(options['root'])
+    options['compose_files'] = None
+    options['since'] = None
+
+    if options['combined']:
+        if options['dedup']:
+            log.error("A chunk repository can't be used with --combined.")
+            raise SystemExit(1)
+        target = options['target']
+        if options['compression'] is None and \
+                (target is None or Path(target).suffix not in COMPRESSION_EXTENSIONS):
+            options['compression'] = 'tar'
+    elif options['target'] is None:
+        log.error('A --target directory is required unless --combined is set.')
+        raise SystemExit(1)
+    elif not is_s3_url(options['target']):
+        directory_exists(Path(options['target']))
+
+    options = process_dump_options(options)
+    if options['combined']:
+        options['target_type'] = 'shared'
+    return options
+
+
+def backup_project(batch, project_dir):
+    # dumps one project of a batch
+    from compose_dump.backup import create_dump
+
+    options = batch.options.copy()
+    options['project_dir'] = project_dir
+    options['project_name'] = get_env_file_project_name(project_dir) or project_dir.name
+    options['services'] = ()
+    config, config_details, environment = get_compose_context(options)
+    log.info('Dumping project %s in %s' % (options['project_name'], project_dir))
+    ctx = SimpleNamespace(
+        options=options, manifest=OrderedDict(), config=config, config_details=config_details,
+        environment=environment, clients=batch.clients, shared_storage=batch.shared_storage,
+        shared_lock=batch.shared_lock)
+    create_dump(ctx)
+
+
+def get_env_file_project_name(project_dir):
+    # the environment variable COMPOSE_PROJECT_NAME applies to all projects, hence only the .env file is read
+    from compose.config.environment import env_vars_from_file
+
+    env_file = project_dir / '.env'
+    if env_file.is_file():
+        return env_vars_from_file(str(env_file)).get('COMPOSE_PROJECT_NAME')
+    return None
+
+
+def restore(args):
+    """
+    Restore a project's configuration, mounted volumes and container volumes from a dump.
+
+    If none of the include flags is provided, all are set to true. Missing containers are
+    created, running containers should be stopped before.
+
+    For example:
+
+        $ compose-dump restore /var/backups/docker-compose/dump.tar.gz
+    ####
+    """
+    from compose.config.environment import Environment
+    from compose_dump.restore import restore_dump
+
+    options = process_restore_options(vars(args).copy())
+    environment = Environment.from_env_file(str(options['project_dir']))
+    log.debug('Invoking project restore with these settings: %s' % options)
+    ctx = SimpleNamespace(options=options, environment=environment)
+    restore_dump(ctx)
+
+
+def process_restore_options(options):
+    del options['action']
+
+    options['compose_files'] = options['file']
+    del options['file']
+
+    options['project_dir'] = Path(options['project_dir']).resolve()
+    directory_exists(options['project_dir'])
+    options['project_name'] = (options['project_name'] or
+                               os.getenv('COMPOSE_PROJECT_NAME') or
+                               options['project_dir'].name)
+
+    options['scopes'] = ()
+    for scope in SCOPES:
+        if options[scope]:
+            options['scopes'] += (scope,)
+        del options[scope]
+    if not options['scopes']:
+        options['scopes'] = SCOPES
+
+    options['source'] = process_source_option(options['source'])
+    process_key_file_option(options)
+
+    return options
+
+
+def verify(args):
+    """
+    Verify a dump's contents against the checksums in its manifest.
+
+    The dump is read in one pass, the command exits with a non-zero status if
+    a file is missing, unexpected or has been altered.
+
+    For example:
+
+        $ compose-dump verify /var/backups/docker-compose/dump.tar.gz
+    ####
+    """
+    from compose_dump.verify import verify_dump
+
+    options = vars(args).copy()
+    del options['action']
+    options['source'] = process_source_option(options['source'])
+    process_key_file_option(options)
+    verify_dump(SimpleNamespace(options=options))
+
+
+def process_source_option(source):
+    from compose_dump.streams import find_parts
+
+    if source == '-':
+        return None
+    source = Path(source).resolve()
+    if not source.exists() and not find_parts(source):
+        log.error('%s does not exist.' % source)
+        raise SystemExit(1)
+    return source
+
+
+def process_key_file_option(options):
+    from compose_dump.encryption import ChaCha20Poly1305
+
+    if options['encryption_key_file'] is None:
+        return
+    if ChaCha20Poly1305 is None:
+        log.error('The cryptography package is required for encryption.')
+        raise SystemExit(1)
+    options['encryption_key_file'] = Path(options['encryption_key_file']).resolve()
+    if not options['encryption_key_file'].is_file():
+        log.error('%s does not exist.' % options['encryption_key_file'])
+        raise SystemExit(1)
+
+
 def get_compose_context(options):
+    from compose import config as compose_config
+    from compose.config.environment import Environment
+
     base_dir = str(options['project_dir'])
-    environment = compose_config.environment.Environment.from_env_file(base_dir)
+    environment = Environment.from_env_file(base_dir)
     config_details = compose_config.find(base_dir, options['compose_files'], environment)
     config = compose_config.load(config_details)
     unknown_services = set(options['services']) - set(x['name'] for x in config.services)
@@ -193,13 +621,15 @@ def main():
         args.action(args)
     except SystemExit as e:
         exit_code = e.code
-    except compose_config.ConfigurationError as e:
-        log.error(e.msg)
-        exit_code = 1
     except Exception as e:
-        log.error('An unhandled exception occurred, please submit a bug report:')
-        log.exception(e)
-        exit_code = 3
+        from compose.config.errors import ConfigurationError
+        if isinstance(e, ConfigurationError):
+            log.error(e.msg)
+            exit_code = 1
+        else:
+            log.error('An unhandled exception occurred, please submit a bug report:')
+            log.exception(e)
+            exit_code = 3
     else:
         exit_code = 0
 
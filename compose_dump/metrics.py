@@ -0,0 +1,152 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import sys
+import threading
+from time import monotonic, time
+
+
+# the minimal interval between updates of the progress line in seconds
+PROGRESS_INTERVAL = 0.2
+
+# guards the metrics files that the dumps of a batch may share
+files_lock = threading.Lock()
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'TiB'
+    return '%.1f %s' % (size, unit)
+
+
+class Operation:
+    # A timed step of a dump, e.g. storing a volume. It may be measured in several spans from different
+    # threads, its duration lasts from the first span's start to the last one's end.
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.start = self.end = None
+        self.paused_start = self.paused_end = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def as_dict(self):
+        duration = self.duration
+        return OrderedDict((
+            ('operation', self.kind),
+            ('name', self.name),
+            ('duration', round(duration, 3)),
+            ('bytes_read', self.bytes_read),
+            ('bytes_written', self.bytes_written),
+            ('throughput', round(self.bytes_read / duration) if duration else None),
+            ('paused', round(self.paused_end - self.paused_start, 3)),
+        ))
+
+
+class Metrics:
+    # Collects the timings of a dump's operations. The storages report the bytes that they read and write
+    # with count, these are attributed to the operation that the reporting thread currently measures.
+    # Finished operations are reported to a progress line on stderr and appended to a JSON-lines file if
+    # these are enabled, all are summarized in the manifest's timings section.
+
+    def __init__(self, progress=False, metrics_file=None, name=None):
+        self.progress = progress
+        self.metrics_file = metrics_file
+        self.name = name
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.operations = []
+        self.start = monotonic()
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.last_progress = 0.0
+        # a callable that returns the accumulated time that services were paused
+        self.paused_time = lambda: 0.0
+
+    def count(self, read=0, written=0):
+        operation = getattr(self.local, 'operation', None)
+        with self.lock:
+            self.bytes_read += read
+            self.bytes_written += written
+            if operation is not None:
+                operation.bytes_read += read
+                operation.bytes_written += written
+        if self.progress:
+            self._show_progress(operation)
+
+    @contextmanager
+    def measure(self, kind, name):
+        operation = Operation(kind, name)
+        with self.span(operation):
+            yield operation
+        self.finish(operation)
+
+    @contextmanager
+    def span(self, operation):
+        previous = getattr(self.local, 'operation', None)
+        self.local.operation = operation
+        if operation.start is None:
+            operation.start = monotonic()
+            operation.paused_start = self.paused_time()
+        try:
+            yield operation
+        finally:
+            self.local.operation = previous
+            operation.end = monotonic()
+            operation.paused_end = self.paused_time()
+
+    def finish(self, operation):
+        with self.lock:
+            self.operations.append(operation)
+        if self.metrics_file is not None:
+            record = operation.as_dict()
+            record['time'] = time()
+            if self.name is not None:
+                record['dump'] = self.name
+            with files_lock, open(str(self.metrics_file), 'at') as f:
+                f.write(json.dumps(record) + '\n')
+        if self.progress:
+            self._show_progress(operation, force=True)
+
+    def close(self):
+        if self.progress:
+            self._show_progress(None, force=True)
+            sys.stderr.write('\n')
+
+    @property
+    def timings(self):
+        # the manifest's timings section
+        duration = monotonic() - self.start
+        total = OrderedDict((
+            ('duration', round(duration, 3)),
+            ('bytes_read', self.bytes_read),
+            ('bytes_written', self.bytes_written),
+            ('throughput', round(self.bytes_read / duration) if duration else None),
+            ('paused', round(self.paused_time(), 3)),
+        ))
+        operations = [x.as_dict() for x in sorted(self.operations, key=lambda x: x.start)]
+        return OrderedDict((('total', total), ('operations', operations)))
+
+    def _show_progress(self, operation, force=False):
+        now = monotonic()
+        with self.lock:
+            if not force and now - self.last_progress < PROGRESS_INTERVAL:
+                return
+            self.last_progress = now
+            duration = now - self.start
+            line = '%s read, %s written, %s/s' % (
+                format_size(self.bytes_read), format_size(self.bytes_written),
+                format_size(self.bytes_read / duration if duration else 0))
+            if operation is not None:
+                line += ' - %s %s' % (operation.kind, operation.name)
+            sys.stderr.write('\r\033[K' + line)
+            sys.stderr.flush()
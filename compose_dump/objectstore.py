@@ -0,0 +1,252 @@
+from collections import deque
+from concurrent.futures import wait
+from datetime import datetime
+import hashlib
+import hmac
+import io
+import logging
+import os
+from threading import local
+from time import sleep
+from urllib.parse import parse_qsl, quote, urlsplit
+from xml.etree import ElementTree
+
+import requests
+
+from compose_dump.utils import worker_pool
+
+
+S3_SCHEME = 's3://'
+# the size of the parts of a multipart upload, the last one may be smaller, S3 requires 5 MiB at least
+UPLOAD_PART_SIZE = 16 * 1024 ** 2
+MIN_UPLOAD_PART_SIZE = 5 * 1024 ** 2
+# the number of parts that are uploaded concurrently
+UPLOAD_THREADS = 4
+# the part size is doubled after this many parts, so that the 10000 parts which S3 allows per upload
+# suffice for more than a petabyte
+PARTS_PER_SIZE = 1000
+# failed requests are repeated after delays that begin with RETRY_DELAY seconds and are doubled each time
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 1
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+EMPTY_PAYLOAD_HASH = hashlib.sha256(b'').hexdigest()
+
+
+log = logging.getLogger('compose-compose_dump')
+
+
+def is_s3_url(target):
+    return isinstance(target, str) and target.startswith(S3_SCHEME)
+
+
+def parse_s3_url(url):
+    # returns the bucket and the key or prefix of an s3://bucket/key URL
+    bucket, _, key = url[len(S3_SCHEME):].partition('/')
+    return bucket, key.strip('/')
+
+
+def canonical_query(query):
+    return '&'.join('%s=%s' % (quote(k, safe='-_.~'), quote(v, safe='-_.~'))
+                    for k, v in sorted(parse_qsl(query, keep_blank_values=True)))
+
+
+def signature(method, path, query, headers, payload_hash, secret_key, region, timestamp):
+    # the AWS Signature Version 4 of a request to S3, headers maps the lower-case names of the signed
+    # headers to their values, timestamp is the value of the x-amz-date header, e.g. 20130524T000000Z
+    names = sorted(headers)
+    canonical_request = '\n'.join((
+        method, path, canonical_query(query),
+        ''.join('%s:%s\n' % (x, ' '.join(headers[x].split())) for x in names),
+        ';'.join(names), payload_hash))
+    scope = '%s/%s/s3/aws4_request' % (timestamp[:8], region)
+    string_to_sign = '\n'.join(('AWS4-HMAC-SHA256', timestamp, scope,
+                                hashlib.sha256(canonical_request.encode()).hexdigest()))
+    key = ('AWS4' + secret_key).encode()
+    for part in (timestamp[:8], region, 's3', 'aws4_request'):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    return hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+
+class S3Client:
+    # Sends signed requests to an S3 compatible endpoint with path-style addressing. Failed requests are
+    # repeated, a request that fails finally ends the program. Each thread uses its own HTTP session.
+
+    def __init__(self, endpoint, region, access_key, secret_key, session_token=None):
+        self.endpoint = endpoint.rstrip('/')
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.session_token = session_token
+        self.local = local()
+
+    @classmethod
+    def from_environment(cls, endpoint=None):
+        # the credentials are read from the environment variables that AWS' tools use
+        access_key, secret_key = os.environ.get('AWS_ACCESS_KEY_ID'), os.environ.get('AWS_SECRET_ACCESS_KEY')
+        if not access_key or not secret_key:
+            log.error('The environment variables AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY must be set '
+                      'to upload to an object store.')
+            raise SystemExit(1)
+        region = os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION') or 'us-east-1'
+        endpoint = endpoint or os.environ.get('AWS_ENDPOINT_URL') or 'https://s3.%s.amazonaws.com' % region
+        return cls(endpoint, region, access_key, secret_key, os.environ.get('AWS_SESSION_TOKEN'))
+
+    @property
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def request(self, method, bucket, key, query='', data=b''):
+        # returns the response to a request for an object, query is an encoded query string
+        path = quote('/%s/%s' % (bucket, key), safe='/-_.~')
+        url = self.endpoint + path + ('?' + query if query else '')
+        payload_hash = hashlib.sha256(data).hexdigest() if data else EMPTY_PAYLOAD_HASH
+        description = '%s %s/%s' % (method, bucket, key)
+
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt:
+                sleep(RETRY_DELAY * 2 ** (attempt - 1))
+            headers = {'host': urlsplit(self.endpoint).netloc, 'x-amz-content-sha256': payload_hash,
+                       'x-amz-date': datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}
+            if self.session_token:
+                headers['x-amz-security-token'] = self.session_token
+            signed_headers = ';'.join(sorted(headers))
+            headers['authorization'] = \
+                'AWS4-HMAC-SHA256 Credential=%s/%s/%s/s3/aws4_request, SignedHeaders=%s, Signature=%s' % (
+                    self.access_key, headers['x-amz-date'][:8], self.region, signed_headers,
+                    signature(method, path, query, headers, payload_hash, self.secret_key, self.region,
+                              headers['x-amz-date']))
+            try:
+                response = self.session.request(method, url, data=data, headers=headers)
+            except requests.RequestException as e:
+                log.warning('%s failed, attempt %i of %i: %s' % (description, attempt + 1, MAX_ATTEMPTS, e))
+                continue
+            if not self._failed(method, response):
+                return response
+            if response.status_code >= 300 and response.status_code not in RETRY_STATUSES:
+                log.error('%s failed with status %i: %s' %
+                          (description, response.status_code, response.text.strip()))
+                raise SystemExit(1)
+            log.warning('%s failed with status %i, attempt %i of %i.' %
+                        (description, response.status_code, attempt + 1, MAX_ATTEMPTS))
+        log.error('%s failed after %i attempts.' % (description, MAX_ATTEMPTS))
+        raise SystemExit(1)
+
+    @staticmethod
+    def _failed(method, response):
+        # the completion of a multipart upload may fail after a response's status 200 has been sent
+        if response.status_code >= 300:
+            return True
+        return method == 'POST' and response.content.lstrip().startswith(b'<') and \
+            ElementTree.fromstring(response.content).tag == 'Error'
+
+
+class MultipartUpload(io.RawIOBase):
+    # A writable file object that uploads the written data to an object when complete is called. The data
+    # is collected in parts that are uploaded by a pool of threads as a multipart upload, the number of parts
+    # in memory is bounded. Data that doesn't fill a part is uploaded as a simple object. The upload is
+    # aborted if it fails or if the file object is closed before it has been completed.
+
+    def __init__(self, client, bucket, key, part_size=UPLOAD_PART_SIZE, threads=UPLOAD_THREADS):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.threads = threads
+        self.buffer = bytearray()
+        self.position = 0
+        self.upload_id = None
+        # the numbers and uploads of parts in flight and the numbers and ETags of uploaded parts
+        self.pending = deque()
+        self.parts = []
+        self.executor = worker_pool(threads)
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self._submit(part)
+        return len(data)
+
+    def complete(self):
+        if self.upload_id is None:
+            self.client.request('PUT', self.bucket, self.key, data=bytes(self.buffer))
+            return
+        if self.buffer:
+            part, self.buffer = bytes(self.buffer), bytearray()
+            self._submit(part)
+        while self.pending:
+            self._finish_next()
+        body = '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % ''.join(
+            '<Part><PartNumber>%i</PartNumber><ETag>%s</ETag></Part>' % x for x in self.parts)
+        self.client.request('POST', self.bucket, self.key, self._query(), body.encode())
+        self.upload_id = None
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.upload_id is not None:
+                self._abort()
+        finally:
+            self.executor.shutdown(wait=False)
+            super().close()
+
+    def _query(self, **params):
+        params['uploadId'] = self.upload_id
+        return '&'.join('%s=%s' % (k, quote(str(v), safe='')) for k, v in sorted(params.items()))
+
+    def _submit(self, part):
+        if self.upload_id is None:
+            response = self.client.request('POST', self.bucket, self.key, 'uploads=')
+            self.upload_id = self._find(response, 'UploadId')
+        number = len(self.parts) + len(self.pending) + 1
+        if number % PARTS_PER_SIZE == 0:
+            self.part_size *= 2
+        self.pending.append((number, self.executor.submit(self._upload_part, number, part)))
+        while len(self.pending) > self.threads:
+            self._finish_next()
+
+    def _upload_part(self, number, part):
+        response = self.client.request('PUT', self.bucket, self.key, self._query(partNumber=number), part)
+        return response.headers['ETag']
+
+    def _finish_next(self):
+        number, future = self.pending.popleft()
+        try:
+            self.parts.append((number, future.result()))
+        except BaseException:
+            self.close()
+            raise
+
+    def _abort(self):
+        # the parts of an aborted upload are discarded by the object store
+        for number, future in self.pending:
+            future.cancel()
+        # a part that is being uploaded would be stored after the upload was aborted
+        wait([x for _, x in self.pending])
+        self.pending.clear()
+        log.warning('Aborting the upload of %s/%s.' % (self.bucket, self.key))
+        try:
+            self.client.request('DELETE', self.bucket, self.key, self._query())
+        except SystemExit:
+            log.warning('The parts of the incomplete upload %s remain in the bucket %s.' % (self.key, self.bucket))
+        self.upload_id = None
+
+    @staticmethod
+    def _find(response, name):
+        # the text of an element in an XML response, whose elements may or may not be namespaced
+        for element in ElementTree.fromstring(response.content).iter():
+            if element.tag.rpartition('}')[2] == name:
+                return element.text
+        log.error('Found no %s in the response: %s' % (name, response.text))
+        raise SystemExit(1)
@@ -0,0 +1,95 @@
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import logging
+from threading import Lock
+from time import monotonic
+
+
+PAUSE_MODES = ('project', 'volume')
+
+
+log = logging.getLogger('compose-compose_dump')
+
+
+class PauseScheduler:
+    # In the 'project' mode all selected services are paused while volumes are stored, in the 'volume'
+    # mode only the services that use the volume that is currently captured. As volumes may be captured
+    # concurrently, pauses are reference counted per service. The accumulated time that each service
+    # spent paused is collected in the downtimes property.
+
+    def __init__(self, ctx):
+        self.project = ctx.project
+        self.services = ctx.options['services']
+        self.mode = None if ctx.options['no_pause'] else ctx.options.get('pause_mode', 'project')
+        self.lock = Lock()
+        self.references = Counter()
+        self.paused_since = {}
+        self._downtimes = Counter()
+        # the time during which any service was paused
+        self.any_paused_since = None
+        self._paused_time = 0.0
+
+    @property
+    def downtimes(self):
+        return OrderedDict((x, round(self._downtimes[x], 3)) for x in sorted(self._downtimes))
+
+    def paused_time(self):
+        # returns the accumulated time during which any of the services was paused, including an ongoing pause
+        with self.lock:
+            result = self._paused_time
+            if self.any_paused_since is not None:
+                result += monotonic() - self.any_paused_since
+            return result
+
+    @contextmanager
+    def project_window(self):
+        if self.mode == 'project':
+            with self._paused(self.services):
+                yield
+        else:
+            yield
+
+    @contextmanager
+    def volume_window(self, service_names):
+        if self.mode == 'volume':
+            with self._paused(service_names):
+                yield
+        else:
+            yield
+
+    @contextmanager
+    def _paused(self, service_names):
+        service_names = sorted(set(service_names))
+        self.pause(service_names)
+        try:
+            yield
+        finally:
+            self.unpause(service_names)
+
+    def pause(self, service_names):
+        with self.lock:
+            to_pause = [x for x in service_names if not self.references[x]]
+            if to_pause:  # the project would consider all services if the list was empty
+                log.debug('Pausing services: %s' % ', '.join(to_pause))
+                self.project.pause(service_names=to_pause)
+                now = monotonic()
+                for name in to_pause:
+                    self.paused_since[name] = now
+                if self.any_paused_since is None:
+                    self.any_paused_since = now
+            # only counted once paused, a failed pause leaves nothing that a window would unpause
+            self.references.update(service_names)
+
+    def unpause(self, service_names):
+        with self.lock:
+            self.references.subtract(service_names)
+            to_unpause = [x for x in service_names if not self.references[x]]
+            if to_unpause:
+                self.project.unpause(service_names=to_unpause)
+                now = monotonic()
+                for name in to_unpause:
+                    self._downtimes[name] += now - self.paused_since.pop(name)
+                if not self.paused_since:
+                    self._paused_time += now - self.any_paused_since
+                    self.any_paused_since = None
+                log.debug('Unpaused services: %s' % ', '.join(to_unpause))
@@ -0,0 +1,205 @@
+import io
+import json
+import os
+from pathlib import Path, PurePosixPath
+import stat
+import sys
+
+import yaml
+
+from compose_dump.chunks import ChunkRepository
+from compose_dump.encryption import read_secret
+from compose_dump.storage import PAX_PREFIX
+from compose_dump.streams import find_parts, PartsReader, read_archive
+
+
+INDEX_NAME = 'Index.json'
+INVENTORY_NAME = 'Inventory.json'
+MANIFEST_NAME = 'Manifest.yml'
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def parse_manifest(data):
+    return next(yaml.load_all(data, Loader=SafeLoader))
+
+
+def open_dump(source, key_file=None):
+    # source is the path of a dump folder, an archive file, a split archive or its first part, a dump in a
+    # chunk repository or None for stdin, key_file is needed to read encrypted archives
+    secret = None if key_file is None else read_secret(key_file)
+    if source is None:
+        return ArchiveDump(sys.stdin.buffer, secret)
+    source = Path(source)
+    parts = find_parts(source)
+    if parts:
+        return ArchiveDump(PartsReader(parts), secret)
+    elif not source.is_dir():
+        return ArchiveDump(source.open('rb'), secret)
+    elif (source / INDEX_NAME).is_file():
+        return ChunkDump(source)
+    else:
+        return FolderDump(source)
+
+
+class DumpMember:
+    # a file, folder, symlink or something else in a dump, open returns a readable file object for files
+
+    def __init__(self, name, type, size=0, mode=0o644, mtime=0, linkname=None, metadata=None, opener=None):
+        self.name = name
+        self.type = type
+        self.size = size
+        self.mode = mode
+        self.mtime = mtime
+        self.linkname = linkname
+        self.metadata = metadata or {}
+        self.opener = opener
+
+    @property
+    def path(self):
+        return PurePosixPath(self.name)
+
+    def open(self):
+        return self.opener()
+
+
+class DumpBase:
+    # Dumps are iterated over in one pass. With random access, members' contents can be read in any
+    # order and from different threads, otherwise only before the iteration proceeds. The manifest and
+    # inventory of dumps without random access are only available after they have been iterated over.
+    random_access = True
+
+    def __init__(self):
+        self.manifest = None
+        self.inventory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        pass
+
+    def _read_metadata(self, path):
+        if (path / MANIFEST_NAME).is_file():
+            self.manifest = parse_manifest((path / MANIFEST_NAME).read_bytes())
+        if (path / INVENTORY_NAME).is_file():
+            self.inventory = json.loads((path / INVENTORY_NAME).read_text())
+
+
+class FolderDump(DumpBase):
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._read_metadata(path)
+
+    def __iter__(self):
+        for dirpath, dirnames, filenames in os.walk(str(self.path)):
+            dirnames.sort()
+            for name in sorted(dirnames + filenames):
+                path = Path(dirpath) / name
+                yield self._make_member(path, path.relative_to(self.path).as_posix())
+
+    @staticmethod
+    def _make_member(path, name):
+        stat_result = os.lstat(str(path))
+        mode = stat_result.st_mode
+        kwargs = {'mode': stat.S_IMODE(mode), 'mtime': stat_result.st_mtime}
+        if stat.S_ISREG(mode):
+            return DumpMember(name, 'file', size=stat_result.st_size, opener=lambda: path.open('rb'), **kwargs)
+        elif stat.S_ISDIR(mode):
+            return DumpMember(name, 'dir', **kwargs)
+        elif stat.S_ISLNK(mode):
+            return DumpMember(name, 'symlink', linkname=os.readlink(str(path)), **kwargs)
+        else:
+            return DumpMember(name, 'other', **kwargs)
+
+
+class ArchiveDump(DumpBase):
+    random_access = False
+
+    def __init__(self, fileobj, secret=None):
+        super().__init__()
+        self.fileobj = fileobj
+        self.secret = secret
+
+    def close(self):
+        if self.fileobj is not sys.stdin.buffer:
+            self.fileobj.close()
+
+    def __iter__(self):
+        with read_archive(self.fileobj, self.secret) as archive:
+            for tarinfo in archive:
+                member = self._make_member(archive, tarinfo)
+                if member.name in (INVENTORY_NAME, MANIFEST_NAME):
+                    # a stream's member can only be read once
+                    data = member.open().read()
+                    member.opener = lambda data=data: io.BytesIO(data)
+                    if member.name == MANIFEST_NAME:
+                        self.manifest = parse_manifest(data)
+                    else:
+                        self.inventory = json.loads(data.decode())
+                yield member
+
+    @staticmethod
+    def _make_member(archive, tarinfo):
+        metadata = {k[len(PAX_PREFIX):]: v for k, v in tarinfo.pax_headers.items() if k.startswith(PAX_PREFIX)}
+        kwargs = {'mode': tarinfo.mode, 'mtime': tarinfo.mtime, 'metadata': metadata}
+        name = tarinfo.name.rstrip('/')
+        if tarinfo.isreg():
+            return DumpMember(name, 'file', size=tarinfo.size, opener=lambda: archive.extractfile(tarinfo),
+                              **kwargs)
+        elif tarinfo.isdir():
+            return DumpMember(name, 'dir', **kwargs)
+        elif tarinfo.issym():
+            return DumpMember(name, 'symlink', linkname=tarinfo.linkname, **kwargs)
+        else:
+            return DumpMember(name, 'other', **kwargs)
+
+
+class ChunkDump(DumpBase):
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.repository = ChunkRepository(path.parent.parent)
+        self._read_metadata(path)
+        with (path / INDEX_NAME).open('rt') as f:
+            self.index = json.load(f)
+
+    def __iter__(self):
+        for name in sorted(self.index):
+            entry = self.index[name]
+            kwargs = {'mode': entry.get('mode', 0o644), 'mtime': entry.get('mtime', 0),
+                      'metadata': entry.get('metadata')}
+            if entry['type'] == 'file':
+                yield DumpMember(name, 'file', size=entry['size'], opener=self._opener(entry['chunks']), **kwargs)
+            else:
+                yield DumpMember(name, entry['type'], linkname=entry.get('linkname'), **kwargs)
+        for name in (INVENTORY_NAME, MANIFEST_NAME):
+            if (self.path / name).is_file():
+                yield FolderDump._make_member(self.path / name, name)
+
+    def _opener(self, digests):
+        return lambda: io.BufferedReader(ChunkReader(self.repository, digests))
+
+
+class ChunkReader(io.RawIOBase):
+    def __init__(self, repository, digests):
+        self.repository = repository
+        self.digests = iter(digests)
+        self.buffer = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.buffer:
+            digest = next(self.digests, None)
+            if digest is None:
+                return 0
+            self.buffer = memoryview(self.repository.get(digest))
+        size = min(len(buffer), len(self.buffer))
+        buffer[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
@@ -0,0 +1,345 @@
+from collections import defaultdict, deque
+import logging
+import os
+from pathlib import Path, PurePosixPath
+import posixpath
+import shutil
+import stat
+
+from compose.cli.command import get_config_path_from_options, get_project
+from compose.project import NoSuchService
+
+from compose_dump.incremental import load_dump_metadata
+from compose_dump.reader import open_dump
+from compose_dump.storage import CHUNK_SIZE, iter_chunks, spool
+from compose_dump.tarstream import filter_archive
+from compose_dump.utils import get_container_for_service, get_container_with_project_volume, \
+    get_services_using_project_volume, worker_pool
+
+
+log = logging.getLogger('compose-compose_dump')
+
+
+def restore_dump(ctx):
+    ctx.project = None
+    ctx.volume_targets = {}
+    unresolved = []
+
+    with open_dump(ctx.options['source'], ctx.options.get('encryption_key_file')) as dump, Pushes(ctx) as pushes:
+        if dump.manifest is not None:
+            ctx.volume_targets.update(get_volume_targets(dump.manifest))
+
+        for member in dump:
+            restore_member(ctx, dump, member, pushes, unresolved)
+
+        if dump.manifest is None:
+            log.error('The dump contains no manifest.')
+            raise SystemExit(1)
+        ctx.volume_targets.update(get_volume_targets(dump.manifest))
+
+        # archives written by earlier versions lack metadata about their targets
+        for key, buffer in unresolved:
+            push_volume(ctx, pushes, key, lambda buffer=buffer: buffer)
+
+        if dump.manifest['meta'].get('since'):
+            restore_references(ctx, dump, pushes)
+
+
+####
+
+
+def get_restore_project(ctx):
+    if ctx.project is not None:
+        return ctx.project
+
+    base_dir = str(ctx.options['project_dir'])
+    config_path = get_config_path_from_options(
+        base_dir, {'--file': ctx.options['compose_files']}, ctx.environment)
+    ctx.project = \
+        get_project(base_dir, config_path=config_path,
+                    project_name=ctx.options['project_name'],
+                    verbose=ctx.options['verbose'], host=None, tls_config=None, environment=ctx.environment)
+
+    service_names = [x.name for x in ctx.project.services]
+    unknown_services = set(ctx.options['services']) - set(service_names)
+    if unknown_services:
+        log.error('Unknown services: %s' % ', '.join(unknown_services))
+        raise SystemExit(1)
+    if not ctx.options['services']:
+        ctx.options['services'] = tuple(service_names)
+    return ctx.project
+
+
+def create_containers(ctx, service_names):
+    log.info('Creating containers for: %s' % ', '.join(service_names))
+    ctx.project.initialize()
+    ctx.project.create(service_names=service_names)
+
+
+def get_volume_targets(manifest):
+    # maps the volume archives of a dump to metadata about their origin
+    result = {}
+    volumes = manifest.get('volumes') or {}
+    for name, archive_name in (volumes.get('project') or {}).items():
+        result['project/' + archive_name] = {'volume': name}
+    for service, index in (volumes.get('services') or {}).items():
+        for path, archive_name in index.items():
+            result['services/' + archive_name] = {'service': service, 'path': path}
+    return result
+
+
+def get_volume_destination(ctx, target):
+    # returns the id of the container and the path where a volume archive is to be extracted
+    project = get_restore_project(ctx)
+
+    if 'volume' in target:
+        name = target['volume']
+        services = get_services_using_project_volume(project, name)
+        if not set(services) & set(ctx.options['services']):
+            return None, None
+        container, path = get_container_with_project_volume(project, name)
+        if container is None:
+            create_containers(ctx, services)
+            container, path = get_container_with_project_volume(project, name)
+    else:
+        if target['service'] not in ctx.options['services']:
+            return None, None
+        try:
+            service = project.get_service(target['service'])
+        except NoSuchService:
+            log.critical('The service %s is not defined in the project.' % target['service'])
+            return None, None
+        container, path = get_container_for_service(service), target['path']
+        if container is None:
+            create_containers(ctx, [service.name])
+            container = get_container_for_service(service)
+
+    if container is None:
+        log.critical('Found no container to restore %s' % target)
+        return None, None
+    # archives contain the volume's folder, hence they're extracted into its parent
+    return container.id, posixpath.dirname(path.rstrip('/')) or '/'
+
+
+####
+
+
+def restore_member(ctx, dump, member, pushes, unresolved):
+    parts = member.path.parts
+    scopes = ctx.options['scopes']
+    project_dir = ctx.options['project_dir']
+
+    if parts[0] == 'config' and len(parts) > 1:
+        if 'config' in scopes:
+            extract_member(member, get_member_destination(project_dir, '/'.join(parts[1:])))
+    elif parts[:2] == ('volumes', 'mounted') and len(parts) > 2:
+        if 'mounted' in scopes:
+            extract_member(member, get_member_destination(project_dir, '/'.join(parts[2:])))
+    elif parts[:2] in (('volumes', 'project'), ('volumes', 'services')) and len(parts) == 3 and \
+            member.type == 'file':
+        if 'volumes' not in scopes:
+            return
+        key = '/'.join(parts[1:])
+        if member.metadata:
+            ctx.volume_targets[key] = member.metadata
+        if key in ctx.volume_targets:
+            push_volume(ctx, pushes, key, member.open, dump.random_access)
+        else:
+            unresolved.append((key, spool(iter_chunks(member.open()))[0]))
+
+
+def get_member_destination(project_dir, name):
+    # returns the path below project_dir where a dumped file is to be restored and creates its missing parent
+    # folders. Like tarfile's data filter, names that are absolute or contain .. and paths that lead through
+    # a symbolic link or beyond the project's folder are refused with None.
+    parts = PurePosixPath(name).parts
+    if not parts or PurePosixPath(name).is_absolute() or '..' in parts:
+        log.warning('Skipping %s, its name leaves the project folder.' % name)
+        return None
+
+    base = Path(project_dir).resolve()
+    parent = base
+    for part in parts[:-1]:
+        parent = parent / part
+        try:
+            mode = os.lstat(str(parent)).st_mode
+        except FileNotFoundError:
+            parent.mkdir()
+            continue
+        if not stat.S_ISDIR(mode):
+            log.warning('Skipping %s, %s is not a folder.' % (name, parent))
+            return None
+
+    path = parent / parts[-1]
+    if os.path.commonpath([str(base), str(path.parent.resolve())]) != str(base):
+        log.warning('Skipping %s, its destination leaves the project folder.' % name)
+        return None
+    return path
+
+
+def extract_member(member, path):
+    if path is None:
+        return
+    log.debug('Restoring %s' % path)
+    if not clear_destination(path, member.type == 'dir'):
+        return
+
+    if member.type == 'dir':
+        path.mkdir(exist_ok=True)
+        return
+
+    if member.type == 'symlink':
+        os.symlink(member.linkname, str(path))
+    elif member.type == 'file':
+        # the file is created anew, a link that's placed there meanwhile isn't followed
+        fd = os.open(str(path), os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+        with member.open() as src, os.fdopen(fd, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            dst.flush()
+            os.fchmod(dst.fileno(), member.mode)
+            os.utime(dst.fileno(), (member.mtime, member.mtime))
+    else:
+        log.warning('Skipping unsupported file type of %s' % member.name)
+
+
+def clear_destination(path, directory=False):
+    # removes a symbolic link or another file that is in the place of a restored member, so links are replaced
+    # and never written through. A directory in the place of a member that isn't one is kept and the member
+    # is skipped, False is returned then.
+    if path.is_symlink() or (path.exists() and not path.is_dir()):
+        path.unlink()
+    elif not directory and path.is_dir():
+        log.warning('Skipping %s, a directory is in its place.' % path)
+        return False
+    return True
+
+
+def push_volume(ctx, pushes, key, source, random_access=True):
+    container_id, path = get_volume_destination(ctx, ctx.volume_targets[key])
+    if container_id is None:
+        return
+    log.info('Restoring volume archive %s' % key)
+    pushes.submit(container_id, path, source, random_access)
+
+
+class Pushes:
+    # Extracts volume archives into containers with up to ctx.options['jobs'] threads. Sources are callables
+    # that return the data. Sources of dumps without random access must be read before the dump's
+    # iteration proceeds, they're spooled when the archive is pushed concurrently.
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.jobs = ctx.options.get('jobs', 1)
+        self.pending = deque()
+        self.executor = worker_pool(self.jobs) if self.jobs > 1 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                while self.pending:
+                    self.pending.popleft().result()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+
+    def submit(self, container_id, path, source, random_access=True):
+        if self.executor is None:
+            self._put(container_id, path, source)
+            return
+        if not random_access:
+            buffer = spool(iter_chunks(source()))[0]
+            source = lambda: buffer  # noqa: E731
+        while len(self.pending) >= 2 * self.jobs:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(self._put, container_id, path, source))
+
+    def _put(self, container_id, path, source):
+        data = source()
+        try:
+            self.ctx.project.client.put_archive(container_id, path, iter_chunks(data))
+        finally:
+            if hasattr(data, 'close'):
+                data.close()
+
+
+####
+
+
+def restore_references(ctx, dump, pushes):
+    # restores the contents of an incremental dump that are stored in the dumps it refers to
+    inventory = dump.inventory
+    if inventory is None:
+        log.error('The dump refers to a previous dump, but has no inventory.')
+        raise SystemExit(1)
+
+    chain = []
+    since = dump.manifest['meta']['since']
+    while since:
+        path = Path(since['path'])
+        manifest, previous_inventory = load_dump_metadata(path, ctx.options.get('encryption_key_file'))
+        if previous_inventory is None:
+            log.error('The referenced dump %s has no inventory.' % path)
+            raise SystemExit(1)
+        chain.append((path, previous_inventory))
+        since = manifest['meta'].get('since')
+
+    project_dir = ctx.options['project_dir']
+    wanted = [(set(), defaultdict(set)) for _ in chain]
+
+    for name, entry in inventory['mounted'].items():
+        if entry['type'] == 'dir' and 'mounted' in ctx.options['scopes']:
+            path = get_member_destination(project_dir, name)
+            if path is not None and clear_destination(path, directory=True):
+                path.mkdir(exist_ok=True)
+        elif entry['type'] == 'symlink' and 'mounted' in ctx.options['scopes']:
+            path = get_member_destination(project_dir, name)
+            if path is not None and clear_destination(path):
+                os.symlink(entry['linkname'], str(path))
+        elif entry['type'] == 'file' and not entry['stored']:
+            index = locate_entry(chain, name)
+            if index is None:
+                log.error('The content of %s is not found in any referenced dump.' % name)
+            else:
+                wanted[index][0].add(name)
+
+    for key, members in inventory['volumes'].items():
+        for name, entry in members.items():
+            if entry['type'] == 'file' and not entry['stored']:
+                index = locate_entry(chain, name, key)
+                if index is None:
+                    log.error('The content of %s in %s is not found in any referenced dump.' % (name, key))
+                else:
+                    wanted[index][1][key].add(name)
+
+    for (path, _), (mounted, volumes) in zip(chain, wanted):
+        if not mounted and not volumes:
+            continue
+        log.info('Restoring contents from %s' % path)
+        with open_dump(path, ctx.options.get('encryption_key_file')) as base:
+            for member in base:
+                parts = member.path.parts
+                key = '/'.join(parts[1:])
+                if parts[:2] == ('volumes', 'mounted') and '/'.join(parts[2:]) in mounted:
+                    if 'mounted' in ctx.options['scopes']:
+                        extract_member(member, get_member_destination(project_dir, '/'.join(parts[2:])))
+                elif parts[0] == 'volumes' and key in volumes and key in ctx.volume_targets:
+                    if 'volumes' in ctx.options['scopes']:
+                        source = lambda m=member, n=volumes[key]: filter_archive(iter_chunks(m.open()), n)  # noqa
+                        push_volume(ctx, pushes, key, source, base.random_access)
+
+
+def locate_entry(chain, name, key=None):
+    # returns the index of the dump in the chain that stores an entry's content
+    for index, (path, inventory) in enumerate(chain):
+        if key is None:
+            entry = inventory['mounted'].get(name)
+        else:
+            entry = inventory['volumes'].get(key, {}).get(name)
+        if entry is None:
+            return None
+        if entry.get('stored', True):
+            return index
+    return None
@@ -0,0 +1,127 @@
+import abc
+from itertools import count
+import logging
+import os
+from pathlib import Path
+import shlex
+from shutil import rmtree
+from subprocess import PIPE, run
+
+
+SNAPSHOT_MODES = ('btrfs', 'command', 'reflink', 'zfs')
+
+
+log = logging.getLogger('compose-compose_dump')
+
+# numbers the snapshots of all dumps of a batch
+snapshot_numbers = count(1)
+
+
+def run_command(args, check=True):
+    # returns the command's output, a failure ends the program if check is set and is logged otherwise
+    process = run(args, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    if process.returncode:
+        message = '%s failed: %s' % (' '.join(args), process.stderr.strip())
+        if check:
+            log.error(message)
+            raise SystemExit(1)
+        log.warning(message)
+    return process.stdout
+
+
+class SnapshotterBase(abc.ABC):
+    # Takes cheap snapshots of folders so that these can be stored while the services that use them run.
+    # take returns the path of a folder with the snapshot's contents, release removes the snapshot.
+
+    def __init__(self, ctx):
+        self.prefix = 'compose-dump-snapshot-%i-' % os.getpid()
+
+    def _name(self):
+        return self.prefix + str(next(snapshot_numbers))
+
+    def _sibling(self, path):
+        # a hidden path next to path for a snapshot on the same filesystem
+        return path.parent / ('.%s-%s' % (self._name(), path.name))
+
+    @abc.abstractmethod
+    def take(self, path):
+        pass
+
+    @abc.abstractmethod
+    def release(self, path, snapshot):
+        pass
+
+
+class BtrfsSnapshotter(SnapshotterBase):
+    # path must be a btrfs subvolume, a read-only snapshot is created next to it
+
+    def take(self, path):
+        snapshot = self._sibling(path)
+        run_command(['btrfs', 'subvolume', 'snapshot', '-r', str(path), str(snapshot)])
+        return snapshot
+
+    def release(self, path, snapshot):
+        run_command(['btrfs', 'subvolume', 'delete', str(snapshot)], check=False)
+
+
+class CommandSnapshotter(SnapshotterBase):
+    # A user supplied command is called with the arguments 'create PATH' and must print the path of a
+    # folder with the snapshot's contents as last line of its output. It's called with
+    # 'release PATH SNAPSHOT' when the snapshot has been stored. This allows snapshots of LVM volumes and
+    # other facilities.
+
+    def __init__(self, ctx):
+        super().__init__(ctx)
+        self.command = shlex.split(ctx.options['fs_snapshot_command'])
+
+    def take(self, path):
+        lines = run_command(self.command + ['create', str(path)]).strip().splitlines()
+        if not lines or not Path(lines[-1]).is_dir():
+            log.error('The snapshot command printed no folder for %s.' % path)
+            raise SystemExit(1)
+        return Path(lines[-1])
+
+    def release(self, path, snapshot):
+        run_command(self.command + ['release', str(path), str(snapshot)], check=False)
+
+
+class ReflinkSnapshotter(SnapshotterBase):
+    # a copy-on-write copy of the folder next to it, requires a filesystem with reflinks like Btrfs or XFS
+
+    def take(self, path):
+        snapshot = self._sibling(path)
+        run_command(['cp', '--archive', '--reflink=always', str(path), str(snapshot)])
+        return snapshot
+
+    def release(self, path, snapshot):
+        rmtree(str(snapshot), ignore_errors=True)
+
+
+class ZfsSnapshotter(SnapshotterBase):
+    # a snapshot of the dataset that contains the path, it's read from the dataset's .zfs folder
+
+    def __init__(self, ctx):
+        super().__init__(ctx)
+        # maps the snapshots' folders to the snapshots' names
+        self.names = {}
+
+    def take(self, path):
+        dataset, mountpoint = run_command(['zfs', 'list', '-H', '-o', 'name,mountpoint', str(path)]) \
+            .strip().split('\t')
+        name = self._name()
+        run_command(['zfs', 'snapshot', '%s@%s' % (dataset, name)])
+        snapshot = Path(mountpoint) / '.zfs' / 'snapshot' / name / path.relative_to(mountpoint)
+        self.names[snapshot] = '%s@%s' % (dataset, name)
+        return snapshot
+
+    def release(self, path, snapshot):
+        run_command(['zfs', 'destroy', self.names.pop(snapshot)], check=False)
+
+
+SNAPSHOTTERS = {'btrfs': BtrfsSnapshotter, 'command': CommandSnapshotter, 'reflink': ReflinkSnapshotter,
+                'zfs': ZfsSnapshotter}
+
+
+def init_snapshotter(ctx):
+    mode = ctx.options.get('fs_snapshots')
+    ctx.snapshotter = None if mode is None else SNAPSHOTTERS[mode](ctx)
@@ -1,26 +1,88 @@
 import abc
+from contextlib import contextmanager
 from functools import wraps
 import io
+import json
 import logging
 import os
-from pathlib import Path
+from pathlib import Path, PurePath
 import shutil
+import stat
 import sys
 import tarfile
-import types
+from tempfile import SpooledTemporaryFile
+from threading import Lock
 from time import time
 
+from compose_dump.checksums import Checksum, HashingReader
+from compose_dump.chunks import ChunkRepository, split_chunks
+from compose_dump.encryption import EncryptingWriter, read_secret
+from compose_dump.objectstore import MIN_UPLOAD_PART_SIZE, MultipartUpload, parse_s3_url, S3Client, \
+    UPLOAD_PART_SIZE, UPLOAD_THREADS
+from compose_dump.streams import BackgroundWriter, BlockCompressor, FILE_EXTENSIONS, get_compressor, SplitWriter
+from compose_dump.metrics import format_size
+from compose_dump.treewalk import READAHEAD_MAX_SIZE, clone_file, make_tarinfo, open_scanned, ordered_map, \
+    read_small_file, reflink_file, scan_tree
 from compose_dump.utils import hash_string
 
-log = logging.getLogger('compose-compose_dump')
-
-
-def copy(src, dst, *args, **kwargs):
-    shutil.copy2(str(src), str(dst), *args, **kwargs)
+try:
+    import grp
+    import pwd
+except ImportError:
+    grp = pwd = None
 
+log = logging.getLogger('compose-compose_dump')
 
-def copytree(src, dst, *args, **kwargs):
-    shutil.copytree(str(src), str(dst), *args, **kwargs)
+# data that is written to an archive is kept in memory up to this size, beyond it's spooled to a temporary file
+SPOOL_MAX_SIZE = 16 * 1024 ** 2
+CHUNK_SIZE = 64 * 1024
+# members of folders that are added to an archive are collected up to this size before they're written
+ARCHIVE_BATCH_SIZE = 1024 ** 2
+# metadata of members in archives is stored as pax headers with this prefix
+PAX_PREFIX = 'COMPOSE_DUMP.'
+# the state of a split archive that is being written is recorded next to it in a file with this suffix
+CHECKPOINT_SUFFIX = '.checkpoint'
+
+
+def iter_chunks(data):
+    # data can be a string, bytes, a readable file object, an iterable of chunks or a callable that returns one
+    if isinstance(data, str):
+        data = data.encode()
+    if isinstance(data, bytes):
+        yield data
+        return
+    if hasattr(data, 'read'):
+        while True:
+            chunk = data.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        return
+    if callable(data):  # TODO: obsolete with docker-compose>1.19.0 (e.g. docker-py>=3.0.0)
+        data = data()
+    yield from data
+
+
+def spool(data):
+    # returns a readable file object with the contents of data and its size, streamed data is spooled
+    # to a temporary file beyond SPOOL_MAX_SIZE so that memory consumption doesn't grow with its size
+    if isinstance(data, str):
+        data = data.encode()
+    if isinstance(data, bytes):
+        return io.BytesIO(data), len(data)
+    if hasattr(data, 'read') and hasattr(data, 'seek'):
+        data.seek(0, io.SEEK_END)
+        size = data.tell()
+        data.seek(0)
+        return data, size
+
+    size = 0
+    buffer = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    for chunk in iter_chunks(data):
+        size += len(chunk)
+        buffer.write(chunk)
+    buffer.seek(0)
+    return buffer, size
 
 
 def ensure_path_type(method):
@@ -37,15 +99,77 @@ def ensure_path_type(method):
 def expand_dst(method):
     @wraps(method)
     def wrapper(self, src, dst, **kwargs):
-        namespace = kwargs.get('namespace', '.')
-        ancestors = self.root_path
-        for part in namespace.split('/'):
-            ancestors /= part
-        method(self, src, ancestors / dst, **kwargs)
+        method(self, src, expand_path(self.root_path, dst, kwargs.get('namespace', '.')), **kwargs)
     return wrapper
 
 
+def expand_path(root_path, dst, namespace):
+    for part in namespace.split('/'):
+        root_path /= part
+    return root_path / dst
+
+
+def find_checkpoint(folder, project_name):
+    # returns the path and state of the latest interrupted split archive of a project in a folder or None
+    candidates = []
+    for path in Path(folder).glob('*' + CHECKPOINT_SUFFIX):
+        with path.open('rt') as f:
+            state = json.load(f)
+        if state['project_name'] == project_name:
+            candidates.append((path.stat().st_mtime, path, state))
+    if not candidates:
+        return None
+    return max(candidates, key=lambda x: x[0])[1:]
+
+
+class CountingWriter:
+    # a writable file object that passes all data to fileobj and its size to counter
+
+    def __init__(self, fileobj, counter):
+        self.fileobj = fileobj
+        self.counter = counter
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.counter(len(data))
+        return len(data)
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def flush(self):
+        self.fileobj.flush()
+
+
 class StorageAdapterBase(abc.ABC):
+    # whether write_file may be called concurrently from different threads
+    thread_safe = False
+
+    def __init__(self, ctx):
+        self.metrics = getattr(ctx, 'metrics', None)
+        # maps the paths of all stored regular files to the digests and sizes of their contents,
+        # these are computed while the data passes through
+        self.checksums = {}
+        self.checksums_lock = Lock()
+
+    def _count(self, read=0, written=0):
+        if self.metrics is not None:
+            self.metrics.count(read, written)
+
+    def _count_read(self, size):
+        self._count(read=size)
+
+    def _count_copied(self, size):
+        self._count(read=size, written=size)
+
+    def _record_checksum(self, dst, checksum):
+        # checksum is a Checksum or a mapping like the one that its as_dict method returns
+        name = PurePath(dst).relative_to(self.root_path).as_posix()
+        if isinstance(checksum, Checksum):
+            checksum = checksum.as_dict()
+        with self.checksums_lock:
+            self.checksums[name] = checksum
+
     @staticmethod
     def _make_name(ctx):
         isodate = ctx.manifest['meta']['invocation_time']
@@ -61,94 +185,401 @@ class StorageAdapterBase(abc.ABC):
     def finalize(self):
         pass
 
+    def abort(self):
+        # is called instead of finalize when a dump fails, what has been stored is left as it is
+        pass
+
+    def is_stored(self, dst, namespace='.'):
+        # whether dst was already stored by an interrupted run that this one resumes
+        return False
+
     @abc.abstractmethod
     def put_file(self, src, dst, namespace='.', follow_symlinks=True):
         pass
 
     @abc.abstractmethod
-    def put_folder(self, src, dst, namespace='.'):
+    def put_folder(self, src, dst, namespace='.', exclusions=None):
+        # exclusions is an Exclusions instance for paths below src that are not stored
         pass
 
     @abc.abstractmethod
-    def write_file(self, dst, data, namespace='.'):
+    def write_file(self, data, dst, namespace='.', metadata=None):
+        # metadata is a mapping of strings that is stored along with the data if the storage supports it
         pass
 
 
 class ArchiveStorage(StorageAdapterBase):
+    # An archive is written by a pipeline of stages that run concurrently: tarfile writes the members into
+    # a BlockCompressor whose threads compress the data, which is then encrypted optionally and handed to a
+    # BackgroundWriter that writes it to the output. The stages are connected by bounded buffers, so the
+    # slowest one sets the pace.
+    # With the split_size option the archive is written in parts of that size. A checkpoint file next to
+    # them then records the files and folders that were stored completely along with the position after them
+    # and is removed when the archive is finalized. With the resume option, the writing of an interrupted
+    # archive continues from its checkpoint and what it records as stored is skipped.
+
     def __init__(self, ctx):
-        target = ctx.options['target']
+        super().__init__(ctx)
         compression = ctx.options['compression']
-        if target is None:
-            mode = 'w|'
-            fileobj = sys.stdout.buffer
-        else:
-            mode = 'w:'
-            fileobj = None
-            if target.is_dir():
-                name = self._make_name(ctx) + '.tar'
-                if compression != 'tar':
-                    name += '.' + compression
-                target /= name
-            target = str(target)
+        level = ctx.options.get('compression_level')
+        threads = ctx.options.get('compression_threads', 1)
+        key_file = ctx.options.get('encryption_key_file')
+        self.stream = self.encryptor = self.checkpoint_path = None
+        # the names of the files and folders that were stored by calls of put_file, put_folder and write_file
+        self.stored = set()
+        self.output, path, state = self._open_output(ctx)
+        self._identify_output(path)
+        self.writer = BackgroundWriter(self.output)
+        fileobj = CountingWriter(self.writer, lambda size: self._count(written=size))
+        if key_file is not None:
+            # the compressed data is encrypted on its way to the output
+            self.encryptor = fileobj = EncryptingWriter(
+                fileobj, read_secret(key_file), None if state is None else state['encryption'])
         if compression != 'tar':
-            mode += compression
-
-        self.archive = tarfile.open(target, mode, fileobj)
+            # tarfile writes an uncompressed archive into the compressor, which can also end a compression
+            # stream at a checkpoint
+            self.stream = BlockCompressor(fileobj, get_compressor(compression, level), threads)
+            self.archive = tarfile.open(mode='w', fileobj=self.stream, format=tarfile.PAX_FORMAT)
+        else:
+            mode = 'w|' if path is None else 'w:'
+            name = None if path is None or self.checkpoint_path is not None else str(path)
+            self.archive = tarfile.open(name, mode, fileobj, format=tarfile.PAX_FORMAT)
+        if state is not None:
+            self.archive.offset = state['offset']
+            if self.stream is not None:
+                self.stream.position = state['offset']
+            self.stored.update(state['stored'])
+            self.checksums.update(state['checksums'])
         self.root_path = Path('.')
+        self.owner_names = {}
+
+    def _open_output(self, ctx):
+        # returns a writable file object for the archive, the archive's path unless it's a stream and the
+        # state of an interrupted split archive to resume or None
+        target = ctx.options['target']
+        split_size = ctx.options.get('split_size')
+        if split_size is not None:
+            target, state = self._find_checkpoint(ctx, target)
+            self.checkpoint_path = target.with_name(target.name + CHECKPOINT_SUFFIX)
+            self.checkpoint_state = {'project_name': ctx.options['project_name'], 'name': target.name,
+                                     'compression': ctx.options['compression'], 'split_size': split_size,
+                                     'encrypted': ctx.options.get('encryption_key_file') is not None}
+            return SplitWriter(target, split_size, None if state is None else state['position']), target, state
+        if target is None:
+            return sys.stdout.buffer, None, None
+        if target.is_dir():
+            target /= self._make_name(ctx) + self._extension(ctx.options['compression'])
+        return target.open('wb'), target, None
+
+    @staticmethod
+    def _extension(compression):
+        return '.tar' if compression == 'tar' else '.tar' + FILE_EXTENSIONS[compression]
+
+    def _identify_output(self, path):
+        # records what identifies the archive's own files, so these aren't added to it when the target is in
+        # a stored folder: the inode of the output file, also if it's stdout, and the path with the names of
+        # the parts and the checkpoint of a split archive
+        try:
+            stat_result = os.fstat(self.output.fileno())
+        except (AttributeError, OSError, ValueError):
+            stat_result = None
+        self.output_inode = None if stat_result is None or not stat.S_ISREG(stat_result.st_mode) \
+            else (stat_result.st_dev, stat_result.st_ino)
+        self.output_path = None if path is None else Path(os.path.realpath(str(path)))
+
+    def _is_own_file(self, path, stat_result):
+        if (stat_result.st_dev, stat_result.st_ino) == self.output_inode:
+            return True
+        if self.output_path is None:
+            return False
+        name, suffix = self.output_path.name, path.name[len(self.output_path.name):]
+        if not path.name.startswith(name) or \
+                not (suffix in ('', CHECKPOINT_SUFFIX, CHECKPOINT_SUFFIX + '.tmp') or
+                     suffix[:1] == '.' and suffix[1:].isdigit()):
+            return False
+        return os.path.realpath(str(path.parent)) == str(self.output_path.parent)
+
+    def _find_checkpoint(self, ctx, target):
+        # returns the path of a split archive and the state to resume its writing from or None
+        options = ctx.options
+        if target.is_dir():
+            checkpoint = find_checkpoint(target, options['project_name']) if options.get('resume') else None
+            if checkpoint is None:
+                return target / (self._make_name(ctx) + self._extension(options['compression'])), None
+            path, state = checkpoint
+            target /= state['name']
+        else:
+            path = target.with_name(target.name + CHECKPOINT_SUFFIX)
+            if not options.get('resume') or not path.is_file():
+                return target, None
+            with path.open('rt') as f:
+                state = json.load(f)
+
+        if (state['compression'], state['split_size'], state['encrypted']) != \
+                (options['compression'], options['split_size'], options.get('encryption_key_file') is not None):
+            log.error('The interrupted dump %s was written with --compression %s and --split-size %i and is%s '
+                      'encrypted.' % (target, state['compression'], state['split_size'],
+                                      '' if state['encrypted'] else ' not'))
+            raise SystemExit(1)
+        log.info('Resuming the interrupted dump %s after %i stored files and folders.' %
+                 (target, len(state['stored'])))
+        return target, state
+
+    def flush(self):
+        # writes all data that was added so far, including what the compressor and the encryptor hold back.
+        # This ends the current compression stream, so the data so far can be decompressed on its own.
+        if self.stream is not None:
+            self.stream.flush()
+        if self.encryptor is not None:
+            self.encryptor.flush()
+        self.writer.flush()
+
+    def checkpoint(self):
+        # makes all data that was added so far durable and records the state to resume from
+        self.flush()
+        self.output.sync()
+        state = dict(self.checkpoint_state, position=(self.output.index, self.output.part_position),
+                     offset=self.archive.offset, stored=sorted(self.stored), checksums=self.checksums,
+                     encryption=None if self.encryptor is None else self.encryptor.state())
+        temporary = self.checkpoint_path.with_name(self.checkpoint_path.name + '.tmp')
+        with temporary.open('wt') as f:
+            json.dump(state, f)
+        os.replace(str(temporary), str(self.checkpoint_path))
 
     def finalize(self):
+        self._close_archive()
+        if self.output is sys.stdout.buffer:
+            self.output.flush()
+        elif self.checkpoint_path is not None:
+            self.output.sync()
+            self.output.close()
+            if self.checkpoint_path.exists():
+                self.checkpoint_path.unlink()
+        else:
+            self.output.close()
+
+    def abort(self):
+        # the threads are ended and the output is closed without completing the archive. A split archive can be
+        # resumed from its last checkpoint, an upload is aborted when it's closed incomplete.
+        try:
+            self.writer.close()
+        except Exception as e:
+            log.debug('Failed to write the data of the aborted dump: %s' % e)
+        finally:
+            if self.stream is not None:
+                self.stream.executor.shutdown()
+            if self.output is not sys.stdout.buffer:
+                self.output.close()
+
+    def _close_archive(self):
         self.archive.close()
+        if self.stream is not None:
+            self.stream.close()
+        if self.encryptor is not None:
+            self.encryptor.close()
+        self.writer.close()
+
+    def is_stored(self, dst, namespace='.'):
+        return str(expand_path(self.root_path, dst, namespace)) in self.stored
+
+    def _stored(self, dst, checkpoint):
+        # records a stored file or folder, the checkpoint is written after volumes and other larger data
+        self.stored.add(str(dst))
+        if checkpoint and self.checkpoint_path is not None:
+            self.checkpoint()
 
     @ensure_path_type
     @expand_dst
     def put_file(self, src, dst, namespace='.', follow_symlinks=True):
         dst /= src.name
+        if str(dst) in self.stored:
+            return
         if follow_symlinks:
             src = src.resolve()
-        self.archive.add(str(src), str(dst))
+        self._add_entries(((src, dst, os.lstat(str(src))),), threads=1)
+        self._stored(dst, checkpoint=False)
 
+    @ensure_path_type
     @expand_dst
-    def put_folder(self, src, dst, namespace='.'):
-        self.archive.add(str(src), str(dst))
+    def put_folder(self, src, dst, namespace='.', exclusions=None):
+        if str(dst) in self.stored:
+            return
+        self._add_entries(scan_tree(src, dst, exclusions=exclusions))
+        self._stored(dst, checkpoint=True)
+
+    def _add_entries(self, entries, threads=None):
+        # like TarFile.add for the paths, names and stat results in entries, but the contents of small files
+        # are read ahead by a pool of threads and the members are written in batches without being recorded
+        # in the archive's list of members, the contents of regular files are hashed while they're added
+        archive = self.archive
+        batch = bytearray()
+        results = ordered_map(read_small_file, entries) if threads is None \
+            else ordered_map(read_small_file, entries, threads)
+        for (path, name, stat_result), data in results:
+            if self._is_own_file(path, stat_result):
+                continue
+            tarinfo = self._make_tarinfo(path, name, stat_result)
+            if tarinfo is None:
+                log.warning('Skipping unsupported file type of %s' % path)
+                continue
+            if not tarinfo.isreg():
+                batch += tarinfo.tobuf(archive.format, archive.encoding, archive.errors)
+                continue
+
+            checksum = Checksum(self._count_read)
+            if data is not None:
+                # the file may have changed since it was scanned
+                tarinfo.size = len(data)
+                checksum.update(data)
+                batch += tarinfo.tobuf(archive.format, archive.encoding, archive.errors)
+                batch += data + self._padding(tarinfo.size)
+            else:
+                # the file is opened before its header is written, so a replaced file is skipped entirely
+                f = open_scanned(path, stat_result)
+                if f is None:
+                    log.warning('Skipping %s, it was replaced while it was read.' % path)
+                    continue
+                batch += tarinfo.tobuf(archive.format, archive.encoding, archive.errors)
+                self._write_batch(batch)
+                batch = bytearray()
+                with f:
+                    self._copy_content(f, path, checksum, tarinfo.size)
+            self._record_checksum(name, checksum)
+            if len(batch) >= ARCHIVE_BATCH_SIZE:
+                self._write_batch(batch)
+                batch = bytearray()
+        self._write_batch(batch)
+
+    def _copy_content(self, f, path, checksum, size):
+        # writes the content of a member with the size that its header states from an opened file to the
+        # archive, padded to a full block. Like tarstream's archive_tree, a truncated file is padded with zeros.
+        # So is the rest of a file that fails to be read before the error is raised again, hence the members
+        # that follow are intact, e.g. the other projects' in a combined archive.
+        fileobj = self.archive.fileobj
+        written, truncated = 0, False
+        try:
+            while written < size:
+                chunk = b'' if truncated else f.read(min(size - written, CHUNK_SIZE))
+                if not chunk:
+                    if not truncated:
+                        log.warning('%s was truncated while it was read, the missing data is stored as zeros.' % path)
+                        truncated = True
+                    chunk = bytes(min(size - written, CHUNK_SIZE))
+                checksum.update(chunk)
+                fileobj.write(chunk)
+                written += len(chunk)
+        except OSError:
+            log.error('Failed to read %s, the rest of its member is stored as zeros.' % path)
+            while written < size:
+                chunk = bytes(min(size - written, CHUNK_SIZE))
+                fileobj.write(chunk)
+                written += len(chunk)
+            raise
+        finally:
+            padding = self._padding(size)
+            fileobj.write(padding)
+            self.archive.offset += size + len(padding)
+
+    def _write_batch(self, batch):
+        if batch:
+            self.archive.fileobj.write(batch)
+            self.archive.offset += len(batch)
+
+    @staticmethod
+    def _padding(size):
+        remainder = size % tarfile.BLOCKSIZE
+        return bytes(tarfile.BLOCKSIZE - remainder) if remainder else b''
+
+    def _make_tarinfo(self, path, name, stat_result):
+        # like make_tarinfo, with cached names of owners
+        tarinfo = make_tarinfo(path, name, stat_result, self.archive.inodes)
+        if tarinfo is not None:
+            tarinfo.uname, tarinfo.gname = self._owner_names(stat_result.st_uid, stat_result.st_gid)
+        return tarinfo
+
+    def _owner_names(self, uid, gid):
+        key = (uid, gid)
+        if key not in self.owner_names:
+            uname = gname = ''
+            if pwd is not None:
+                try:
+                    uname = pwd.getpwuid(uid)[0]
+                except KeyError:
+                    pass
+                try:
+                    gname = grp.getgrgid(gid)[0]
+                except KeyError:
+                    pass
+            self.owner_names[key] = uname, gname
+        return self.owner_names[key]
 
     @expand_dst
-    def write_file(self, data, dst, namespace='.'):
-        if isinstance(data, str):
-            data = data.encode()
-        if isinstance(data, bytes):
-            size = len(data)
-            buffer = io.BytesIO(data)
-        elif callable(data):  # TODO: obsolete with docker-compose>1.19.0 (e.g. docker-py>=3.0.0)
-            size = 0
-            buffer = io.BytesIO()
-            for chunk in data():
-                size += len(chunk)
-                buffer.write(chunk)
-            buffer.seek(0)
-        elif isinstance(data, types.GeneratorType):
-            size = 0
-            buffer = io.BytesIO()
-            for chunk in data:
-                size += len(chunk)
-                buffer.write(chunk)
-            buffer.seek(0)
-
-        tarinfo = tarfile.TarInfo(str(dst))
-        tarinfo.size = size
-        tarinfo.mtime = time()
-        tarinfo.mode = 440
-        tarinfo.uid = os.getuid()
-        tarinfo.gid = os.getgid()
-        self.archive.addfile(tarinfo, buffer)
+    def write_file(self, data, dst, namespace='.', metadata=None):
+        # a tar member's header includes its size, so streamed data must be spooled before it's added
+        if str(dst) in self.stored:
+            return
+        buffer, size = spool(data)
+        with buffer:
+            tarinfo = tarfile.TarInfo(str(dst))
+            if metadata:
+                tarinfo.pax_headers = {PAX_PREFIX + k: str(v) for k, v in metadata.items()}
+            tarinfo.size = size
+            tarinfo.mtime = time()
+            tarinfo.mode = 440
+            tarinfo.uid = os.getuid()
+            tarinfo.gid = os.getgid()
+            checksum = Checksum(self._count_read)
+            self.archive.addfile(tarinfo, HashingReader(buffer, checksum))
+        self._record_checksum(dst, checksum)
+        self._stored(dst, checkpoint=True)
+
+
+class S3Storage(ArchiveStorage):
+    # Uploads the archive to an S3 compatible object store, the target is an s3://bucket/key URL. A key
+    # without an archive's file extension is a prefix that the name per target pattern is appended to.
+
+    def _open_output(self, ctx):
+        options = ctx.options
+        bucket, key = parse_s3_url(options['target'])
+        if not key.endswith(('.tar',) + tuple(FILE_EXTENSIONS.values())):
+            key = (key + '/' if key else '') + self._make_name(ctx) + self._extension(options['compression'])
+        part_size = options.get('upload_part_size') or UPLOAD_PART_SIZE
+        if part_size < MIN_UPLOAD_PART_SIZE:
+            log.error('The --upload-part-size must be %s at least.' % format_size(MIN_UPLOAD_PART_SIZE))
+            raise SystemExit(1)
+        client = S3Client.from_environment(options.get('s3_endpoint'))
+        log.debug('Uploading the dump to %s as %s/%s' % (client.endpoint, bucket, key))
+        upload = MultipartUpload(client, bucket, key, part_size, options.get('upload_threads') or UPLOAD_THREADS)
+        return upload, None, None
+
+    def finalize(self):
+        self._close_archive()
+        self.output.complete()
+        self.output.close()
 
 
 class FolderStorage(StorageAdapterBase):
+    # With a snapshot base (a previous dump of the project), files that are unchanged since it was made are
+    # linked to its files instead of being copied. They're reflinked where the filesystem supports it,
+    # otherwise hardlinked, so unchanged files of all such dumps share the same inode.
+    thread_safe = True
+
     def __init__(self, ctx):
+        super().__init__(ctx)
         self.target_path = ctx.options['target']
         if self.target_path.exists():
             self.target_path /= self._make_name(ctx)
             self.target_path.mkdir()
         self.root_path = self.target_path
+        self.snapshot_base = getattr(ctx, 'snapshot_base', None)
+        # whether the filesystem may support reflinks, this is unset after the first failed attempt
+        self.reflinks = True
+        self.linked_files = self.linked_bytes = 0
+
+    def finalize(self):
+        if self.snapshot_base is not None:
+            log.info('Linked %i unchanged files with %s to the previous dump.' %
+                     (self.linked_files, format_size(self.linked_bytes)))
 
     @ensure_path_type
     @expand_dst
@@ -156,33 +587,290 @@ class FolderStorage(StorageAdapterBase):
         if not dst.exists():
             dst.mkdir(parents=True)
 
-        copy(src, dst, follow_symlinks=follow_symlinks)
+        self._copy(src, dst, follow_symlinks=follow_symlinks)
 
     @ensure_path_type
     @expand_dst
-    def put_folder(self, src, dst, namespace='.'):
+    def put_folder(self, src, dst, namespace='.', exclusions=None):
+        # like copytree, the contents of symlinks are copied, the files are copied by a pool of threads
         if not dst.parent.exists():
             dst.parent.mkdir(parents=True)
-        copytree(src, dst)
+        folders = []
+
+        def files():
+            # folders are created before anything is copied into them
+            for path, name, stat_result in scan_tree(src, dst, follow_symlinks=True, exclusions=exclusions):
+                if stat.S_ISDIR(stat_result.st_mode):
+                    os.mkdir(str(name))
+                    folders.append((path, name))
+                elif stat.S_ISREG(stat_result.st_mode):
+                    yield path, name, stat_result
+                else:
+                    log.warning('Skipping unsupported file type of %s' % path)
+
+        for (path, name, stat_result), (checksum, copied) in ordered_map(self._copy_file, files()):
+            self._count_copied(copied)
+            if checksum is not None:
+                self._record_checksum(name, checksum)
+        # the folders' timestamps are set after their contents have been written
+        for path, name in reversed(folders):
+            shutil.copystat(str(path), str(name))
+
+    def _copy_file(self, item):
+        # copies a regular file with its metadata and returns its content's checksum and the number of
+        # copied bytes, large files are copied within the kernel if possible, though the copy is still read
+        # once to compute the checksum of what was copied, files that were replaced since they were scanned
+        # are skipped with None
+        path, name, stat_result = item
+        checksum = self._link_unchanged(name, stat_result)
+        if checksum is not None:
+            return checksum, 0
+
+        f_src = open_scanned(path, stat_result, follow_symlinks=True)
+        if f_src is None:
+            log.warning('Skipping %s, it was replaced while it was read.' % path)
+            return None, 0
+        checksum = Checksum()
+        with f_src, name.open('w+b') as f_dst:
+            if stat_result.st_size > READAHEAD_MAX_SIZE and \
+                    clone_file(f_src.fileno(), f_dst.fileno(), stat_result.st_size):
+                f_dst.seek(0)
+                for chunk in iter_chunks(f_dst):
+                    checksum.update(chunk)
+            else:
+                for chunk in iter_chunks(f_src):
+                    checksum.update(chunk)
+                    f_dst.write(chunk)
+        shutil.copystat(str(path), str(name))
+        return checksum, checksum.size
+
+    def _link_unchanged(self, dst, stat_result):
+        # links dst to the snapshot base's file if that has the same size, mode and modification time,
+        # returns its recorded checksum then, the content isn't read
+        base_file, recorded = self._snapshot_file(dst, stat_result.st_size)
+        if base_file is None:
+            return None
+        try:
+            base_stat = os.lstat(str(base_file))
+        except FileNotFoundError:
+            return None
+        if not stat.S_ISREG(base_stat.st_mode) or base_stat.st_size != stat_result.st_size or \
+                base_stat.st_mtime_ns != stat_result.st_mtime_ns or \
+                stat.S_IMODE(base_stat.st_mode) != stat.S_IMODE(stat_result.st_mode):
+            return None
+        if not self._link(base_file, dst, stat_result.st_size):
+            return None
+        return recorded
+
+    def _snapshot_file(self, dst, size, digest=None):
+        # returns the path of the snapshot base's file at dst's position and its recorded checksum if these
+        # match the size and digest, (None, None) otherwise
+        if self.snapshot_base is None:
+            return None, None
+        name = PurePath(dst).relative_to(self.root_path).as_posix()
+        recorded = self.snapshot_base.checksums.get(name)
+        if recorded is None or recorded['size'] != size or (digest is not None and recorded['digest'] != digest):
+            return None, None
+        return self.snapshot_base.path / name, recorded
+
+    def _link(self, base_file, dst, size):
+        # returns whether dst could be created as reflink or hardlink of base_file
+        if self.reflinks:
+            with base_file.open('rb') as f_src, dst.open('wb') as f_dst:
+                reflinked = reflink_file(f_src.fileno(), f_dst.fileno())
+            if reflinked:
+                shutil.copystat(str(base_file), str(dst))
+                self._count_linked(size)
+                return True
+            self.reflinks = False
+            dst.unlink()
+        try:
+            os.link(str(base_file), str(dst))
+        except OSError as e:
+            log.debug('Could not link %s: %s' % (base_file, e))
+            return False
+        self._count_linked(size)
+        return True
+
+    def _count_linked(self, size):
+        with self.checksums_lock:
+            self.linked_files += 1
+            self.linked_bytes += size
 
     @expand_dst
-    def write_file(self, data, dst, namespace='.'):
-        if not dst.parent.exists():
-            dst.parent.mkdir(parents=True)
+    def write_file(self, data, dst, namespace='.', metadata=None):
+        dst.parent.mkdir(parents=True, exist_ok=True)
         if isinstance(data, str):
-            with dst.open('wt') as f:
-                print(data, file=f)
-        elif isinstance(data, bytes):
-            with dst.open('wb') as f:
-                f.write(data)
-        elif callable(data):  # TODO: obsolete with docker-compose>1.19.0 (e.g. docker-py>=3.0.0)
-            with dst.open('wb') as f:
-                for chunk in data():
-                    f.write(chunk)
-        elif isinstance(data, types.GeneratorType):
-            with dst.open('wb') as f:
-                for chunk in data:
+            data += '\n'
+        checksum = Checksum(self._count_copied)
+        with dst.open('wb') as f:
+            for chunk in iter_chunks(data):
+                checksum.update(chunk)
+                f.write(chunk)
+        self._record_checksum(dst, checksum)
+
+        # written data that equals the snapshot base's file, e.g. an unchanged volume's archive, is replaced
+        # by a link to that file to save the space
+        base_file = self._snapshot_file(dst, checksum.size, checksum.as_dict()['digest'])[0]
+        if base_file is not None and base_file.is_file():
+            temporary = dst.with_name(dst.name + '.link')
+            if self._link(base_file, temporary, checksum.size):
+                os.replace(str(temporary), str(dst))
+
+    def _copy(self, src, dst, follow_symlinks=True):
+        # like shutil.copy2, but the content is hashed while it's copied
+        src, dst = Path(src), Path(dst)
+        if dst.is_dir():
+            dst /= src.name
+        if not follow_symlinks and src.is_symlink():
+            os.symlink(os.readlink(str(src)), str(dst))
+            shutil.copystat(str(src), str(dst), follow_symlinks=False)
+        else:
+            checksum, copied = self._copy_file((src, dst, os.stat(str(src))))
+            self._count_copied(copied)
+            self._record_checksum(dst, checksum)
+
+
+class ChunkStorage(StorageAdapterBase):
+    # Stores the contents of files in a repository of deduplicated chunks, a dump is represented by a
+    # folder in the repository's 'dumps' folder with an index that maps paths to chunks. Files on the
+    # dump's top level (the manifest and the inventory) are stored there as plain files.
+    INDEX_NAME = 'Index.json'
+    thread_safe = True
+
+    def __init__(self, ctx):
+        super().__init__(ctx)
+        self.repository = ChunkRepository(ctx.options['target'])
+        self.dump_path = self.repository.path / 'dumps' / self._make_name(ctx)
+        self.dump_path.mkdir(parents=True)
+        self.root_path = Path('.')
+        self.index = {}
+        self.written_bytes = 0
+        self.lock = Lock()
+        ctx.manifest['meta']['index'] = self.INDEX_NAME
+
+    def finalize(self):
+        with (self.dump_path / self.INDEX_NAME).open('wt') as f:
+            json.dump(self.index, f, sort_keys=True)
+        log.debug('Wrote %s bytes of new chunks to the repository.' % self.written_bytes)
+
+    def _put_entry(self, src, dst, stat_result=None):
+        if stat_result is None:
+            stat_result = os.lstat(str(src))
+        entry = {'mode': stat_result.st_mode & 0o7777, 'mtime': stat_result.st_mtime}
+        if stat.S_ISLNK(stat_result.st_mode):
+            entry['type'] = 'symlink'
+            entry['linkname'] = os.readlink(str(src))
+        elif stat.S_ISDIR(stat_result.st_mode):
+            entry['type'] = 'dir'
+        else:
+            f = open_scanned(src, stat_result)
+            if f is None:
+                log.warning('Skipping %s, it was replaced while it was read.' % src)
+                return
+            with f:
+                entry.update(self._put_chunks(f, dst))
+        self.index[str(dst)] = entry
+
+    def _put_chunks(self, data, dst):
+        checksum, digests = Checksum(self._count_read), []
+        for chunk in split_chunks(iter_chunks(data)):
+            digest, written = self.repository.put(chunk)
+            if written:
+                with self.lock:
+                    self.written_bytes += len(chunk)
+                self._count(written=len(chunk))
+            checksum.update(chunk)
+            digests.append(digest)
+        self._record_checksum(dst, checksum)
+        return {'type': 'file', 'size': checksum.size, 'chunks': digests}
+
+    @ensure_path_type
+    @expand_dst
+    def put_file(self, src, dst, namespace='.', follow_symlinks=True):
+        if follow_symlinks:
+            src = src.resolve()
+        self._put_entry(src, dst / src.name)
+
+    @ensure_path_type
+    @expand_dst
+    def put_folder(self, src, dst, namespace='.', exclusions=None):
+        for path, name, stat_result in scan_tree(src, dst, exclusions=exclusions):
+            self._put_entry(path, name, stat_result)
+
+    @expand_dst
+    def write_file(self, data, dst, namespace='.', metadata=None):
+        if dst.parent == self.root_path:
+            checksum = Checksum(self._count_copied)
+            with (self.dump_path / dst).open('wb') as f:
+                for chunk in iter_chunks(data):
+                    checksum.update(chunk)
                     f.write(chunk)
+            self._record_checksum(dst, checksum)
+        else:
+            entry = self.index[str(dst)] = self._put_chunks(data, dst)
+            if metadata:
+                entry['metadata'] = dict(metadata)
+
+
+class NamespacedStorage(StorageAdapterBase):
+    # Stores a dump in a folder of a storage that is shared by the dumps of a batch, e.g. one archive for
+    # all projects. The calls are serialized with ctx.shared_lock, the owner finalizes the shared storage.
+
+    def __init__(self, ctx):
+        self.metrics = getattr(ctx, 'metrics', None)
+        self.storage = ctx.shared_storage
+        self.lock = ctx.shared_lock
+        self.name = self._make_name(ctx)
+
+    def put_file(self, src, dst, namespace='.', follow_symlinks=True):
+        with self._locked():
+            self.storage.put_file(src, dst, namespace=self._namespace(namespace), follow_symlinks=follow_symlinks)
+
+    def put_folder(self, src, dst, namespace='.', exclusions=None):
+        with self._locked():
+            self.storage.put_folder(src, dst, namespace=self._namespace(namespace), exclusions=exclusions)
+
+    def write_file(self, data, dst, namespace='.', metadata=None):
+        # streamed data is read before the lock is acquired, so other dumps aren't blocked meanwhile
+        buffer = spool(data)[0]
+        with buffer, self._locked():
+            self.storage.write_file(buffer, dst, namespace=self._namespace(namespace), metadata=metadata)
+
+    def finalize(self):
+        self._detach(flush=True)
+
+    def abort(self):
+        self._detach(flush=False)
+
+    @contextmanager
+    def _locked(self):
+        # The shared storage reports to the metrics of the dump that added data last. The compressed data
+        # trails the added data, so what the storage holds back is written and reported before another dump's
+        # metrics are attached.
+        with self.lock:
+            if self.storage.metrics is not self.metrics:
+                self.storage.flush()
+                self.storage.metrics = self.metrics
+            yield
+
+    def _detach(self, flush):
+        # a dump's metrics are closed after its storage is finalized, the data that is still held back for it
+        # is reported before, unless it failed
+        with self.lock:
+            if self.storage.metrics is self.metrics:
+                if flush:
+                    self.storage.flush()
+                self.storage.metrics = None
+
+    @property
+    def checksums(self):
+        prefix = self.name + '/'
+        with self.lock:
+            return {k[len(prefix):]: v for k, v in self.storage.checksums.items() if k.startswith(prefix)}
+
+    def _namespace(self, namespace):
+        return self.name + '/' + namespace
 
 
 def init_storage(ctx):
@@ -190,3 +878,9 @@ def init_storage(ctx):
         ctx.storage = ArchiveStorage(ctx)
     elif ctx.options['target_type'] == 'folder':
         ctx.storage = FolderStorage(ctx)
+    elif ctx.options['target_type'] == 's3':
+        ctx.storage = S3Storage(ctx)
+    elif ctx.options['target_type'] == 'chunks':
+        ctx.storage = ChunkStorage(ctx)
+    elif ctx.options['target_type'] == 'shared':
+        ctx.storage = NamespacedStorage(ctx)
@@ -0,0 +1,321 @@
+import bz2
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import io
+from itertools import count
+import lzma
+import os
+import logging
+from queue import Queue
+import tarfile
+from threading import current_thread, Thread
+
+from compose_dump.encryption import DecryptingReader, ENCRYPTION_MAGIC
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# the size of the blocks that are compressed independently, each becomes a complete gzip member,
+# bzip2, xz or zstd stream and the concatenation of these is a valid stream of the according format
+COMPRESSION_BLOCK_SIZE = 4 * 1024 ** 2
+FILE_EXTENSIONS = {'bz2': '.bz2', 'gz': '.gz', 'xz': '.xz', 'zstd': '.zst'}
+BZIP2_MAGIC = b'BZh'
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# the output of an archive is written by a thread of its own from this many buffers of this size
+WRITE_BUFFER_SIZE = 1024 ** 2
+WRITE_BUFFERS = 8
+# the parts of a split archive are named like the archive with this suffix
+PART_SUFFIX = '.%03i'
+
+
+log = logging.getLogger('compose-compose_dump')
+
+
+def get_compressor(compression, level=None):
+    # returns a function that compresses a block of bytes to a self-contained stream
+    if compression == 'bz2':
+        return lambda data: bz2.compress(data, 9 if level is None else level)
+    elif compression == 'gz':
+        return lambda data: gzip.compress(data, 9 if level is None else level)
+    elif compression == 'xz':
+        return lambda data: lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+    elif compression == 'zstd':
+        return lambda data: zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    else:
+        raise ValueError('Unknown compression: %s' % compression)
+
+
+def read_archive(fileobj, secret=None):
+    # opens a possibly encrypted and compressed tar stream for sequential reading, unlike tarfile's stream
+    # mode this supports compressed data that consists of multiple streams as written by BlockCompressor,
+    # secret is the content of the key file for encrypted archives
+    if not hasattr(fileobj, 'peek'):
+        fileobj = io.BufferedReader(fileobj)
+    if fileobj.peek(len(ENCRYPTION_MAGIC)).startswith(ENCRYPTION_MAGIC):
+        if secret is None:
+            log.error('The archive is encrypted, an --encryption-key-file is required.')
+            raise SystemExit(1)
+        fileobj = io.BufferedReader(DecryptingReader(fileobj, secret))
+    magic = fileobj.peek(6)[:6]
+    if magic.startswith(GZIP_MAGIC):
+        fileobj = gzip.GzipFile(fileobj=fileobj, mode='rb')
+    elif magic.startswith(BZIP2_MAGIC):
+        fileobj = bz2.BZ2File(fileobj, mode='rb')
+    elif magic.startswith(XZ_MAGIC):
+        fileobj = lzma.LZMAFile(fileobj, mode='rb')
+    elif magic.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise tarfile.ReadError('The zstandard package is required to read zstd compressed archives.')
+        fileobj = zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+    return tarfile.open(fileobj=fileobj, mode='r|')
+
+
+def part_path(path, index):
+    return path.with_name(path.name + PART_SUFFIX % index)
+
+
+def find_parts(path):
+    # returns the paths of a split archive's parts in order, path is the archive's or its first part's
+    if path.suffix == PART_SUFFIX % 0:
+        path = path.with_suffix('')
+    parts = []
+    while part_path(path, len(parts)).is_file():
+        parts.append(part_path(path, len(parts)))
+    return parts
+
+
+class PartsReader(io.RawIOBase):
+    # a readable file object with the concatenated contents of the files at paths
+
+    def __init__(self, paths):
+        self.paths = iter(paths)
+        self.file = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            if self.file is None:
+                path = next(self.paths, None)
+                if path is None:
+                    return 0
+                self.file = path.open('rb')
+            size = self.file.readinto(buffer)
+            if size:
+                return size
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        super().close()
+
+
+class SplitWriter(io.RawIOBase):
+    # A writable file object that writes to parts of path, a new part is begun when one holds part_size bytes.
+    # position is the index of a part and an offset in it to continue from, the data beyond is discarded.
+    # Completed parts are synced to disk, sync does so with the current part.
+
+    def __init__(self, path, part_size, position=None):
+        self.path = path
+        self.part_size = part_size
+        self.index, self.part_position = position or (0, 0)
+        if position is None:
+            self.file = part_path(path, 0).open('wb')
+        else:
+            for index in count(self.index + 1):
+                if not part_path(path, index).exists():
+                    break
+                part_path(path, index).unlink()
+            self.file = part_path(path, self.index).open('r+b')
+            self.file.truncate(self.part_position)
+            self.file.seek(self.part_position)
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.index * self.part_size + self.part_position
+
+    def write(self, data):
+        data = memoryview(data)
+        written = len(data)
+        while data:
+            if self.part_position >= self.part_size:
+                self._next_part()
+            size = min(len(data), self.part_size - self.part_position)
+            self.file.write(data[:size])
+            self.part_position += size
+            data = data[size:]
+        return written
+
+    def flush(self):
+        self.file.flush()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            super().close()
+        finally:
+            self.file.close()
+
+    def _next_part(self):
+        self.sync()
+        self.file.close()
+        self.index += 1
+        self.part_position = 0
+        self.file = part_path(self.path, self.index).open('wb')
+
+
+class BlockCompressor(io.RawIOBase):
+    # A writable file object that compresses the written data in blocks of COMPRESSION_BLOCK_SIZE on a pool
+    # of threads (the compression libraries release the GIL) and writes the results in order to fileobj.
+    # The number of blocks in flight is bounded, so is the memory consumption.
+
+    def __init__(self, fileobj, compress, threads=1, block_size=COMPRESSION_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.compress = compress
+        self.threads = threads
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.position = 0
+        # the compression also runs on another thread with one thread, so it overlaps with the producer
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def flush(self):
+        # compresses and writes all buffered data, this ends a compression stream
+        if self.buffer:
+            block, self.buffer = bytes(self.buffer), bytearray()
+            self._submit(block)
+        while self.pending:
+            self._write_next()
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+            super().close()
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(self.compress, block))
+        while len(self.pending) > 2 * self.threads:
+            self._write_next()
+
+    def _write_next(self):
+        self.fileobj.write(self.pending.popleft().result())
+
+
+class BackgroundWriter(io.RawIOBase):
+    # A writable file object that passes the data to fileobj on a thread of its own, so that producing the
+    # data overlaps with writing it. The data is collected in a fixed set of reusable buffers, write blocks
+    # while all of them wait to be written. flush returns when all data was written, an error of the thread
+    # is raised by the following call. fileobj isn't closed.
+
+    def __init__(self, fileobj, buffer_size=WRITE_BUFFER_SIZE, buffers=WRITE_BUFFERS):
+        self.fileobj = fileobj
+        self.buffer_size = buffer_size
+        self.free = Queue()
+        for _ in range(buffers):
+            self.free.put(bytearray(buffer_size))
+        # the buffers that wait to be written with the sizes of their contents, None stops the thread
+        self.filled = Queue()
+        self.buffer = self.free.get()
+        self.size = 0
+        self.error = None
+        self.thread = Thread(target=self._run, name=current_thread().name + '/writer', daemon=True)
+        self.thread.start()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        self.flush()
+        return self.fileobj.tell()
+
+    def write(self, data):
+        self._check()
+        data = memoryview(data)
+        written = len(data)
+        while data:
+            size = min(len(data), self.buffer_size - self.size)
+            self.buffer[self.size:self.size + size] = data[:size]
+            self.size += size
+            data = data[size:]
+            if self.size == self.buffer_size:
+                self._hand_over()
+        return written
+
+    def flush(self):
+        if self.size:
+            self._hand_over()
+        self.filled.join()
+        self._check()
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self.filled.put((None, 0))
+            self.thread.join()
+            super().close()
+
+    def _hand_over(self):
+        self.filled.put((self.buffer, self.size))
+        self.buffer = self.free.get()
+        self.size = 0
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            buffer, size = self.filled.get()
+            try:
+                if buffer is None:
+                    return
+                # after an error the data is discarded, the buffers must still return to the producer
+                if self.error is None:
+                    self.fileobj.write(memoryview(buffer)[:size])
+            except BaseException as e:
+                self.error = e
+            finally:
+                if buffer is not None:
+                    self.free.put(buffer)
+                self.filled.task_done()
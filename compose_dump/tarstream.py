@@ -0,0 +1,305 @@
+import logging
+from pathlib import PurePosixPath
+import tarfile
+from tempfile import SpooledTemporaryFile
+
+from compose_dump.checksums import hash_object
+from compose_dump.storage import ARCHIVE_BATCH_SIZE, CHUNK_SIZE, SPOOL_MAX_SIZE
+from compose_dump.treewalk import make_tarinfo, open_scanned, ordered_map, read_small_file, scan_tree
+
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+END_OF_ARCHIVE = bytes(2 * BLOCKSIZE)
+EXTENSION_TYPES = (tarfile.XHDTYPE, tarfile.XGLTYPE, tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK)
+
+
+log = logging.getLogger('compose-compose_dump')
+
+
+def member_type(tarinfo):
+    if tarinfo.isreg():
+        return 'file'
+    elif tarinfo.isdir():
+        return 'dir'
+    elif tarinfo.issym():
+        return 'symlink'
+    elif tarinfo.islnk():
+        return 'link'
+    else:
+        return 'other'
+
+
+def normalize_member_name(name):
+    while name.startswith('./'):
+        name = name[2:]
+    return name.rstrip('/') or '.'
+
+
+def padded(size):
+    return -(-size // BLOCKSIZE) * BLOCKSIZE
+
+
+def parse_pax_records(data):
+    result = {}
+    position = 0
+    while position < len(data) and data[position]:
+        space = data.index(b' ', position)
+        length = int(data[position:space])
+        key, value = bytes(data[space + 1:position + length - 1]).split(b'=', 1)
+        result[key.decode('utf-8')] = value.decode('utf-8', 'surrogateescape')
+        position += length
+    return result
+
+
+def archive_tree(path, name):
+    # Yields a tar stream of the folder at path as chunks of bytes, the members' names begin with name like
+    # in the archives of a container's path that Docker's API returns. Small files are read ahead by a pool
+    # of threads, headers and small files are yielded in batches.
+    inodes = {}
+    batch = bytearray()
+    entries = scan_tree(path, PurePosixPath(name))
+    for (item, item_name, stat_result), data in ordered_map(read_small_file, entries):
+        tarinfo = make_tarinfo(item, item_name, stat_result, inodes)
+        if tarinfo is None:
+            log.warning('Skipping unsupported file type of %s' % item)
+            continue
+        source = None
+        if data is not None:
+            # the file may have changed since it was scanned
+            tarinfo.size = len(data)
+        elif tarinfo.isreg():
+            source = open_scanned(item, stat_result)
+            if source is None:
+                log.warning('Skipping %s, it was replaced while it was read.' % item)
+                continue
+        batch += tarinfo.tobuf(tarfile.PAX_FORMAT)
+        if data is not None:
+            batch += data + bytes(padded(tarinfo.size) - tarinfo.size)
+        elif source is not None:
+            yield bytes(batch)
+            batch = bytearray()
+            with source:
+                yield from _read_exactly(source, item, tarinfo.size)
+            batch += bytes(padded(tarinfo.size) - tarinfo.size)
+        if len(batch) >= ARCHIVE_BATCH_SIZE:
+            yield bytes(batch)
+            batch = bytearray()
+    yield bytes(batch) + END_OF_ARCHIVE
+
+
+def _read_exactly(f, path, size):
+    # yields an opened file's content, truncated or padded with zeros to the size that its header already states
+    while size:
+        chunk = f.read(min(size, ARCHIVE_BATCH_SIZE))
+        if not chunk:
+            log.warning('%s was truncated while it was read, the missing data is stored as zeros.' % path)
+            chunk = bytes(size)
+        size -= len(chunk)
+        yield chunk
+
+
+def scan_archive(chunks, members, previous=None):
+    # Scans a tar stream that is provided as iterable of bytes chunks and yields it again.
+    # An entry for each member is added to the members mapping, regular files' contents are hashed.
+    # If a mapping of a previous scan is provided, only members that differ from it are yielded,
+    # followed by an end-of-archive marker. Entries of members that are omitted are flagged with
+    # stored = False, files with unchanged size and mtime are skipped without hashing.
+    scanner = ArchiveScanner(members, previous)
+    for chunk in chunks:
+        scanner.feed(chunk)
+        if previous is None:
+            yield chunk
+        else:
+            yield from scanner.pop_output()
+    scanner.close()
+    yield from scanner.pop_output()
+
+
+class ArchiveScanner:
+    # a push parser for tar streams, see scan_archive
+
+    def __init__(self, members, previous=None):
+        self.members = members
+        self.previous = previous
+        self.filtering = previous is not None
+        self.buffer = bytearray()
+        self.output = []
+        self.state = 'header'
+        self.remaining = 0
+        self.payload = 0
+        self.extension = None
+        self.extension_data = bytearray()
+        self.extension_headers = []
+        self.overrides = {}
+        self.name = None
+        self.entry = None
+        self.hasher = None
+        self.include = True
+        self.spool = None
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        while self.buffer:
+            if self.state == 'header':
+                if len(self.buffer) < BLOCKSIZE:
+                    break
+                block = bytes(self.buffer[:BLOCKSIZE])
+                del self.buffer[:BLOCKSIZE]
+                self._process_header(block)
+            elif self.state in ('data', 'extension'):
+                data = self.buffer[:self.remaining]
+                del self.buffer[:len(data)]
+                self._process_data(bytes(data))
+            else:  # end of archive, the remaining bytes are padding
+                self.buffer.clear()
+
+    def close(self):
+        if self.state not in ('header', 'end') or self.buffer:
+            raise tarfile.ReadError('unexpected end of data')
+        if self.filtering:
+            self.output.append(END_OF_ARCHIVE)
+
+    def pop_output(self):
+        result, self.output = self.output, []
+        return result
+
+    def _emit(self, data):
+        if not self.filtering or not data:
+            return
+        if self.spool is not None:
+            self.spool.write(data)
+        elif self.include:
+            self.output.append(data)
+
+    def _process_header(self, block):
+        if block == bytes(BLOCKSIZE):
+            self.state = 'end'
+            return
+
+        tarinfo = tarfile.TarInfo.frombuf(block, 'utf-8', 'surrogateescape')
+
+        if tarinfo.type in EXTENSION_TYPES:
+            self.extension = tarinfo.type
+            if tarinfo.type == tarfile.XGLTYPE:
+                self.include = True
+                self._emit(block)
+            else:
+                self.extension_headers.append(block)
+            self._start_data('extension', tarinfo.size)
+            return
+
+        for key, value in self.overrides.items():
+            if key == 'path':
+                tarinfo.name = value
+            elif key == 'linkpath':
+                tarinfo.linkname = value
+            elif key == 'size':
+                tarinfo.size = int(value)
+            elif key == 'mtime':
+                tarinfo.mtime = float(value)
+        self.overrides = {}
+        headers, self.extension_headers = self.extension_headers, []
+        headers.append(block)
+
+        name = self.name = normalize_member_name(tarinfo.name)
+        entry = self.entry = {'type': member_type(tarinfo), 'size': tarinfo.size, 'mtime': int(tarinfo.mtime),
+                              'stored': True}
+        if entry['type'] in ('symlink', 'link'):
+            entry['linkname'] = tarinfo.linkname
+        self.members[name] = entry
+
+        size = tarinfo.size if tarinfo.isreg() or tarinfo.type not in tarfile.SUPPORTED_TYPES else 0
+        self._decide(name, entry)
+
+        for header in headers:
+            self._emit(header)
+        self._start_data('data', size)
+
+    def _decide(self, name, entry):
+        # sets whether a member is included in the output and whether its contents are hashed
+        self.hasher = hash_object() if entry['type'] == 'file' else None
+        self.include = True
+        if self.filtering and entry['type'] == 'file':
+            previous = self.previous.get(name)
+            if previous is not None and previous['type'] == 'file' and previous['size'] == entry['size'] and \
+                    previous['mtime'] == entry['mtime'] and previous.get('digest'):
+                entry['digest'] = previous['digest']
+                entry['stored'] = False
+                self.include = False
+                self.hasher = None
+            elif previous is not None and previous.get('digest'):
+                # the decision is postponed until the digest is known
+                self.spool = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+    def _start_data(self, state, size):
+        self.payload = size
+        self.remaining = padded(size)
+        self.state = state
+        if not self.remaining:
+            self._finish()
+
+    def _process_data(self, data):
+        if self.state == 'extension':
+            self.extension_data += data
+            if self.extension == tarfile.XGLTYPE:
+                self._emit(data)
+            else:
+                self.extension_headers.append(data)
+        else:
+            if self.hasher is not None:
+                consumed = padded(self.payload) - self.remaining
+                self.hasher.update(data[:max(0, self.payload - consumed)])
+            self._emit(data)
+        self.remaining -= len(data)
+        if not self.remaining:
+            self._finish()
+
+    def _finish(self):
+        if self.state == 'extension':
+            data = bytes(self.extension_data[:self.payload])
+            self.extension_data = bytearray()
+            if self.extension == tarfile.XHDTYPE:
+                self.overrides.update(parse_pax_records(data))
+            elif self.extension == tarfile.GNUTYPE_LONGNAME:
+                self.overrides['path'] = data.rstrip(b'\0').decode('utf-8', 'surrogateescape')
+            elif self.extension == tarfile.GNUTYPE_LONGLINK:
+                self.overrides['linkpath'] = data.rstrip(b'\0').decode('utf-8', 'surrogateescape')
+            self.state = 'header'
+            return
+
+        if self.hasher is not None:
+            self.entry['digest'] = self.hasher.hexdigest()
+            self.hasher = None
+
+        if self.spool is not None:
+            spool, self.spool = self.spool, None
+            with spool:
+                if self.previous[self.name]['digest'] == self.entry['digest']:
+                    self.entry['stored'] = False
+                else:
+                    spool.seek(0)
+                    for chunk in iter(lambda: spool.read(CHUNK_SIZE), b''):
+                        self.output.append(chunk)
+        self.state = 'header'
+
+
+class MemberFilter(ArchiveScanner):
+    # a scanner that only outputs the members with the given names, see filter_archive
+
+    def __init__(self, names):
+        super().__init__({}, previous={})
+        self.names = names
+
+    def _decide(self, name, entry):
+        self.hasher = None
+        self.include = name in self.names
+
+
+def filter_archive(chunks, names):
+    # yields a tar stream that only contains the members with the given (normalized) names
+    scanner = MemberFilter(names)
+    for chunk in chunks:
+        scanner.feed(chunk)
+        yield from scanner.pop_output()
+    scanner.close()
+    yield from scanner.pop_output()
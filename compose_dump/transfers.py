@@ -0,0 +1,130 @@
+from collections import deque
+import logging
+from pathlib import PurePosixPath
+
+from docker.errors import ImageNotFound
+from docker.utils import parse_repository_tag
+
+from compose_dump.hooks import demux_socket, LABEL_PREFIX, STDERR_MAX_SIZE
+from compose_dump.metrics import Operation
+from compose_dump.storage import spool
+from compose_dump.utils import worker_pool
+
+
+# the label of the containers that read volumes for a dump
+HELPER_LABEL = LABEL_PREFIX + 'helper'
+
+
+log = logging.getLogger('compose-compose_dump')
+
+
+def get_archive(client, container_id, path):
+    bits, stat = client.get_archive(container_id, path)
+    if hasattr(bits, 'stream'):  # TODO: obsolete with docker-compose>1.19.0 (e.g. docker-py>=3.0.0)
+        bits = bits.stream
+    return bits
+
+
+def ensure_image(client, image):
+    # pulls an image unless it's present
+    try:
+        client.inspect_image(image)
+    except ImageNotFound:
+        log.info('Pulling the image %s' % image)
+        repository, tag = parse_repository_tag(image)
+        client.pull(repository, tag or 'latest')
+
+
+def helper_archive(client, container_id, path, image):
+    # Yields a tar stream of a container's path like get_archive, but the archive is created by tar in a
+    # short-lived container of image that mounts the container's volumes read-only, which relieves the
+    # Docker daemon. A failure ends the program.
+    path = PurePosixPath(path)
+    host_config = client.create_host_config(volumes_from=[container_id + ':ro'], network_mode='none')
+    helper_id = client.create_container(image, ['tar', '-c', '-f', '-', '-C', str(path.parent), path.name],
+                                        host_config=host_config, labels={HELPER_LABEL: container_id})['Id']
+    try:
+        # attaching before the start ensures that no output is missed
+        output = demux_socket(client.attach_socket(helper_id, params={'stdout': 1, 'stderr': 1, 'stream': 1,
+                                                                      'logs': 1}))
+        client.start(helper_id)
+        stderr = bytearray()
+        for out, err in output:
+            if err:
+                stderr += err
+                del stderr[:-STDERR_MAX_SIZE]
+            if out:
+                yield out
+        exit_code = client.wait(helper_id)
+        # docker-py returns a mapping since version 3
+        if isinstance(exit_code, dict):
+            exit_code = exit_code['StatusCode']
+        if exit_code:
+            log.error('Reading %s of container %s with the image %s failed with exit code %i: %s' %
+                      (path, container_id, image, exit_code, stderr.decode(errors='replace').strip()))
+            raise SystemExit(1)
+    finally:
+        client.remove_container(helper_id, force=True)
+
+
+class Transfers:
+    # Retrieves data from sources (callables that return a stream, e.g. Docker's get_archive) with up to
+    # ctx.options['jobs'] worker threads, unless jobs is given. The results are handed to the storage in the
+    # order of submission from the calling thread, storages that aren't thread-safe therefore only see one
+    # writer. With one job the next source is still retrieved while the previous result is being stored.
+
+    def __init__(self, ctx, jobs=None):
+        self.ctx = ctx
+        self.jobs = ctx.options.get('jobs', 1) if jobs is None else jobs
+        self.pending = deque()
+        self.executor = worker_pool(self.jobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.join()
+        else:
+            for future, _, _, _ in self.pending:
+                future.cancel()
+            self.executor.shutdown()
+
+    def submit(self, source, dst, namespace, index, key, services=(), metadata=None, kind='volume'):
+        # when the data was stored, index[key] is set to dst
+        # the services that use the source are paused while it is read if the pause mode is 'volume'
+        # kind names the operation in the metrics
+        if self.ctx.storage.is_stored(dst, namespace=namespace):
+            log.debug('Skipping %s/%s, it was stored before the dump was interrupted.' % (namespace, dst))
+            index[key] = dst
+            return
+
+        # bounds the amount of spooled data that waits to be written
+        while len(self.pending) >= 2 * self.jobs:
+            self._store_next()
+        operation = Operation(kind, namespace + '/' + dst)
+        future = self.executor.submit(self._retrieve, source, dst, namespace, services, metadata, operation)
+        self.pending.append((future, index, key, operation))
+
+    def join(self):
+        while self.pending:
+            self._store_next()
+        self.executor.shutdown()
+
+    def _retrieve(self, source, dst, namespace, services, metadata, operation):
+        storage = self.ctx.storage
+        with self.ctx.metrics.span(operation), self.ctx.pauses.volume_window(services):
+            if storage.thread_safe:
+                storage.write_file(source(), dst, namespace=namespace, metadata=metadata)
+                return None, dst, namespace, metadata
+            else:
+                return spool(source())[0], dst, namespace, metadata
+
+    def _store_next(self):
+        future, index, key, operation = self.pending.popleft()
+        buffer, dst, namespace, metadata = future.result()
+        if buffer is not None:
+            with self.ctx.metrics.span(operation):
+                self.ctx.storage.write_file(buffer, dst, namespace=namespace, metadata=metadata)
+        self.ctx.metrics.finish(operation)
+        index[key] = dst
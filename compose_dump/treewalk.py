@@ -0,0 +1,196 @@
+from collections import deque
+import errno
+import logging
+import os
+from pathlib import Path
+import stat
+import tarfile
+
+from compose_dump.utils import worker_pool
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+log = logging.getLogger('compose-compose_dump')
+
+# files up to this size are read completely by the pool of read-ahead threads
+READAHEAD_MAX_SIZE = 1024 ** 2
+READAHEAD_THREADS = 4
+# the ioctl request that clones a file's extents on filesystems with copy-on-write support (Linux' FICLONE)
+FICLONE = 0x40049409
+
+
+def scan_tree(path, name, follow_symlinks=False, exclusions=None):
+    # yields the path, its name below name and the stat result of path and everything below it in sorted,
+    # depth-first order, the entries' stat results are not queried again, paths that exclusions exclude are
+    # skipped without descending into them. Folders are read through descriptors that are opened relative to
+    # their parent's and that must refer to the scanned folder, so a folder that is replaced with a symbolic
+    # link meanwhile isn't followed.
+    path = Path(path)
+    stat_result = os.stat(str(path)) if follow_symlinks else os.lstat(str(path))
+    yield path, name, stat_result
+    if stat.S_ISDIR(stat_result.st_mode):
+        yield from _scan_directory(str(path), None, path, name, stat_result, follow_symlinks, exclusions, '')
+
+
+def _scan_directory(entry, dir_fd, path, name, stat_result, follow_symlinks, exclusions, relative):
+    fd = _open_scanned(entry, stat_result, os.O_DIRECTORY, follow_symlinks, dir_fd)
+    if fd is None:
+        log.warning('Skipping %s, it was replaced while it was read.' % path)
+        return
+    try:
+        for entry in sorted(os.listdir(fd)):
+            entry_relative = relative + entry
+            excluded = exclusions is not None and exclusions.excludes(entry_relative)
+            stat_result = os.stat(entry, dir_fd=fd, follow_symlinks=follow_symlinks and not excluded)
+            if excluded:
+                if not stat.S_ISDIR(stat_result.st_mode):
+                    exclusions.record(stat_result.st_size)
+                    continue
+                if not exclusions.may_include_below(entry_relative):
+                    exclusions.record(0)
+                    continue
+            entry_path, entry_name = path / entry, name / entry
+            yield entry_path, entry_name, stat_result
+            if stat.S_ISDIR(stat_result.st_mode):
+                yield from _scan_directory(entry, fd, entry_path, entry_name, stat_result, follow_symlinks,
+                                           exclusions, entry_relative + '/')
+    finally:
+        os.close(fd)
+
+
+def _open_scanned(path, stat_result, flags, follow_symlinks=False, dir_fd=None):
+    # returns a descriptor of a scanned file or None if path no longer refers to it, a fifo that replaced it
+    # doesn't block
+    flags |= os.O_RDONLY | os.O_NONBLOCK
+    if not follow_symlinks:
+        flags |= getattr(os, 'O_NOFOLLOW', 0)
+    try:
+        fd = os.open(path, flags, dir_fd=dir_fd)
+    except OSError as e:
+        if e.errno in (errno.ELOOP, errno.ENOENT, errno.ENOTDIR):
+            return None
+        raise
+    current = os.fstat(fd)
+    if stat.S_IFMT(current.st_mode) != stat.S_IFMT(stat_result.st_mode) or \
+            (current.st_dev, current.st_ino) != (stat_result.st_dev, stat_result.st_ino):
+        os.close(fd)
+        return None
+    return fd
+
+
+def open_scanned(path, stat_result, follow_symlinks=False):
+    # opens a regular file that scan_tree yielded for reading, returns None if path no longer refers to the
+    # scanned file, e.g. because it was replaced with a symbolic link
+    fd = _open_scanned(str(path), stat_result, 0, follow_symlinks)
+    return None if fd is None else os.fdopen(fd, 'rb')
+
+
+def make_tarinfo(path, name, stat_result, inodes):
+    # like TarFile.gettarinfo, but with a given stat result and without the names of owners, inodes maps the
+    # inodes of regular files with several links to the name they were stored with first, returns None for
+    # unsupported file types
+    arcname = str(name).lstrip('/')
+    mode = stat_result.st_mode
+    linkname = ''
+    if stat.S_ISREG(mode):
+        type = tarfile.REGTYPE
+        # only inodes with several links are remembered, they're rare and there may be millions of files
+        if stat_result.st_nlink > 1:
+            inode = (stat_result.st_ino, stat_result.st_dev)
+            if inode in inodes and inodes[inode] != arcname:
+                type, linkname = tarfile.LNKTYPE, inodes[inode]
+            else:
+                inodes[inode] = arcname
+    elif stat.S_ISDIR(mode):
+        type = tarfile.DIRTYPE
+    elif stat.S_ISFIFO(mode):
+        type = tarfile.FIFOTYPE
+    elif stat.S_ISLNK(mode):
+        type, linkname = tarfile.SYMTYPE, os.readlink(str(path))
+    elif stat.S_ISCHR(mode):
+        type = tarfile.CHRTYPE
+    elif stat.S_ISBLK(mode):
+        type = tarfile.BLKTYPE
+    else:
+        return None
+
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.type = type
+    tarinfo.linkname = linkname
+    tarinfo.mode = mode
+    tarinfo.uid = stat_result.st_uid
+    tarinfo.gid = stat_result.st_gid
+    tarinfo.size = stat_result.st_size if type == tarfile.REGTYPE else 0
+    tarinfo.mtime = stat_result.st_mtime
+    if type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        tarinfo.devmajor = os.major(stat_result.st_rdev)
+        tarinfo.devminor = os.minor(stat_result.st_rdev)
+    return tarinfo
+
+
+def ordered_map(function, items, threads=READAHEAD_THREADS):
+    # yields each item with function's result for it, the results are computed ahead on a pool of threads
+    # with a bounded number of items in flight
+    if threads < 2:
+        for item in items:
+            yield item, function(item)
+        return
+    pending = deque()
+    with worker_pool(threads) as pool:
+        for item in items:
+            pending.append((item, pool.submit(function, item)))
+            if len(pending) >= 4 * threads:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+
+def read_small_file(item):
+    # returns the content of a regular file up to READAHEAD_MAX_SIZE, None for anything else and for files
+    # that were replaced since they were scanned
+    path, name, stat_result = item
+    if not stat.S_ISREG(stat_result.st_mode) or stat_result.st_size > READAHEAD_MAX_SIZE:
+        return None
+    f = open_scanned(path, stat_result)
+    if f is None:
+        return None
+    with f:
+        return f.read()
+
+
+def reflink_file(src_fd, dst_fd):
+    # lets the destination share the source's extents, returns False if the filesystem doesn't support it
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError:
+        return False
+    return True
+
+
+def clone_file(src_fd, dst_fd, size):
+    # copies a file's content within the kernel, with a reflink if the filesystem supports it,
+    # returns False if neither is supported
+    if reflink_file(src_fd, dst_fd):
+        return True
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    copied = 0
+    try:
+        while copied < size:
+            count = os.copy_file_range(src_fd, dst_fd, size - copied)
+            if not count:
+                break
+            copied += count
+    except OSError:
+        if copied:
+            raise
+        return False
+    return True
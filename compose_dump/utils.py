@@ -1,7 +1,13 @@
 import logging
 from collections.abc import Set
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 import os
+from pathlib import Path
+import threading
+
+
+COMPOSE_FILENAMES = ('docker-compose.yml', 'docker-compose.yaml')
 
 
 class PathSet(Set):
@@ -26,17 +32,85 @@ class PathSet(Set):
         self.items.add(self._norm_value(value))
 
 
+class ThreadLogFilter(logging.Filter):
+    # passes the records that are logged from the thread that created the filter and from the threads
+    # of the pools it started with worker_pool
+
+    def __init__(self):
+        super().__init__()
+        self.thread_name = threading.current_thread().name
+
+    def filter(self, record):
+        return record.threadName == self.thread_name or record.threadName.startswith(self.thread_name + '/')
+
+
+def worker_pool(max_workers):
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=threading.current_thread().name + '/')
+
+
+def find_projects(root):
+    # returns the folders below root that contain a compose file, hidden folders are skipped
+    result = []
+    for dirpath, dirnames, filenames in os.walk(str(root)):
+        dirnames[:] = sorted(x for x in dirnames if not x.startswith('.'))
+        if any(x in filenames for x in COMPOSE_FILENAMES):
+            result.append(Path(dirpath))
+    return result
+
+
 def get_container_with_project_volume(project, volume_name):
-    volume_name = '%s_%s' % (project.name, volume_name)
+    volume_names = get_project_volume_names(project, volume_name)
     for service in project.services:
         for volume in service.options.get('volumes', ()):
-            if volume.external == volume_name:
+            if volume.external in volume_names:
                 container = get_container_for_service(service)
                 if container:
                     return container, volume.internal
     return None, None
 
 
+def get_local_mountpoint(client, mounts, path):
+    # returns the folder on this host that holds the local volume that is mounted at path, mounts are a
+    # container's as Docker reports them, None if the Docker daemon is remote, the folder isn't accessible or
+    # other mounts are nested below path
+    if not client.base_url.startswith('http+docker://local'):
+        return None
+    mount = next((x for x in mounts if normpath(x.get('Destination', '')) == normpath(path)), None)
+    if mount is None or mount.get('Type') != 'volume' or mount.get('Driver') != 'local' or not mount.get('Source'):
+        return None
+    if any(locates_in(x.get('Destination', ''), path) for x in mounts):
+        return None
+    source = Path(mount['Source'])
+    if not os.access(str(source), os.R_OK | os.X_OK) or not source.is_dir():
+        return None
+    return source
+
+
+def get_services_using_path(project, path):
+    return [x.name for x in project.services
+            if any(v.external is not None and normpath(v.external) == normpath(path)
+                   for v in x.options.get('volumes', ()))]
+
+
+def get_services_using_project_volume(project, volume_name):
+    volume_names = get_project_volume_names(project, volume_name)
+    return [x.name for x in project.services
+            if any(v.external in volume_names for v in x.options.get('volumes', ()))]
+
+
+def get_project_volume_names(project, volume_name):
+    # the names that the volume specs of services refer to a project volume with, it's resolved like
+    # docker-compose does, so a volume with a custom name is found as well. A volume that the project doesn't
+    # define, e.g. one that a dump holds, has none.
+    volume = project.volumes.volumes.get(volume_name)
+    return () if volume is None else get_volume_names(volume)
+
+
+def get_volume_names(volume):
+    # a compose Volume's name and the one that docker-compose used before 1.21
+    return sorted(set((volume.full_name, getattr(volume, 'legacy_full_name', volume.full_name))))
+
+
 def get_container_for_service(service):
     containers = service.containers(stopped=True) or \
                  service.containers(stopped=True, one_off=True)
@@ -0,0 +1,82 @@
+import logging
+
+from compose_dump.checksums import CHECKSUM_ALGORITHM, Checksum, summarize_checksums
+from compose_dump.reader import MANIFEST_NAME, open_dump, parse_manifest
+from compose_dump.storage import iter_chunks
+
+
+log = logging.getLogger('compose-compose_dump')
+
+
+def verify_dump(ctx):
+    # hashes all files of a dump in one pass and compares them to the checksums that its manifest records,
+    # the dumps of a combined archive are stored in folders with their own manifests and are verified each
+    found = {}
+    manifests = {}
+    with open_dump(ctx.options['source'], ctx.options.get('encryption_key_file')) as dump:
+        for member in dump:
+            if member.type != 'file' or member.name == MANIFEST_NAME:
+                continue
+            if member.name.count('/') == 1 and member.name.endswith('/' + MANIFEST_NAME):
+                with member.open() as f:
+                    manifests[member.name[:-len(MANIFEST_NAME)]] = parse_manifest(f.read())
+                continue
+            checksum = Checksum()
+            with member.open() as f:
+                for chunk in iter_chunks(f):
+                    checksum.update(chunk)
+            found[member.name] = checksum.as_dict()
+
+    if dump.manifest is not None:
+        manifests = {'': dump.manifest}
+    elif not manifests:
+        log.error('The dump contains no manifest.')
+        raise SystemExit(1)
+
+    problems = files = 0
+    for prefix, manifest in sorted(manifests.items()):
+        namespace = {k[len(prefix):]: v for k, v in found.items() if k.startswith(prefix)}
+        problems += verify_checksums(prefix, manifest, namespace)
+        files += len(namespace)
+    for name in sorted(x for x in found if not any(x.startswith(y) for y in manifests)):
+        log.error('File is not recorded in any manifest: %s' % name)
+        problems += 1
+
+    if problems:
+        log.error('The dump is corrupted, found %i problems.' % problems)
+        raise SystemExit(1)
+    if '' in manifests:
+        log.info("Verified %i files, the dump's digest is %s." % (files, dump.manifest['checksums']['digest']))
+    else:
+        log.info('Verified %i files of %i dumps.' % (files, len(manifests)))
+
+
+def verify_checksums(prefix, manifest, found):
+    # compares the checksums of the files below prefix to the ones that their manifest records, returns the
+    # number of problems
+    recorded = manifest.get('checksums')
+    if not recorded:
+        log.error('The manifest %s records no checksums.' % (prefix + MANIFEST_NAME))
+        return 1
+    if recorded['algorithm'] != CHECKSUM_ALGORITHM:
+        log.error('Unsupported checksum algorithm: %s' % recorded['algorithm'])
+        return 1
+
+    problems = 0
+    files = recorded['files']
+    for name in sorted(set(files) | set(found)):
+        if name not in found:
+            log.error('Missing file: %s' % (prefix + name))
+        elif name not in files:
+            log.error('File is not recorded in the manifest: %s' % (prefix + name))
+        elif found[name]['size'] != files[name]['size'] or found[name]['digest'] != files[name]['digest']:
+            log.error('Checksum mismatch: %s' % (prefix + name))
+        else:
+            continue
+        problems += 1
+    if summarize_checksums(files)['digest'] != recorded['digest']:
+        log.error("The recorded checksums don't match the digest of %s." % (prefix + MANIFEST_NAME))
+        problems += 1
+    elif prefix:
+        log.debug("The digest of %s is %s." % (prefix.rstrip('/'), recorded['digest']))
+    return problems
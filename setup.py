@@ -37,6 +37,7 @@ setup(
     license='ISC',
     platforms=["any"],
     install_requires=['docker-compose>=1.7,<=1.24'],
+    extras_require={'encryption': ['cryptography>=2.0'], 'zstd': ['zstandard>=0.16']},
     tests_require=['tox'],
     packages=find_packages(exclude=['tests.*', 'tests']),
     include_package_data=True,
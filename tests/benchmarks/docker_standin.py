@@ -0,0 +1,240 @@
+from base64 import urlsafe_b64encode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import re
+import tarfile
+from threading import Thread
+from urllib.parse import parse_qs, urlsplit
+
+
+# the synthetic contents of files are made of chunks of this size, half random and half zeros
+DATA_CHUNK_SIZE = 64 * 1024
+MTIME = 1500000000
+
+
+def synthetic_data(size):
+    # yields semi-compressible data
+    while size > 0:
+        chunk_size = min(DATA_CHUNK_SIZE, size)
+        half = chunk_size // 2
+        yield os.urandom(half) + bytes(chunk_size - half)
+        size -= chunk_size
+
+
+def synthetic_archive(name, files, file_size):
+    # yields a tar stream of a folder with files of synthetic data, like Docker's archive API
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.DIRTYPE
+    info.mode = 0o755
+    info.mtime = MTIME
+    yield info.tobuf(format=tarfile.GNU_FORMAT)
+    for number in range(files):
+        info = tarfile.TarInfo('%s/%06i' % (name, number))
+        info.size = file_size
+        info.mode = 0o644
+        info.mtime = MTIME
+        yield info.tobuf(format=tarfile.GNU_FORMAT)
+        yield from synthetic_data(file_size)
+        remainder = file_size % tarfile.BLOCKSIZE
+        if remainder:
+            yield bytes(tarfile.BLOCKSIZE - remainder)
+    yield bytes(2 * tarfile.BLOCKSIZE)
+
+
+class Container:
+    def __init__(self, id, name, project, service, image, mounts=()):
+        # mounts are pairs of volume names and paths
+        self.id = id
+        self.name = name
+        self.image = image
+        self.labels = {
+            'com.docker.compose.project': project,
+            'com.docker.compose.service': service,
+            'com.docker.compose.oneoff': 'False',
+            'com.docker.compose.container-number': '1',
+        }
+        self.paused = False
+        self.mounts = [{'Type': 'volume', 'Name': x, 'Source': '/var/lib/docker/volumes/%s/_data' % x,
+                        'Destination': y, 'Driver': 'local', 'Mode': 'rw', 'RW': True, 'Propagation': ''}
+                       for x, y in mounts]
+
+    def matches(self, label_filters):
+        for label_filter in label_filters:
+            key, _, value = label_filter.partition('=')
+            if key not in self.labels or (value and self.labels[key] != value):
+                return False
+        return True
+
+    def summary(self):
+        return {'Id': self.id, 'Image': self.image, 'Names': ['/' + self.name], 'Labels': self.labels,
+                'State': 'paused' if self.paused else 'running', 'Mounts': self.mounts}
+
+    def inspect(self):
+        return {'Id': self.id, 'Name': '/' + self.name, 'Image': self.image,
+                'Config': {'Image': self.image, 'Labels': self.labels},
+                'State': {'Running': True, 'Paused': self.paused, 'Status': 'running'},
+                'HostConfig': {}, 'Mounts': self.mounts, 'NetworkSettings': {'Ports': {}}}
+
+
+class DockerStandIn:
+    # Serves the parts of Docker's Engine API that a backup uses from a local HTTP server. Containers,
+    # images and volumes are declared with the add_* methods, archives of container paths are synthesized
+    # from the declared number and size of files. Point DOCKER_HOST to the url property to use it.
+
+    def __init__(self):
+        self.containers = {}
+        self.images = {}
+        self.volumes = set()
+        self.archives = {}
+        self.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(self))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'tcp://127.0.0.1:%i' % self.server.server_address[1]
+
+    def add_container(self, id, name, project, service, image, mounts=()):
+        self.containers[id] = Container(id, name, project, service, image, mounts)
+
+    def add_image(self, name, volumes=()):
+        self.images[name] = {'Id': 'sha256:' + name.encode().hex().ljust(64, '0')[:64],
+                             'Config': {'Volumes': {x: {} for x in volumes} or None}}
+
+    def add_volume(self, name):
+        self.volumes.add(name)
+
+    def add_archive(self, container_id, path, files, file_size):
+        self.archives[(container_id, path)] = (files, file_size)
+
+    def start(self):
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def volume_summary(name):
+    return {'Name': name, 'Driver': 'local', 'Mountpoint': '/var/lib/docker/volumes/%s/_data' % name,
+            'Labels': None, 'Scope': 'local'}
+
+
+def make_handler(standin):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self.dispatch('GET')
+
+        def do_POST(self):
+            self.dispatch('POST')
+
+        def dispatch(self, method):
+            url = urlsplit(self.path)
+            path = re.sub(r'^/v[0-9.]+', '', url.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            standin.requests.append((method, path))
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                self.rfile.read(length)
+
+            for pattern, handler_method, name in ROUTES:
+                match = re.fullmatch(pattern, path)
+                if match and method == handler_method:
+                    getattr(self, name)(query, *match.groups())
+                    return
+            self.send_json(404, {'message': 'page not found'})
+
+        def list_containers(self, query):
+            label_filters = json.loads(query.get('filters', '{}')).get('label', [])
+            self.send_json(200, [x.summary() for x in standin.containers.values() if x.matches(label_filters)])
+
+        def inspect_container(self, query, container_id):
+            container = standin.containers.get(container_id)
+            if container is None:
+                self.send_json(404, {'message': 'No such container: %s' % container_id})
+            else:
+                self.send_json(200, container.inspect())
+
+        def pause_container(self, query, container_id):
+            standin.containers[container_id].paused = True
+            self.send_empty(204)
+
+        def unpause_container(self, query, container_id):
+            standin.containers[container_id].paused = False
+            self.send_empty(204)
+
+        def get_archive(self, query, container_id):
+            path = query['path'].rstrip('/') or '/'
+            if (container_id, path) not in standin.archives:
+                self.send_json(404, {'message': 'Could not find the file %s in container %s' % (path, container_id)})
+                return
+            files, file_size = standin.archives[(container_id, path)]
+            name = os.path.basename(path)
+            stat = {'name': name, 'size': 4096, 'mode': 0o20000000755, 'mtime': '2017-07-14T02:40:00Z',
+                    'linkTarget': ''}
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-tar')
+            self.send_header('X-Docker-Container-Path-Stat', urlsafe_b64encode(json.dumps(stat).encode()).decode())
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in synthetic_archive(name, files, file_size):
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+
+        def inspect_image(self, query, name):
+            image = standin.images.get(name)
+            if image is None:
+                self.send_json(404, {'message': 'No such image: %s' % name})
+            else:
+                self.send_json(200, image)
+
+        def list_volumes(self, query):
+            self.send_json(200, {'Volumes': [volume_summary(x) for x in sorted(standin.volumes)], 'Warnings': None})
+
+        def inspect_volume(self, query, name):
+            if name in standin.volumes:
+                self.send_json(200, volume_summary(name))
+            else:
+                self.send_json(404, {'message': 'get %s: no such volume' % name})
+
+        def send_json(self, status, data):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_empty(self, status):
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    return Handler
+
+
+ROUTES = (
+    (r'/containers/json', 'GET', 'list_containers'),
+    (r'/containers/([^/]+)/json', 'GET', 'inspect_container'),
+    (r'/containers/([^/]+)/pause', 'POST', 'pause_container'),
+    (r'/containers/([^/]+)/unpause', 'POST', 'unpause_container'),
+    (r'/containers/([^/]+)/archive', 'GET', 'get_archive'),
+    (r'/images/(.+)/json', 'GET', 'inspect_image'),
+    (r'/volumes', 'GET', 'list_volumes'),
+    (r'/volumes/([^/]+)', 'GET', 'inspect_volume'),
+)
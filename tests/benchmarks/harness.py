@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# Benchmarks the backup of a synthetic project against a stand-in for the Docker API. Each configuration
+# of storage, compression and level is dumped by a separate process that reports its wall time and peak
+# RSS. Run it from the repository's root:
+#
+#     $ python -m tests.benchmarks.harness --volumes 4 --volume-files 64 --file-size 1048576
+#
+# Use --json to record the results for comparisons of later runs.
+
+from argparse import ArgumentParser
+import json
+import os
+from pathlib import Path
+from shutil import rmtree
+from subprocess import run, PIPE
+import sys
+from tempfile import mkdtemp
+
+from tests.benchmarks.docker_standin import DockerStandIn, synthetic_data
+
+
+PROJECT_NAME = 'benchmark'
+CONTAINER_ID = 'be9c4a7ac0ffee'
+IMAGE = 'benchmark/app'
+IMAGE_VOLUME = '/cache'
+DEFAULT_MATRIX = ('folder', 'tar', 'gz:1', 'gz:6', 'gz:9', 'bz2:1', 'bz2:9', 'xz:0', 'xz:6',
+                  'zstd:1', 'zstd:3', 'zstd:9')
+FILE_EXTENSIONS = {'tar': '.tar', 'bz2': '.tar.bz2', 'gz': '.tar.gz', 'xz': '.tar.xz', 'zstd': '.tar.zst'}
+
+# runs the backup command and prints its wall time and the process' peak RSS as JSON
+CHILD_SCRIPT = """
+import json, resource, sys
+from time import perf_counter
+from compose_dump.main import parse_cli_args
+args = parse_cli_args(sys.argv[1:])
+start = perf_counter()
+args.action(args)
+wall_time = perf_counter() - start
+print(json.dumps({'wall_time': wall_time, 'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}))
+"""
+
+
+def create_project(path, volumes, mounted_files, mounted_file_size):
+    lines = ['version: "2"', 'services:', '  app:', '    image: %s' % IMAGE, '    volumes:',
+             '      - ./mounted:/mounted']
+    lines.extend('      - vol%i:/volumes/vol%i' % (x, x) for x in range(volumes))
+    if volumes:
+        lines.append('volumes:')
+        lines.extend('  vol%i: {}' % x for x in range(volumes))
+    path.mkdir(parents=True)
+    (path / 'docker-compose.yml').write_text('\n'.join(lines) + '\n')
+
+    # many small files in folders of a hundred
+    mounted = path / 'mounted'
+    mounted.mkdir()
+    for number in range(mounted_files):
+        folder = mounted / ('%04i' % (number // 100))
+        folder.mkdir(exist_ok=True)
+        with (folder / ('%06i' % number)).open('wb') as f:
+            for chunk in synthetic_data(mounted_file_size):
+                f.write(chunk)
+
+
+def setup_standin(standin, volumes, volume_files, file_size):
+    mounts = [('%s_vol%i' % (PROJECT_NAME, x), '/volumes/vol%i' % x) for x in range(volumes)]
+    standin.add_container(CONTAINER_ID, PROJECT_NAME + '_app_1', PROJECT_NAME, 'app', IMAGE, mounts)
+    standin.add_image(IMAGE, volumes=(IMAGE_VOLUME,))
+    standin.add_archive(CONTAINER_ID, IMAGE_VOLUME, volume_files, file_size)
+    for number in range(volumes):
+        standin.add_volume('%s_vol%i' % (PROJECT_NAME, number))
+        standin.add_archive(CONTAINER_ID, '/volumes/vol%i' % number, volume_files, file_size)
+
+
+def parse_configuration(value):
+    # 'folder', 'tar' or a compression with an optional level, e.g. 'gz:6'
+    compression, _, level = value.partition(':')
+    return compression, int(level) if level else None
+
+
+def get_size(path):
+    if path.is_file():
+        return path.stat().st_size
+    return sum(x.stat().st_size for x in path.rglob('*') if x.is_file() and not x.is_symlink())
+
+
+def run_configuration(configuration, project_dir, target_dir, docker_host, jobs=1, compression_threads=1):
+    compression, level = parse_configuration(configuration)
+    target_dir.mkdir()
+    args = ['backup', '--project-dir', str(project_dir), '-p', PROJECT_NAME, '-j', str(jobs)]
+    if compression == 'folder':
+        target = target_dir
+    else:
+        target = target_dir / ('dump' + FILE_EXTENSIONS[compression])
+        args.extend(['--compression-threads', str(compression_threads)])
+        if level is not None:
+            args.extend(['--compression-level', str(level)])
+    args.extend(['-t', str(target)])
+
+    env = {k: v for k, v in os.environ.items() if not k.startswith(('DOCKER_', 'COMPOSE_'))}
+    env['DOCKER_HOST'] = docker_host
+    process = run([sys.executable, '-c', CHILD_SCRIPT] + args, stdout=PIPE, stderr=PIPE, env=env,
+                  cwd=str(project_dir))
+    if process.returncode:
+        raise RuntimeError('The backup with %s failed:\n%s' % (configuration, process.stderr.decode()))
+    result = json.loads(process.stdout.decode().splitlines()[-1])
+    result.update({'configuration': configuration, 'output_size': get_size(target), 'target': str(target)})
+    return result
+
+
+def run_benchmark(work_dir, matrix=DEFAULT_MATRIX, volumes=2, volume_files=16, file_size=1024 ** 2,
+                  mounted_files=1000, mounted_file_size=4096, jobs=1, compression_threads=1):
+    # returns a result for each configuration in matrix
+    project_dir = work_dir / 'project'
+    create_project(project_dir, volumes, mounted_files, mounted_file_size)
+    input_size = (volumes + 1) * volume_files * file_size + mounted_files * mounted_file_size
+
+    results = []
+    with DockerStandIn() as standin:
+        setup_standin(standin, volumes, volume_files, file_size)
+        for number, configuration in enumerate(matrix):
+            result = run_configuration(configuration, project_dir, work_dir / ('target_%i' % number),
+                                       standin.url, jobs, compression_threads)
+            result['input_size'] = input_size
+            result['throughput'] = input_size / result['wall_time']
+            results.append(result)
+    return results
+
+
+def format_results(results):
+    lines = ['%-12s %10s %12s %12s %8s %10s' % ('config', 'wall (s)', 'MiB/s', 'output MiB', 'ratio', 'RSS MiB')]
+    for result in results:
+        lines.append('%-12s %10.2f %12.1f %12.1f %8.3f %10.1f' % (
+            result['configuration'], result['wall_time'], result['throughput'] / 1024 ** 2,
+            result['output_size'] / 1024 ** 2, result['output_size'] / result['input_size'],
+            result['peak_rss'] / 1024 ** 2))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark backups of a synthetic project.')
+    parser.add_argument('--matrix', nargs='*', default=DEFAULT_MATRIX, metavar='CONFIGURATION',
+                        help="'folder', 'tar' or a compression with an optional level, e.g. 'gz:6'.")
+    parser.add_argument('--volumes', type=int, default=2, help='Number of project volumes.')
+    parser.add_argument('--volume-files', type=int, default=16, help='Number of files in each volume.')
+    parser.add_argument('--file-size', type=int, default=1024 ** 2, help='Size of files in volumes.')
+    parser.add_argument('--mounted-files', type=int, default=1000, help='Number of files in the mounted folder.')
+    parser.add_argument('--mounted-file-size', type=int, default=4096, help='Size of files in the mounted folder.')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--compression-threads', type=int, default=1)
+    parser.add_argument('--json', metavar='PATH', help='Write the results to this file.')
+    parser.add_argument('--keep', action='store_true', help="Keep the working directory.")
+    args = parser.parse_args()
+
+    work_dir = Path(mkdtemp(prefix='compose_dump_benchmark_'))
+    try:
+        results = run_benchmark(
+            work_dir, args.matrix, volumes=args.volumes, volume_files=args.volume_files, file_size=args.file_size,
+            mounted_files=args.mounted_files, mounted_file_size=args.mounted_file_size, jobs=args.jobs,
+            compression_threads=args.compression_threads)
+    finally:
+        if args.keep:
+            print('Results are kept in %s' % work_dir)
+        else:
+            rmtree(str(work_dir))
+
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'wt') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+from compose_dump.reader import open_dump
+from compose_dump.verify import verify_dump
+from tests.benchmarks.harness import format_results, run_benchmark
+
+
+def test_harness(temp_dir):
+    results = run_benchmark(temp_dir, ('folder', 'gz:1'), volumes=1, volume_files=2, file_size=100000,
+                            mounted_files=150, mounted_file_size=100)
+
+    assert [x['configuration'] for x in results] == ['folder', 'gz:1']
+    for result in results:
+        assert result['wall_time'] > 0 and result['peak_rss'] > 0
+        assert result['input_size'] == 2 * 2 * 100000 + 150 * 100
+
+    folder_target = Path(results[0]['target'])
+    dump_path = next(folder_target.iterdir())
+    verify_dump(SimpleNamespace(options={'source': dump_path}))
+    with open_dump(dump_path) as dump:
+        names = [x.name for x in dump]
+    assert 'volumes/project/vol0.tar' in names
+    assert 'volumes/mounted/mounted/0001/000149' in names
+    assert results[1]['output_size'] < results[0]['output_size']
+
+    assert 'gz:1' in format_results(results)
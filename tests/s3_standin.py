@@ -0,0 +1,112 @@
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import re
+from threading import Lock, Thread
+from urllib.parse import parse_qs, unquote, urlsplit
+from uuid import uuid4
+
+from compose_dump.objectstore import signature
+
+
+AUTHORIZATION_PATTERN = re.compile(r'AWS4-HMAC-SHA256 Credential=(?P<access_key>[^/]+)/(?P<date>\d{8})/'
+                                   r'(?P<region>[^/]+)/s3/aws4_request, SignedHeaders=(?P<headers>[^,]+), '
+                                   r'Signature=(?P<signature>[0-9a-f]{64})')
+
+
+class S3StandIn:
+    # An in-memory object store that implements the parts of S3's API that uploads use with path-style
+    # addressing and checks the signatures of requests. The numbers of parts in failing_parts fail once
+    # with status 500.
+
+    def __init__(self, access_key='AKIDSTANDIN', secret_key='stand-in-secret', region='us-east-1'):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        # maps bucket and key to contents, upload ids to dicts of part numbers and contents
+        self.objects = {}
+        self.uploads = {}
+        self.aborted = []
+        self.failing_parts = set()
+        self.lock = Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:%i' % self.server.server_address[1]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method, path, query, headers, body):
+        # returns a status, headers and a body
+        match = AUTHORIZATION_PATTERN.fullmatch(headers.get('authorization', ''))
+        if match is None or match.group('access_key') != self.access_key:
+            return 403, {}, b'<Error><Code>InvalidAccessKeyId</Code></Error>'
+        signed = {x: headers.get(x, '') for x in match.group('headers').split(';')}
+        if sha256(body).hexdigest() != headers.get('x-amz-content-sha256') or \
+                signature(method, path, query, signed, headers['x-amz-content-sha256'], self.secret_key,
+                          self.region, headers['x-amz-date']) != match.group('signature'):
+            return 403, {}, b'<Error><Code>SignatureDoesNotMatch</Code></Error>'
+
+        bucket, _, key = unquote(path).lstrip('/').partition('/')
+        params = {k: v[0] for k, v in parse_qs(query, keep_blank_values=True).items()}
+        with self.lock:
+            if method == 'POST' and 'uploads' in params:
+                upload_id = uuid4().hex
+                self.uploads[upload_id] = {}
+                return 200, {}, ('<InitiateMultipartUploadResult><UploadId>%s</UploadId>'
+                                 '</InitiateMultipartUploadResult>' % upload_id).encode()
+            elif method == 'PUT' and 'partNumber' in params:
+                number = int(params['partNumber'])
+                if number in self.failing_parts:
+                    self.failing_parts.remove(number)
+                    return 500, {}, b'<Error><Code>InternalError</Code></Error>'
+                self.uploads[params['uploadId']][number] = body
+                return 200, {'ETag': '"%s"' % sha256(body).hexdigest()}, b''
+            elif method == 'POST' and 'uploadId' in params:
+                parts = self.uploads.pop(params['uploadId'])
+                numbers = [int(x) for x in re.findall(r'<PartNumber>(\d+)</PartNumber>', body.decode())]
+                if numbers != sorted(parts):
+                    return 400, {}, b'<Error><Code>InvalidPart</Code></Error>'
+                self.objects[(bucket, key)] = b''.join(parts[x] for x in numbers)
+                return 200, {}, b'<CompleteMultipartUploadResult></CompleteMultipartUploadResult>'
+            elif method == 'DELETE' and 'uploadId' in params:
+                del self.uploads[params['uploadId']]
+                self.aborted.append(key)
+                return 204, {}, b''
+            elif method == 'PUT':
+                self.objects[(bucket, key)] = body
+                return 200, {'ETag': '"%s"' % sha256(body).hexdigest()}, b''
+        return 400, {}, b'<Error><Code>NotImplemented</Code></Error>'
+
+    def _make_handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _respond(self):
+                url = urlsplit(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                headers = {k.lower(): v for k, v in self.headers.items()}
+                status, response_headers, response_body = standin.handle(
+                    self.command, url.path, url.query, headers, body)
+                self.send_response(status)
+                for name, value in response_headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(response_body)))
+                self.end_headers()
+                self.wfile.write(response_body)
+
+            do_DELETE = do_POST = do_PUT = _respond
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,95 @@
+import json
+from threading import Lock
+from types import SimpleNamespace
+
+import yaml
+from pytest import mark, raises
+
+from compose_dump.checksums import hash_object, summarize_checksums
+from compose_dump.reader import MANIFEST_NAME
+from compose_dump.storage import ArchiveStorage, ChunkStorage, FolderStorage, NamespacedStorage
+from compose_dump.verify import verify_dump
+
+
+STORAGES = {
+    'archive': (ArchiveStorage, lambda path: path / 'dump.tar.gz', 'gz'),
+    'folder': (FolderStorage, lambda path: path / 'dump', None),
+    'chunks': (ChunkStorage, lambda path: path / 'repository', None),
+}
+
+
+def make_dump(storage_type, temp_dir):
+    storage_class, make_target, compression = STORAGES[storage_type]
+    target = make_target(temp_dir)
+    if storage_type != 'archive':
+        target.mkdir()
+    ctx = SimpleNamespace(
+        options={'target': target, 'compression': compression, 'target_pattern': 'dump',
+                 'project_name': 'test', 'project_dir': temp_dir},
+        manifest={'meta': {'invocation_time': '2017-01-01T00:00:00', 'host': 'host'}})
+    source = temp_dir / 'source'
+    (source / 'sub').mkdir(parents=True)
+    (source / 'a.txt').write_text('a')
+    (source / 'sub' / 'b.txt').write_text('bb')
+
+    storage = storage_class(ctx)
+    storage.put_folder(source, 'source', namespace='volumes/mounted')
+    storage.write_file(iter([b'x' * 1000]), 'data.tar', namespace='volumes/project')
+    manifest = json.loads(json.dumps({'checksums': summarize_checksums(storage.checksums)}))
+    storage.write_file(yaml.dump(manifest), MANIFEST_NAME)
+    storage.finalize()
+
+    if storage_type == 'archive':
+        return target, manifest
+    elif storage_type == 'folder':
+        return target / 'dump', manifest
+    else:
+        return target / 'dumps' / 'dump', manifest
+
+
+@mark.parametrize('storage_type', sorted(STORAGES))
+def test_checksums_are_recorded_and_verified(storage_type, temp_dir):
+    path, manifest = make_dump(storage_type, temp_dir)
+
+    files = manifest['checksums']['files']
+    assert sorted(files) == ['volumes/mounted/source/a.txt', 'volumes/mounted/source/sub/b.txt',
+                             'volumes/project/data.tar']
+    expected = hash_object()
+    expected.update(b'bb')
+    assert files['volumes/mounted/source/sub/b.txt'] == {'digest': expected.hexdigest(), 'size': 2}
+
+    verify_dump(SimpleNamespace(options={'source': path}))
+
+
+def test_verify_detects_alterations(temp_dir):
+    path, _ = make_dump('folder', temp_dir)
+    (path / 'volumes' / 'mounted' / 'source' / 'a.txt').write_text('b')
+    with raises(SystemExit):
+        verify_dump(SimpleNamespace(options={'source': path}))
+
+
+@mark.parametrize('altered', (False, True))
+def test_verify_combined_archive(altered, temp_dir):
+    target = temp_dir / 'all.tar'
+    shared_storage = ArchiveStorage(SimpleNamespace(options={'target': target, 'compression': 'tar'}))
+    lock = Lock()
+    for name in ('one', 'two'):
+        ctx = SimpleNamespace(
+            options={'target_pattern': '{name}', 'project_name': name, 'project_dir': temp_dir / name},
+            manifest={'meta': {'invocation_time': '2017-01-01T00:00:00', 'host': 'host'}},
+            shared_storage=shared_storage, shared_lock=lock)
+        project_storage = NamespacedStorage(ctx)
+        project_storage.write_file(iter([name.encode()]), 'data.tar', namespace='volumes/project')
+        checksums = project_storage.checksums
+        if altered and name == 'two':
+            checksums['volumes/project/data.tar'] = {'digest': hash_object().hexdigest(), 'size': 3}
+        manifest = json.loads(json.dumps({'checksums': summarize_checksums(checksums)}))
+        project_storage.write_file(yaml.dump(manifest), MANIFEST_NAME)
+        project_storage.finalize()
+    shared_storage.finalize()
+
+    if altered:
+        with raises(SystemExit):
+            verify_dump(SimpleNamespace(options={'source': target}))
+    else:
+        verify_dump(SimpleNamespace(options={'source': target}))
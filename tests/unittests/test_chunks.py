@@ -0,0 +1,48 @@
+import json
+import os
+from types import SimpleNamespace
+
+from compose_dump.chunks import MAX_CHUNK_SIZE, MIN_CHUNK_SIZE, split_chunks
+from compose_dump.storage import ChunkStorage
+
+
+def test_split_chunks_resynchronizes():
+    data = os.urandom(8 * 1024 ** 2)
+    chunks = list(split_chunks(data[i:i + 65536] for i in range(0, len(data), 65536)))
+    assert b''.join(chunks) == data
+    assert all(MIN_CHUNK_SIZE <= len(x) <= MAX_CHUNK_SIZE for x in chunks[:-1])
+
+    # inserted data only affects the chunks around it, also when it's not aligned to tar's blocks
+    shifted = data[:1024 ** 2 + 100] + os.urandom(777) + data[1024 ** 2 + 100:]
+    shifted_chunks = list(split_chunks([shifted]))
+    assert b''.join(shifted_chunks) == shifted
+    assert len(set(chunks) & set(shifted_chunks)) >= len(chunks) - 3
+
+
+def make_ctx(target, name):
+    return SimpleNamespace(
+        manifest={'meta': {'invocation_time': name, 'host': 'host'}},
+        options={'target': target, 'target_pattern': '{isodate}', 'project_name': 'project',
+                 'project_dir': '/project'})
+
+
+def test_chunk_storage_deduplicates(temp_dir):
+    data = os.urandom(3 * 1024 ** 2)
+    for name in ('first', 'second'):
+        ctx = make_ctx(temp_dir, name)
+        storage = ChunkStorage(ctx)
+        storage.write_file(iter([data]), 'volume.tar', namespace='volumes/project')
+        storage.write_file('manifest', 'Manifest.yml')
+        storage.finalize()
+        assert ctx.manifest['meta']['index'] == 'Index.json'
+        if name == 'first':
+            assert storage.written_bytes == len(data)
+        else:
+            assert storage.written_bytes == 0
+
+    dump_path = temp_dir / 'dumps' / 'second'
+    assert (dump_path / 'Manifest.yml').read_text() == 'manifest'
+    with (dump_path / 'Index.json').open() as f:
+        entry = json.load(f)['volumes/project/volume.tar']
+    assert entry['size'] == len(data)
+    assert b''.join(storage.repository.get(x) for x in entry['chunks']) == data
@@ -0,0 +1,109 @@
+import io
+import os
+from types import SimpleNamespace
+
+from pytest import importorskip, raises
+
+from compose_dump.reader import open_dump
+from compose_dump.storage import ArchiveStorage
+
+importorskip('cryptography')
+from compose_dump.encryption import DecryptingReader, ENCRYPTION_CHUNK_SIZE, ENCRYPTION_MAGIC, EncryptingWriter, \
+    SALT_SIZE, TAG_SIZE  # noqa: E402
+
+
+def test_encryption_roundtrip():
+    data = os.urandom(3 * ENCRYPTION_CHUNK_SIZE + 100)
+    output = io.BytesIO()
+    writer = EncryptingWriter(output, b'secret')
+    writer.write(data[:1000])
+    # e.g. at a checkpoint
+    writer.flush()
+    writer.write(data[1000:])
+    writer.close()
+    assert data[:1000] not in output.getvalue()
+
+    assert DecryptingReader(io.BytesIO(output.getvalue()), b'secret').read() == data
+    with raises(SystemExit):
+        DecryptingReader(io.BytesIO(output.getvalue()), b'wrong').read()
+    # a truncation at a chunk's boundary
+    with raises(SystemExit):
+        DecryptingReader(io.BytesIO(output.getvalue()[:-16 - 4 - 100]), b'secret').read()
+
+
+def test_altered_header_is_rejected():
+    output = io.BytesIO()
+    writer = EncryptingWriter(output, b'secret')
+    writer.write(b'data')
+    writer.close()
+    data = output.getvalue()
+    parameters = len(ENCRYPTION_MAGIC) + SALT_SIZE
+
+    # parameters of scrypt that would take excessive memory aren't used to derive a key
+    with raises(SystemExit):
+        DecryptingReader(io.BytesIO(data[:parameters] + bytes((60, 255, 255)) + data[parameters + 3:]), b'secret')
+    with raises(SystemExit):
+        DecryptingReader(io.BytesIO(data[:parameters - 1] + b'\0' + data[parameters:]), b'secret').read()
+
+
+def test_resumed_encryption_uses_new_keys():
+    interrupted_output = io.BytesIO()
+    interrupted_writer = EncryptingWriter(interrupted_output, b'secret')
+    interrupted_writer.write(b'a' * 1000)
+    interrupted_writer.flush()
+    state, position = interrupted_writer.state(), interrupted_output.tell()
+    # the interrupted run encrypted more data beyond the checkpoint
+    interrupted_writer.write(bytes(ENCRYPTION_CHUNK_SIZE))
+    interrupted_writer.flush()
+    interrupted = interrupted_output.getvalue()[position:]
+
+    resumed = []
+    for _ in range(2):
+        output = io.BytesIO(interrupted_output.getvalue()[:position])
+        output.seek(position)
+        writer = EncryptingWriter(output, b'secret', state)
+        writer.write(bytes(ENCRYPTION_CHUNK_SIZE))
+        writer.close()
+        resumed.append(output.getvalue())
+        assert DecryptingReader(io.BytesIO(output.getvalue()), b'secret').read() == \
+            b'a' * 1000 + bytes(ENCRYPTION_CHUNK_SIZE)
+    # the same plaintext is encrypted with different keystreams
+    ciphertexts = [interrupted[4:4 + 100]] + [x[position + 20 + 4:position + 20 + 4 + 100] for x in resumed]
+    assert len(set(ciphertexts)) == 3
+
+    # the chunks of a previous segment can't be dropped
+    with raises(SystemExit):
+        DecryptingReader(io.BytesIO(resumed[0][:position - 4 - 1000 - TAG_SIZE] + resumed[0][position:]),
+                         b'secret').read()
+
+
+def test_encrypted_split_archive_is_resumed(temp_dir):
+    key_file = temp_dir / 'key'
+    key_file.write_text('secret\n')
+    target = temp_dir / 'dumps' / 'dump.tar.xz'
+    target.parent.mkdir()
+    volumes = [('%i.tar' % x, os.urandom(50000)) for x in range(3)]
+
+    def make_storage(resume):
+        ctx = SimpleNamespace(options={'target': target, 'compression': 'xz', 'split_size': 8192,
+                                       'project_name': 'project', 'resume': resume, 'encryption_key_file': key_file})
+        return ArchiveStorage(ctx)
+
+    archive_storage = make_storage(resume=False)
+    for name, data in volumes[:2]:
+        archive_storage.write_file(data, name, namespace='volumes/project')
+    archive_storage.encryptor.write(os.urandom(20000))
+    archive_storage.output.close()
+
+    archive_storage = make_storage(resume=True)
+    for name, data in volumes:
+        archive_storage.write_file(data, name, namespace='volumes/project')
+    archive_storage.finalize()
+
+    with open_dump(target, key_file) as dump:
+        assert {x.name: x.open().read() for x in dump} == {'volumes/project/' + x: y for x, y in volumes}
+    key_file.write_text('other')
+    with raises(SystemExit), open_dump(target, key_file) as dump:
+        list(dump)
+    with raises(SystemExit), open_dump(target) as dump:
+        list(dump)
@@ -0,0 +1,55 @@
+from pathlib import PurePath
+
+from pytest import mark
+
+from compose_dump.exclusions import Exclusions, read_exclusions
+from compose_dump.treewalk import scan_tree
+
+
+@mark.parametrize('patterns,name,excluded', (
+    (['*.log'], 'app.log', True),
+    (['*.log'], 'logs/app.log', False),
+    (['**/*.log'], 'logs/app.log', True),
+    (['**/*.log'], 'app.log', True),
+    (['/node_modules'], 'node_modules/left-pad/index.js', True),
+    (['cache/*/tmp'], 'cache/a/tmp', True),
+    (['cache/*/tmp'], 'cache/a/b/tmp', False),
+    (['file?.txt'], 'file1.txt', True),
+    (['file[0-2].txt'], 'file3.txt', False),
+    (['file[^0-2].txt'], 'file3.txt', True),
+    (['*.md', '!README.md'], 'README.md', False),
+    (['*.md', '!README.md'], 'CHANGES.md', True),
+    (['!README.md', '*.md'], 'README.md', True),
+    (['# *.md', ''], 'README.md', False),
+))
+def test_exclusions(patterns, name, excluded):
+    assert Exclusions(patterns).excludes(name) is excluded
+
+
+def test_may_include_below():
+    exclusions = Exclusions(['data', '!data/keep/*.json'])
+    assert exclusions.may_include_below('data')
+    assert exclusions.may_include_below('data/keep')
+    assert not exclusions.may_include_below('data/other')
+    assert Exclusions(['data', '!**/*.json']).may_include_below('data/other')
+
+
+def test_scan_tree_prunes_excluded_folders(temp_dir):
+    for name in ('.git/objects/aa', 'data/keep', 'data/other', 'src'):
+        (temp_dir / name).mkdir(parents=True)
+    (temp_dir / '.backupignore').write_text('.git\ndata\n!data/keep/*.json\n**/*.pyc\n')
+    (temp_dir / '.git' / 'objects' / 'aa' / 'bb').write_bytes(b'x')
+    (temp_dir / 'data' / 'keep' / 'a.json').write_bytes(b'{}')
+    (temp_dir / 'data' / 'keep' / 'b.bin').write_bytes(b'12345')
+    (temp_dir / 'data' / 'other' / 'c.json').write_bytes(b'{}')
+    (temp_dir / 'src' / 'main.py').write_bytes(b'pass')
+    (temp_dir / 'src' / 'main.pyc').write_bytes(b'123')
+
+    exclusions = read_exclusions(temp_dir, ('.backupignore',))
+    names = [str(x[1]) for x in scan_tree(temp_dir, PurePath('root'), exclusions=exclusions)]
+    assert names == ['root', 'root/.backupignore', 'root/data', 'root/data/keep', 'root/data/keep/a.json',
+                     'root/src', 'root/src/main.py']
+    # .git, data/other, data/keep/b.bin and src/main.pyc
+    assert exclusions.paths == 4
+    assert exclusions.bytes == 8
+    assert read_exclusions(temp_dir, ('.dockerignore',)) is None
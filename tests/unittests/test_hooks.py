@@ -0,0 +1,78 @@
+from collections import OrderedDict
+from types import SimpleNamespace
+
+from pytest import raises
+
+from compose_dump.backup import is_replaced, store_dumps
+from compose_dump.hooks import demux_socket, exec_output, parse_hooks
+from compose_dump.metrics import Metrics
+from compose_dump.pausing import PauseScheduler
+from compose_dump.storage import FolderStorage
+from tests.utils import multiplex
+
+
+class FakeClient:
+    # executes the commands that are mapped to the frames of their output and an exit code
+    def __init__(self, results):
+        self.results = results
+        self.executed = {}
+
+    def exec_create(self, container, cmd):
+        exec_id = str(len(self.executed))
+        self.executed[exec_id] = (container, cmd)
+        return {'Id': exec_id}
+
+    def exec_start(self, exec_id, socket):
+        return multiplex(self.results[self.executed[exec_id][1][2]][0])
+
+    def exec_inspect(self, exec_id):
+        return {'ExitCode': self.results[self.executed[exec_id][1][2]][1]}
+
+
+def test_parse_hooks():
+    hooks = parse_hooks({'compose-dump.dump.db.sql': 'pg_dumpall', 'compose-dump.pre': 'sync',
+                         'compose-dump.replaces': '/var/lib/postgresql/data, /backup', 'other': 'label'})
+    assert hooks.dumps == {'db.sql': 'pg_dumpall'}
+    assert (hooks.pre, hooks.post) == ('sync', None)
+    assert '/var/lib/postgresql/data/' in hooks.replaces and '/backup' in hooks.replaces
+    assert parse_hooks(['compose-dump.post=echo done']).post == 'echo done'
+    assert parse_hooks({'other': 'label'}) is None
+    assert parse_hooks(None) is None
+
+
+def test_demux_socket():
+    frames = [(b'spam', None), (None, b'warning'), (b'x' * 100000, None)]
+    sock = multiplex(frames)
+    result = list(demux_socket(sock))
+    assert result[:2] == frames[:2]
+    assert b''.join(x for x, _ in result[2:]) == b'x' * 100000
+    assert sock.closed
+
+
+def test_exec_output():
+    client = FakeClient({'dump': ([(b'spam', None), (None, b'warning'), (b'eggs', None)], 0),
+                         'fail': ([(b'partial', None), (None, b'no such database')], 1)})
+    assert b''.join(exec_output(client, 'id', 'dump', 'The dump')) == b'spameggs'
+    assert client.executed['0'] == ('id', ['sh', '-c', 'dump'])
+    with raises(SystemExit):
+        list(exec_output(client, 'id', 'fail', 'The dump'))
+
+
+def test_store_dumps(temp_dir):
+    client = FakeClient({'pg_dumpall': ([(b'SELECT 1;', None)], 0), 'redis-cli --rdb -': ([(b'REDIS', None)], 0)})
+    hooks = OrderedDict()
+    for service, name, command in (('db', 'all.sql', 'pg_dumpall'), ('cache', 'dump.rdb', 'redis-cli --rdb -')):
+        hooks[service] = parse_hooks({'compose-dump.dump.' + name: command, 'compose-dump.replaces': '/data'})
+        hooks[service].container = SimpleNamespace(id=service + '_1')
+    ctx = SimpleNamespace(options={'target': temp_dir / 'dump', 'jobs': 1, 'no_pause': True, 'services': ()},
+                          manifest=OrderedDict(), metrics=Metrics(), hooks=hooks,
+                          project=SimpleNamespace(client=client))
+    ctx.pauses = PauseScheduler(ctx)
+    ctx.storage = FolderStorage(ctx)
+    store_dumps(ctx)
+
+    assert (temp_dir / 'dump' / 'dumps' / 'db' / 'all.sql').read_bytes() == b'SELECT 1;'
+    assert (temp_dir / 'dump' / 'dumps' / 'cache' / 'dump.rdb').read_bytes() == b'REDIS'
+    assert ctx.manifest['dumps'] == {'db': {'all.sql': 'all.sql'}, 'cache': {'dump.rdb': 'dump.rdb'}}
+    assert [x.kind for x in ctx.metrics.operations] == ['dump', 'dump']
+    assert is_replaced(ctx, 'db', '/data') and not is_replaced(ctx, 'web', '/data')
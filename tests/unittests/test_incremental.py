@@ -0,0 +1,103 @@
+import io
+import os
+from pathlib import Path
+import tarfile
+
+from pytest import mark
+
+from compose_dump.incremental import find_previous_dump, is_unchanged, set_stored_digests, walk_entries
+from compose_dump.reader import MANIFEST_NAME
+from compose_dump.tarstream import scan_archive
+
+
+def make_archive(files, format):
+    result = io.BytesIO()
+    with tarfile.open(fileobj=result, mode='w', format=format) as archive:
+        for name, (content, mtime) in files.items():
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(content)
+            tarinfo.mtime = mtime
+            archive.addfile(tarinfo, io.BytesIO(content))
+    return result.getvalue()
+
+
+def chunked(data, size=333):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+@mark.parametrize('format', (tarfile.GNU_FORMAT, tarfile.PAX_FORMAT))
+def test_scan_archive(format):
+    long_name = 'deeply/' + 'nested' * 30
+    files = {'spam': (b'spam' * 1000, 1), long_name: (b'ham', 2), 'touched': (b'eggs', 3), 'gone': (b'', 4)}
+    data = make_archive(files, format)
+    members = {}
+    assert b''.join(scan_archive(chunked(data), members)) == data
+    assert set(members) == set(files)
+    assert all(x['stored'] for x in members.values())
+
+    files['spam'] = (b'changed', 5)
+    files['touched'] = (b'eggs', 6)
+    files['new'] = (b'new', 7)
+    del files['gone']
+    data = make_archive(files, format)
+    current = {}
+    delta = b''.join(scan_archive(chunked(data), current, members))
+
+    with tarfile.open(fileobj=io.BytesIO(delta)) as archive:
+        assert archive.getnames() == ['spam', 'new']
+        assert archive.extractfile('spam').read() == b'changed'
+    assert set(current) == set(files)
+    assert current['touched']['digest'] == members['touched']['digest']
+    assert not current[long_name]['stored']
+
+
+def test_walk_entries_and_changes(temp_dir):
+    (temp_dir / 'folder').mkdir()
+    (temp_dir / 'folder' / 'file').write_bytes(b'content')
+    (temp_dir / 'link').symlink_to('folder')
+
+    entries = {str(name): (path, entry) for path, name, entry in walk_entries(temp_dir, Path('root'))}
+    assert sorted(entries) == ['root', 'root/folder', 'root/folder/file', 'root/link']
+    assert entries['root/link'][1] == {'type': 'symlink', 'linkname': 'folder'}
+
+    path, entry = entries['root/folder/file']
+    assert not is_unchanged(path, entry, None)
+    set_stored_digests({}, [(path, 'file', entry)])
+    previous = dict(entry)
+    assert is_unchanged(path, entry, previous)
+
+    # a touched file with the same content is unchanged
+    os.utime(str(path), (1, 1))
+    entry = next(x for _, n, x in walk_entries(path, Path('file')))
+    assert is_unchanged(path, entry, previous)
+    assert entry['digest'] == previous['digest']
+
+    # a changed file of the same size and modification time is only detected by its hash
+    path.write_bytes(b'CONTENT')
+    os.utime(str(path), (previous['mtime'], previous['mtime']))
+    entry = next(x for _, n, x in walk_entries(path, Path('file')))
+    assert not is_unchanged(path, entry, previous)
+    assert entry['digest'] != previous['digest']
+    entry = next(x for _, n, x in walk_entries(path, Path('file')))
+    assert is_unchanged(path, entry, previous, trust_mtime=True)
+    assert entry['digest'] == previous['digest']
+
+    path.write_bytes(b'CONTENT!')
+    entry = next(x for _, n, x in walk_entries(path, Path('file')))
+    assert not is_unchanged(path, entry, previous)
+
+    # the digests of stored files are taken from the storage's checksums
+    set_stored_digests({'file': {'digest': 'stored', 'size': 8}}, [(path, 'file', entry)])
+    assert entry['digest'] == 'stored'
+
+
+def test_find_previous_dump(temp_dir):
+    for name, project_name, mtime in (('a', 'spam', 1), ('b', 'ham', 3), ('c', 'spam', 2), ('d', None, 4)):
+        (temp_dir / name).mkdir()
+        if project_name is None:
+            continue
+        manifest = temp_dir / name / MANIFEST_NAME
+        manifest.write_text('meta:\n  options:\n    project_name: %s\n' % project_name)
+        os.utime(str(manifest), (mtime, mtime))
+    assert find_previous_dump(temp_dir, 'spam')[0] == temp_dir / 'c'
+    assert find_previous_dump(temp_dir, 'eggs') is None
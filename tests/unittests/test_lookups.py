@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+from compose.service import NoSuchImageError
+from docker.errors import ImageNotFound
+from pytest import raises
+
+from compose_dump.lookups import DockerLookups
+
+
+def make_summary(id, project, service, one_off=False, state='running', mounts=(('my-project_data', '/data'),)):
+    return {'Id': id, 'Image': 'image', 'Names': ['/%s_%s_1' % (project, service)], 'State': state,
+            'Labels': {'com.docker.compose.project': project, 'com.docker.compose.service': service,
+                       'com.docker.compose.oneoff': 'True' if one_off else 'False'},
+            'Mounts': [{'Type': 'volume', 'Name': x, 'Destination': y} for x, y in mounts]}
+
+
+class RecordingClient:
+    def __init__(self, summaries=None):
+        self.requests = []
+        self.summaries = summaries or [
+            make_summary('a1', 'my-project', 'app', one_off=True), make_summary('a2', 'my-project', 'app'),
+            make_summary('b1', 'myproject', 'db', state='exited'), make_summary('c1', 'other', 'app')]
+
+    def containers(self, all=False, filters=None):
+        self.requests.append('containers')
+        return self.summaries
+
+    def volumes(self):
+        self.requests.append('volumes')
+        return {'Volumes': [{'Name': 'my-project_data'}]}
+
+    def inspect_image(self, name):
+        self.requests.append('image ' + name)
+        if name == 'missing':
+            raise ImageNotFound(name)
+        return {'Config': {'Volumes': None}}
+
+
+def test_lookups_are_served_from_one_listing():
+    client = RecordingClient()
+    services = [SimpleNamespace(name=x, image_name=y, options={}) for x, y in
+                (('app', 'app'), ('db', 'db'), ('worker', 'app'), ('cache', 'missing'))]
+    project = SimpleNamespace(name='my-project', client=client, services=services)
+    lookups = DockerLookups(project, ['app', 'db', 'worker', 'cache'])
+
+    assert lookups.container_for_service('app').id == 'a2'
+    # the project's name before docker-compose 1.21
+    assert lookups.container_for_service('db').id == 'b1'
+    assert lookups.container_for_service('worker') is None
+    assert lookups.is_running(lookups.container_for_service('app'))
+    assert not lookups.is_running(lookups.container_for_service('db'))
+    assert lookups.mounts(lookups.container_for_service('app'))[0]['Destination'] == '/data'
+
+    assert lookups.volume_exists(SimpleNamespace(full_name='my-project_data'))
+    assert not lookups.volume_exists(SimpleNamespace(full_name='my-project_cache'))
+
+    assert lookups.image(services[0]) is lookups.image(services[2])
+    with raises(NoSuchImageError):
+        lookups.image(services[3])
+    assert sorted(client.requests) == ['containers', 'image app', 'image db', 'image missing', 'volumes']
+
+
+def test_containers_with_volume():
+    client = RecordingClient([
+        make_summary('app1', 'my-project', 'app', mounts=(('my-project_data', '/srv/data'), ('logs', '/logs'))),
+        make_summary('app2', 'my-project', 'app', mounts=(('my-project_data', '/srv/data'), ('logs', '/logs'))),
+        # mounts the volume with volumes_from
+        make_summary('backup1', 'my-project', 'backup', mounts=(('custom-name', '/custom'),
+                                                                ('my-project_data', '/srv/data'))),
+        make_summary('migrate1', 'my-project', 'migrate', state='exited', mounts=(('my-project_data', '/var'),))])
+    lookups = DockerLookups(SimpleNamespace(name='my-project', client=client, services=[]), [])
+    data, custom = SimpleNamespace(full_name='my-project_data'), SimpleNamespace(full_name='custom-name')
+
+    assert lookups.services_using_volume(data) == ['app', 'backup', 'migrate']
+    # stopped containers are preferred, otherwise the running ones take turns
+    assert lookups.container_with_volume(data) == (lookups.container_for_service('migrate'), '/var')
+    assert lookups.container_with_volume(data)[0].id == 'migrate1'
+    logs = SimpleNamespace(full_name='logs')
+    assert [lookups.container_with_volume(logs)[0].id for _ in range(3)] == ['app1', 'app2', 'app1']
+    assert lookups.container_with_volume(custom)[1] == '/custom'
+    assert lookups.container_with_volume(SimpleNamespace(full_name='my-project_cache')) == (None, None)
+    assert client.requests == ['containers']
@@ -0,0 +1,101 @@
+import io
+import os
+from types import SimpleNamespace
+
+from pytest import fixture, raises
+
+from compose_dump import objectstore, storage
+from compose_dump.objectstore import MultipartUpload, S3Client, signature
+from compose_dump.storage import S3Storage
+from compose_dump.streams import read_archive
+from tests.s3_standin import S3StandIn
+
+
+@fixture
+def standin(monkeypatch):
+    monkeypatch.setattr(objectstore, 'RETRY_DELAY', 0)
+    with S3StandIn() as standin:
+        yield standin
+
+
+def make_client(standin):
+    return S3Client(standin.endpoint, standin.region, standin.access_key, standin.secret_key)
+
+
+def test_signature():
+    # the example of a signed GET request in AWS' documentation
+    payload_hash = 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+    headers = {'host': 'examplebucket.s3.amazonaws.com', 'range': 'bytes=0-9',
+               'x-amz-content-sha256': payload_hash, 'x-amz-date': '20130524T000000Z'}
+    assert signature('GET', '/test.txt', '', headers, payload_hash, 'wJalrXUtnFEMI/K7MDENG/bPxRfiCYEXAMPLEKEY',
+                     'us-east-1', '20130524T000000Z') == \
+        'f0e8bdb87c964420e857bd35b5d6ed310bd44f0170aba48dd91039c6036bdb41'
+
+
+def test_multipart_upload_retries_failed_parts(standin):
+    data = os.urandom(10 * 1000)
+    standin.failing_parts.update((2, 5))
+    upload = MultipartUpload(make_client(standin), 'bucket', 'path/dump.tar', part_size=1000, threads=3)
+    for offset in range(0, len(data), 700):
+        upload.write(data[offset:offset + 700])
+    upload.complete()
+    upload.close()
+
+    assert standin.objects[('bucket', 'path/dump.tar')] == data
+    assert not standin.failing_parts and not standin.uploads
+
+
+def test_small_upload_is_a_simple_object(standin):
+    upload = MultipartUpload(make_client(standin), 'bucket', 'dump.tar', part_size=1000)
+    upload.write(b'spam')
+    upload.complete()
+    upload.close()
+    assert standin.objects == {('bucket', 'dump.tar'): b'spam'}
+
+
+def test_incomplete_upload_is_aborted(standin):
+    upload = MultipartUpload(make_client(standin), 'bucket', 'dump.tar', part_size=1000)
+    upload.write(bytes(2500))
+    upload.close()
+    assert standin.aborted == ['dump.tar']
+    assert not standin.objects and not standin.uploads
+
+
+def test_wrong_credentials_fail(standin):
+    client = S3Client(standin.endpoint, standin.region, standin.access_key, 'wrong')
+    with raises(SystemExit):
+        client.request('PUT', 'bucket', 'dump.tar', data=b'spam')
+
+
+def make_s3_storage(standin, monkeypatch, compression='gz', part_size=8192):
+    monkeypatch.setattr(storage, 'MIN_UPLOAD_PART_SIZE', 1024)
+    for name, value in (('AWS_ACCESS_KEY_ID', standin.access_key), ('AWS_SECRET_ACCESS_KEY', standin.secret_key),
+                        ('AWS_REGION', standin.region)):
+        monkeypatch.setenv(name, value)
+    ctx = SimpleNamespace(options={'target': 's3://bucket/dumps', 'compression': compression,
+                                   'target_pattern': '{name}', 'project_name': 'project', 'project_dir': '/project',
+                                   's3_endpoint': standin.endpoint, 'upload_part_size': part_size},
+                          manifest={'meta': {'invocation_time': '2017-01-01T00:00:00', 'host': 'host'}})
+    return S3Storage(ctx)
+
+
+def test_s3_storage(standin, monkeypatch):
+    data = os.urandom(100000)
+    s3_storage = make_s3_storage(standin, monkeypatch)
+    s3_storage.write_file(data, 'data.tar', namespace='volumes/project')
+    s3_storage.write_file('manifest', 'Manifest.yml')
+    s3_storage.finalize()
+
+    with read_archive(io.BytesIO(standin.objects[('bucket', 'dumps/project.tar.gz')])) as archive:
+        member = next(iter(archive))
+        assert member.name == 'volumes/project/data.tar'
+        assert archive.extractfile(member).read() == data
+
+
+def test_s3_storage_aborts_upload_of_failed_dump(standin, monkeypatch):
+    s3_storage = make_s3_storage(standin, monkeypatch, compression='tar', part_size=1024 ** 2)
+    # more than the writer's buffers hold
+    s3_storage.write_file(os.urandom(10 * 1024 ** 2), 'data.tar', namespace='volumes/project')
+    s3_storage.abort()
+    assert standin.aborted == ['dumps/project.tar']
+    assert not standin.objects and not standin.uploads
@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+
+from pytest import raises
+
+from compose_dump.pausing import PauseScheduler
+
+
+class RecordingProject:
+    def __init__(self):
+        self.calls = []
+
+    def pause(self, service_names):
+        self.calls.append(('pause', service_names))
+
+    def unpause(self, service_names):
+        self.calls.append(('unpause', service_names))
+
+
+def make_scheduler(mode):
+    ctx = SimpleNamespace(options={'no_pause': False, 'pause_mode': mode, 'services': ('db', 'web')},
+                          project=RecordingProject())
+    return PauseScheduler(ctx)
+
+
+def test_project_mode():
+    scheduler = make_scheduler('project')
+    with scheduler.project_window():
+        with scheduler.volume_window(['db']):
+            pass
+    assert scheduler.project.calls == [('pause', ['db', 'web']), ('unpause', ['db', 'web'])]
+    assert list(scheduler.downtimes) == ['db', 'web']
+
+
+def test_volume_mode_with_overlapping_windows():
+    scheduler = make_scheduler('volume')
+    with scheduler.project_window():
+        scheduler.pause(['db'])
+        scheduler.pause(['db', 'web'])
+        scheduler.unpause(['db'])
+        scheduler.unpause(['db', 'web'])
+        with scheduler.volume_window([]):
+            pass
+    assert scheduler.project.calls == [('pause', ['db']), ('pause', ['web']), ('unpause', ['db', 'web'])]
+    assert list(scheduler.downtimes) == ['db', 'web']
+
+
+def test_paused_time_covers_overlapping_pauses():
+    scheduler = make_scheduler('volume')
+    scheduler.pause(['db'])
+    scheduler.pause(['web'])
+    scheduler.unpause(['db'])
+    assert scheduler.paused_time() > 0
+    scheduler.unpause(['web'])
+    paused_time = scheduler.paused_time()
+    assert paused_time == scheduler._paused_time
+    assert paused_time >= max(scheduler._downtimes.values())
+
+
+def test_failed_pause_is_not_counted():
+    scheduler = make_scheduler('volume')
+
+    def fail(service_names):
+        raise RuntimeError
+
+    scheduler.project.pause = fail
+    with raises(RuntimeError):
+        with scheduler.volume_window(['db']):
+            pass
+    assert not +scheduler.references
+    assert scheduler.paused_time() == 0
+    del scheduler.project.pause
+    with scheduler.volume_window(['db']):
+        pass
+    assert scheduler.project.calls == [('pause', ['db']), ('unpause', ['db'])]
@@ -0,0 +1,95 @@
+import json
+import os
+from types import SimpleNamespace
+
+from pytest import mark
+import yaml
+
+from compose_dump.restore import restore_dump
+from compose_dump.storage import ArchiveStorage
+
+
+def write_dump(path, files, inventory, since=None):
+    ctx = SimpleNamespace(options={'target': path, 'compression': 'gz'})
+    storage = ArchiveStorage(ctx)
+    for name, content in files.items():
+        storage.write_file(content, name)
+    manifest = {'meta': {'invocation_time': '2018-01-01T00:00:00', 'since': since}, 'volumes': {}}
+    storage.write_file(json.dumps(inventory), 'Inventory.json')
+    storage.write_file(yaml.dump(manifest), 'Manifest.yml')
+    storage.finalize()
+
+
+def file_entry(stored):
+    return {'type': 'file', 'size': 0, 'mtime': 0, 'stored': stored, 'digest': 'x'}
+
+
+@mark.parametrize('from_stdin', (False, True))
+def test_restore_incremental_chain(temp_dir, from_stdin, monkeypatch):
+    base, delta, project_dir = temp_dir / 'base.tar.gz', temp_dir / 'delta.tar.gz', temp_dir / 'project'
+    project_dir.mkdir()
+    write_dump(base, {'config/docker-compose.yml': 'old', 'volumes/mounted/data/a': 'a', 'volumes/mounted/data/b': 'b'},
+               {'mounted': {'data': {'type': 'dir'}, 'data/a': file_entry(True), 'data/b': file_entry(True)},
+                'volumes': {}})
+    write_dump(delta, {'config/docker-compose.yml': 'new', 'volumes/mounted/data/b': 'B'},
+               {'mounted': {'data': {'type': 'dir'}, 'data/a': file_entry(False), 'data/b': file_entry(True),
+                            'data/link': {'type': 'symlink', 'linkname': 'b'}},
+                'volumes': {}},
+               since={'path': str(base), 'invocation_time': '2018-01-01T00:00:00'})
+
+    if from_stdin:
+        stdin = SimpleNamespace(buffer=delta.open('rb'))
+        monkeypatch.setattr('sys.stdin', stdin)
+    ctx = SimpleNamespace(options={'source': None if from_stdin else delta, 'scopes': ('config', 'mounted'),
+                                   'project_dir': project_dir, 'jobs': 1})
+    restore_dump(ctx)
+
+    assert (project_dir / 'docker-compose.yml').read_text() == 'new'
+    assert (project_dir / 'data' / 'a').read_text() == 'a'
+    assert (project_dir / 'data' / 'b').read_text() == 'B'
+    assert (project_dir / 'data' / 'link').resolve() == project_dir / 'data' / 'b'
+
+
+def test_restore_stays_in_project_dir(temp_dir):
+    base, dump = temp_dir / 'base.tar.gz', temp_dir / 'dump.tar.gz'
+    project_dir, outside = temp_dir / 'project', temp_dir / 'outside'
+    project_dir.mkdir()
+    outside.mkdir()
+    (project_dir / 'link').symlink_to(outside)
+    write_dump(base, {}, {'mounted': {}, 'volumes': {}})
+    write_dump(dump, {'config/../escaped': 'x', 'config/link/escaped': 'x', 'config/docker-compose.yml': 'ok'},
+               {'mounted': {'../escaped': {'type': 'dir'}, '/escaped': {'type': 'dir'},
+                            'link/escaped': {'type': 'dir'}},
+                'volumes': {}},
+               since={'path': str(base), 'invocation_time': '2018-01-01T00:00:00'})
+
+    ctx = SimpleNamespace(options={'source': dump, 'scopes': ('config', 'mounted'), 'project_dir': project_dir,
+                                   'jobs': 1})
+    restore_dump(ctx)
+
+    assert (project_dir / 'docker-compose.yml').read_text() == 'ok'
+    assert not (temp_dir / 'escaped').exists()
+    assert not list(outside.iterdir())
+
+
+def test_restore_replaces_what_is_in_the_way(temp_dir):
+    base, dump = temp_dir / 'base.tar.gz', temp_dir / 'dump.tar.gz'
+    project_dir = temp_dir / 'project'
+    (project_dir / 'data' / 'folder').mkdir(parents=True)
+    (project_dir / 'data' / 'file').write_text('file')
+    (project_dir / 'data' / 'link').symlink_to('elsewhere')
+    (project_dir / 'data' / 'folder' / 'content').write_text('content')
+    write_dump(base, {}, {'mounted': {}, 'volumes': {}})
+    write_dump(dump, {}, {'mounted': {'data': {'type': 'dir'},
+                                      'data/file': {'type': 'symlink', 'linkname': 'target'},
+                                      'data/link': {'type': 'symlink', 'linkname': 'target'},
+                                      'data/folder': {'type': 'symlink', 'linkname': 'target'}},
+                          'volumes': {}},
+               since={'path': str(base), 'invocation_time': '2018-01-01T00:00:00'})
+
+    ctx = SimpleNamespace(options={'source': dump, 'scopes': ('mounted',), 'project_dir': project_dir, 'jobs': 1})
+    restore_dump(ctx)
+
+    assert os.readlink(str(project_dir / 'data' / 'file')) == 'target'
+    assert os.readlink(str(project_dir / 'data' / 'link')) == 'target'
+    assert (project_dir / 'data' / 'folder' / 'content').read_text() == 'content'
@@ -0,0 +1,78 @@
+from collections import OrderedDict
+import sys
+from types import SimpleNamespace
+
+from compose_dump.backup import store_mounted_volumes, take_snapshots
+from compose_dump.metrics import Metrics
+from compose_dump.pausing import PauseScheduler
+from compose_dump.snapshots import CommandSnapshotter
+from compose_dump.storage import FolderStorage
+
+# a stand-in for a snapshot facility that copies the folder and records the calls
+FAKE_COMMAND = """
+import shutil, sys
+with open(sys.argv[1], 'at') as f:
+    f.write(' '.join(sys.argv[2:4]) + '\\n')
+if sys.argv[2] == 'create':
+    shutil.copytree(sys.argv[3], sys.argv[3] + '.snapshot')
+    print(sys.argv[3] + '.snapshot')
+else:
+    shutil.rmtree(sys.argv[4])
+"""
+
+
+class RecordingProject:
+    def __init__(self, path, calls):
+        volume = SimpleNamespace(external=str(path), internal='/data')
+        self.services = [SimpleNamespace(name='app', options={'volumes': [volume]})]
+        self.calls = calls
+
+    def pause(self, service_names):
+        self.calls.append('pause ' + ' '.join(service_names))
+
+    def unpause(self, service_names):
+        self.calls.append('unpause ' + ' '.join(service_names))
+
+
+def make_command(temp_dir):
+    script = temp_dir / 'fake_snapshot.py'
+    script.write_text(FAKE_COMMAND)
+    return '%s %s %s' % (sys.executable, script, temp_dir / 'calls')
+
+
+def test_command_snapshotter(temp_dir):
+    (temp_dir / 'data').mkdir()
+    (temp_dir / 'data' / 'file').write_text('spam')
+    snapshotter = CommandSnapshotter(SimpleNamespace(options={'fs_snapshot_command': make_command(temp_dir)}))
+    snapshot = snapshotter.take(temp_dir / 'data')
+    assert (snapshot / 'file').read_text() == 'spam'
+    snapshotter.release(temp_dir / 'data', snapshot)
+    assert not snapshot.exists()
+
+
+def test_services_run_while_snapshots_are_stored(temp_dir):
+    project_dir = temp_dir / 'project'
+    data = project_dir / 'data'
+    data.mkdir(parents=True)
+    (data / 'file').write_text('spam')
+    calls = []
+    options = {'no_pause': False, 'pause_mode': 'volume', 'services': ('app',), 'project_dir': project_dir,
+               'target': temp_dir / 'dump', 'fs_snapshot_command': make_command(temp_dir)}
+    ctx = SimpleNamespace(options=options, project=RecordingProject(data, calls), metrics=Metrics(),
+                          manifest={'volumes': {'mounted': []}}, inventory=None)
+    ctx.pauses = PauseScheduler(ctx)
+    ctx.storage = FolderStorage(ctx)
+    ctx.snapshotter = CommandSnapshotter(ctx)
+
+    snapshots = OrderedDict()
+    take_snapshots(ctx, [str(data)], snapshots)
+    calls.append('store')
+    store_mounted_volumes(ctx, [str(data)], snapshots)
+    ctx.snapshotter.release(data, snapshots[data])
+
+    with (temp_dir / 'calls').open() as f:
+        calls[1:1] = ['command ' + x.strip() for x in f.readlines()[:1]]
+    assert calls == ['pause app', 'command create %s' % data, 'unpause app', 'store']
+    assert (temp_dir / 'dump' / 'volumes' / 'mounted' / 'data' / 'file').read_text() == 'spam'
+    assert ctx.manifest['volumes']['mounted'] == [data.relative_to(project_dir)]
+    assert not (project_dir / 'data.snapshot').exists()
@@ -0,0 +1,48 @@
+from subprocess import run, PIPE
+import sys
+from time import perf_counter
+
+from pytest import mark
+
+
+# exits like the console script and prints the names of all imported modules afterwards
+SCRIPT = """
+import sys
+from compose_dump.main import main
+sys.argv[1:] = %r
+try:
+    main()
+except SystemExit:
+    pass
+print(' '.join(sys.modules))
+"""
+HEAVY_MODULES = ('compose', 'docker', 'pkg_resources', 'requests', 'yaml')
+# the time that --version and --help may take in addition to a bare interpreter's startup
+MAX_OVERHEAD = 0.25
+
+
+def measure(*args):
+    # returns the shortest of a few runs' wall time
+    result = None
+    for _ in range(5):
+        start = perf_counter()
+        run((sys.executable,) + args, stdout=PIPE, stderr=PIPE, check=True)
+        elapsed = perf_counter() - start
+        result = elapsed if result is None else min(result, elapsed)
+    return result
+
+
+@mark.parametrize('args', (['--version'], ['--help'], ['backup', '--help'], ['restore', '--help'],
+                           ['verify', '--help']))
+def test_no_heavy_imports(args):
+    output = run((sys.executable, '-c', SCRIPT % args), stdout=PIPE, check=True).stdout.decode()
+    modules = set(output.splitlines()[-1].split())
+    assert not {x for x in modules if x.split('.')[0] in HEAVY_MODULES}
+
+
+@mark.parametrize('args', (['--version'], ['--help']))
+def test_startup_latency(args):
+    baseline = measure('-c', 'pass')
+    elapsed = measure('-c', SCRIPT % args)
+    assert elapsed - baseline < MAX_OVERHEAD, \
+        '%s took %.3fs more than a bare interpreter' % (' '.join(args), elapsed - baseline)
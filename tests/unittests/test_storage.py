@@ -0,0 +1,279 @@
+import io
+import os
+import tarfile
+from threading import Lock
+from types import SimpleNamespace
+
+from pytest import importorskip, mark, raises
+
+from compose_dump import storage, treewalk
+from compose_dump.metrics import Metrics
+from compose_dump.reader import open_dump
+from compose_dump.storage import ArchiveStorage, FolderStorage, NamespacedStorage, spool
+from compose_dump.streams import BackgroundWriter, read_archive
+
+
+def make_archive_ctx(target):
+    return SimpleNamespace(options={'target': target, 'compression': 'tar'})
+
+
+def test_spool_rolls_over_to_disk(monkeypatch):
+    monkeypatch.setattr(storage, 'SPOOL_MAX_SIZE', 1024)
+    buffer, size = spool(b'x' * 512 for _ in range(8))
+    assert size == 4096
+    assert buffer._rolled
+    assert buffer.read() == b'x' * 4096
+
+
+def test_archive_write_file_from_generator(temp_dir):
+    target = temp_dir / 'dump.tar'
+    archive_storage = ArchiveStorage(make_archive_ctx(target))
+    archive_storage.write_file((bytes([x]) * 1000 for x in range(3)), 'data.tar', namespace='volumes/project')
+    archive_storage.finalize()
+
+    with tarfile.open(str(target)) as archive:
+        member = archive.extractfile('volumes/project/data.tar')
+        assert member.read() == b'\x00' * 1000 + b'\x01' * 1000 + b'\x02' * 1000
+
+
+def test_background_writer():
+    data = os.urandom(10000)
+    output = io.BytesIO()
+    writer = BackgroundWriter(output, buffer_size=1000, buffers=2)
+    for offset in range(0, len(data), 300):
+        writer.write(data[offset:offset + 300])
+    writer.flush()
+    assert output.getvalue() == data
+    writer.close()
+
+    class FullDisk(io.BytesIO):
+        def write(self, data):
+            raise OSError('No space left on device')
+
+    writer = BackgroundWriter(FullDisk(), buffer_size=1000, buffers=2)
+    with raises(OSError):
+        for _ in range(10):
+            writer.write(bytes(1000))
+        writer.flush()
+
+
+@mark.parametrize('compression', ('bz2', 'gz', 'xz', 'zstd'))
+def test_archive_with_parallel_compression(compression, temp_dir):
+    if compression == 'zstd':
+        importorskip('zstandard')
+    data = os.urandom(1024) * 10 * 1024
+    ctx = make_archive_ctx(temp_dir / 'dump')
+    ctx.options.update({'compression': compression, 'compression_level': 1, 'compression_threads': 4})
+    archive_storage = ArchiveStorage(ctx)
+    archive_storage.write_file(iter([data]), 'data', namespace='volumes/project')
+    archive_storage.write_file('manifest', 'Manifest.yml')
+    archive_storage.finalize()
+
+    with (temp_dir / 'dump').open('rb') as f, read_archive(f) as archive:
+        members = iter(archive)
+        member = next(members)
+        assert member.name == 'volumes/project/data'
+        assert archive.extractfile(member).read() == data
+        assert next(members).name == 'Manifest.yml'
+
+
+def test_namespaced_storages_share_an_archive(temp_dir):
+    target = temp_dir / 'all.tar'
+    shared_storage = ArchiveStorage(make_archive_ctx(target))
+    lock = Lock()
+    for name in ('one', 'two'):
+        ctx = SimpleNamespace(
+            options={'target_pattern': '{name}', 'project_name': name, 'project_dir': temp_dir / name},
+            manifest={'meta': {'invocation_time': '2017-01-01T00:00:00', 'host': 'host'}},
+            shared_storage=shared_storage, shared_lock=lock)
+        project_storage = NamespacedStorage(ctx)
+        project_storage.write_file(iter([name.encode()]), 'data.tar', namespace='volumes/project')
+        project_storage.write_file('manifest', 'Manifest.yml')
+        project_storage.finalize()
+    shared_storage.finalize()
+
+    with tarfile.open(str(target)) as archive:
+        assert archive.getnames() == ['one/volumes/project/data.tar', 'one/Manifest.yml',
+                                      'two/volumes/project/data.tar', 'two/Manifest.yml']
+        assert archive.extractfile('two/volumes/project/data.tar').read() == b'two'
+
+
+def test_namespaced_storages_report_their_compressed_data(temp_dir):
+    target = temp_dir / 'all.tar.gz'
+    ctx = make_archive_ctx(target)
+    ctx.options['compression'] = 'gz'
+    shared_storage = ArchiveStorage(ctx)
+    lock = Lock()
+    project_storages = []
+    for name in ('one', 'two'):
+        ctx = SimpleNamespace(
+            options={'target_pattern': '{name}', 'project_name': name, 'project_dir': temp_dir / name},
+            manifest={'meta': {'invocation_time': '2017-01-01T00:00:00', 'host': 'host'}},
+            shared_storage=shared_storage, shared_lock=lock, metrics=Metrics())
+        project_storages.append(NamespacedStorage(ctx))
+    # the dumps add data alternately, the compressor holds it back for longer
+    for index, project_storage in enumerate(project_storages * 2):
+        project_storage.write_file(os.urandom(100000), 'data%i' % index)
+    for project_storage in project_storages:
+        project_storage.finalize()
+        project_storage.metrics.close()
+    shared_storage.finalize()
+
+    written = [x.metrics.bytes_written for x in project_storages]
+    assert all(x > 200000 for x in written)
+    assert sum(written) <= target.stat().st_size
+
+
+def test_interrupted_batch_aborts_combined_archive(temp_dir, monkeypatch):
+    from compose_dump import main
+
+    root = temp_dir / 'root'
+    for name in ('a', 'b', 'c'):
+        (root / name).mkdir(parents=True)
+        (root / name / 'docker-compose.yml').write_text('version: "2"\n')
+    calls = []
+
+    def backup_project(batch, project_dir):
+        if project_dir.name == 'b':
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(main, 'backup_project', backup_project)
+    for method in ('abort', 'finalize'):
+        monkeypatch.setattr(ArchiveStorage, method, lambda self, method=method: calls.append(method))
+    args = main.parse_cli_args(['backup-all', '--combined', '--root', str(root), '-t', str(temp_dir / 'all.tar')])
+    with raises(KeyboardInterrupt):
+        main.backup_all(args)
+    assert calls == ['abort']
+
+
+def test_archive_reports_to_metrics(temp_dir):
+    target = temp_dir / 'dump.tar.gz'
+    ctx = make_archive_ctx(target)
+    ctx.options['compression'] = 'gz'
+    ctx.metrics = metrics = Metrics()
+    archive_storage = ArchiveStorage(ctx)
+    with metrics.measure('volume', 'data') as operation:
+        archive_storage.write_file(os.urandom(100000), 'data')
+    archive_storage.finalize()
+
+    assert operation.bytes_read == 100000
+    assert metrics.bytes_written == target.stat().st_size
+
+
+def test_split_archive_is_resumed_from_checkpoint(temp_dir):
+    target = temp_dir / 'dump.tar.gz'
+    volumes = [('%i.tar' % x, os.urandom(10000)) for x in range(3)]
+
+    def make_storage(resume):
+        ctx = make_archive_ctx(target)
+        ctx.options.update({'compression': 'gz', 'split_size': 4096, 'project_name': 'project', 'resume': resume})
+        return ArchiveStorage(ctx)
+
+    archive_storage = make_storage(resume=False)
+    for name, data in volumes[:2]:
+        archive_storage.write_file(data, name, namespace='volumes/project')
+    # the run is interrupted while the last volume is written
+    archive_storage.stream.write(b'\x00' * 5000)
+    archive_storage.stream.flush()
+    archive_storage.output.close()
+
+    archive_storage = make_storage(resume=True)
+    assert archive_storage.is_stored('1.tar', namespace='volumes/project')
+    for name, data in volumes:
+        archive_storage.write_file(data, name, namespace='volumes/project')
+    archive_storage.write_file('manifest', 'Manifest.yml')
+    archive_storage.finalize()
+
+    parts = sorted(temp_dir.iterdir())
+    assert parts[0].name == 'dump.tar.gz.000' and len(parts) > 2
+    assert all(x.stat().st_size <= 4096 for x in parts)
+    assert sorted(archive_storage.checksums) == ['Manifest.yml'] + ['volumes/project/' + x for x, _ in volumes]
+    with open_dump(target) as dump:
+        contents = {x.name: x.open().read() for x in dump}
+    assert contents == dict([('Manifest.yml', b'manifest')] + [('volumes/project/' + x, y) for x, y in volumes])
+
+
+@mark.parametrize('split', (False, True))
+def test_archive_skips_its_own_files(temp_dir, split):
+    folder = temp_dir / 'folder'
+    folder.mkdir()
+    (folder / 'data').write_bytes(os.urandom(10000))
+    (folder / 'dump.tar.gz.bak').write_bytes(b'spam')
+    ctx = make_archive_ctx(folder / 'dump.tar.gz')
+    ctx.options.update({'compression': 'gz', 'project_name': 'project'})
+    if split:
+        ctx.options['split_size'] = 4096
+    archive_storage = ArchiveStorage(ctx)
+    archive_storage.write_file(os.urandom(10000), 'volume.tar')
+    if split:
+        archive_storage.checkpoint()
+    archive_storage.put_folder(folder, 'folder')
+    archive_storage.finalize()
+
+    with open_dump(folder / 'dump.tar.gz') as dump:
+        assert sorted(x.name for x in dump) == ['folder', 'folder/data', 'folder/dump.tar.gz.bak', 'volume.tar']
+
+
+def test_folder_snapshot_links_unchanged_files(temp_dir):
+    source = temp_dir / 'source'
+    (source / 'folder').mkdir(parents=True)
+    (source / 'folder' / 'unchanged').write_bytes(b'spam' * 1000)
+    (source / 'folder' / 'changed').write_bytes(b'ham')
+
+    def dump(name, snapshot_base=None):
+        ctx = SimpleNamespace(options={'target': temp_dir / name}, snapshot_base=snapshot_base)
+        folder_storage = FolderStorage(ctx)
+        folder_storage.put_folder(source, 'source', namespace='volumes/mounted')
+        folder_storage.write_file(b'eggs' * 1000, 'volume.tar', namespace='volumes/project')
+        folder_storage.finalize()
+        return folder_storage
+
+    first = dump('first')
+    os.utime(str(source / 'folder' / 'changed'), (0, 0))
+    second = dump('second', SimpleNamespace(path=first.root_path, checksums=first.checksums))
+
+    assert second.checksums == first.checksums
+    assert second.linked_files == 2
+    for name in ('volumes/mounted/source/folder/unchanged', 'volumes/project/volume.tar'):
+        first_file, second_file = first.root_path / name, second.root_path / name
+        assert second_file.read_bytes() == first_file.read_bytes()
+        # hardlinked unless the filesystem supports reflinks
+        assert second.reflinks or second_file.stat().st_ino == first_file.stat().st_ino
+    changed = 'volumes/mounted/source/folder/changed'
+    assert (second.root_path / changed).stat().st_ino != (first.root_path / changed).stat().st_ino
+    assert (second.root_path / changed).stat().st_mtime == 0
+
+
+def test_archive_members_keep_their_size_when_reading_fails(monkeypatch, temp_dir):
+    monkeypatch.setattr(treewalk, 'READAHEAD_MAX_SIZE', 0)
+    source = temp_dir / 'source'
+    source.mkdir()
+    for name in 'abc':
+        (source / name).write_bytes(name.encode() * 1000)
+
+    class FailingReader(io.BytesIO):
+        def read(self, size=-1):
+            if self.tell():
+                raise OSError('Input/output error')
+            return super().read(100)
+
+    def open_scanned(path, stat_result):
+        if path.name == 'a':
+            with path.open('r+b') as f:
+                f.truncate(600)
+        return FailingReader(path.read_bytes()) if path.name == 'b' else path.open('rb')
+
+    monkeypatch.setattr(storage, 'open_scanned', open_scanned)
+    target = temp_dir / 'dump.tar'
+    archive_storage = ArchiveStorage(make_archive_ctx(target))
+    with raises(OSError):
+        archive_storage.put_folder(source, 'source')
+    archive_storage.put_folder(source / 'c', 'c')
+    archive_storage.finalize()
+
+    with tarfile.open(str(target)) as archive:
+        assert archive.extractfile('source/a').read() == b'a' * 600 + bytes(400)
+        assert archive.extractfile('source/b').read() == b'b' * 100 + bytes(900)
+        assert archive.extractfile('c').read() == b'c' * 1000
+    assert archive_storage.checksums['source/a']['size'] == 1000
+    assert 'source/b' not in archive_storage.checksums
@@ -0,0 +1,95 @@
+from random import random
+from time import sleep
+from types import SimpleNamespace
+
+from pytest import mark, raises
+
+from compose_dump.metrics import Metrics
+from compose_dump.pausing import PauseScheduler
+from compose_dump.transfers import helper_archive, Transfers
+from tests.utils import multiplex
+
+
+class RecordingStorage:
+    thread_safe = False
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.written = []
+
+    def is_stored(self, dst, namespace='.'):
+        return False
+
+    def write_file(self, data, dst, namespace='.', metadata=None):
+        if hasattr(data, 'read'):
+            data = data.read()
+        else:
+            data = b''.join(data)
+        self.metrics.count(read=len(data))
+        self.written.append((namespace, dst, data))
+
+
+def slow_source(number):
+    sleep(random() / 100)
+    yield str(number).encode()
+
+
+@mark.parametrize('jobs', (1, 4))
+def test_transfers_keep_order(jobs):
+    metrics = Metrics()
+    storage = RecordingStorage(metrics)
+    ctx = SimpleNamespace(options={'jobs': jobs, 'no_pause': True, 'services': ()}, project=None, storage=storage,
+                          metrics=metrics)
+    ctx.pauses = PauseScheduler(ctx)
+    index = {}
+
+    with Transfers(ctx) as transfers:
+        for number in range(20):
+            transfers.submit(lambda n=number: slow_source(n), '%s.tar' % number, 'volumes', index, number)
+
+    assert list(index) == list(range(20))
+    assert storage.written == [('volumes', '%s.tar' % x, str(x).encode()) for x in range(20)]
+    operations = sorted(metrics.timings['operations'], key=lambda x: int(x['name'][8:-4]))
+    assert [(x['name'], x['bytes_read']) for x in operations] == \
+        [('volumes/%s.tar' % x, len(str(x))) for x in range(20)]
+
+
+class HelperClient:
+    # runs helper containers whose output is the given frames and exit code
+    def __init__(self, frames, exit_code=0):
+        self.frames = frames
+        self.exit_code = exit_code
+        self.created = []
+        self.removed = []
+
+    def create_host_config(self, **kwargs):
+        return kwargs
+
+    def create_container(self, image, command, host_config, labels):
+        self.created.append((image, command, host_config))
+        return {'Id': 'helper%i' % len(self.created)}
+
+    def attach_socket(self, container, params):
+        return multiplex(self.frames)
+
+    def start(self, container):
+        pass
+
+    def wait(self, container):
+        return {'StatusCode': self.exit_code}
+
+    def remove_container(self, container, force):
+        self.removed.append(container)
+
+
+def test_helper_archive():
+    client = HelperClient([(b'tar', None), (None, b'warning'), (b'ball', None)])
+    assert b''.join(helper_archive(client, 'app_1', '/var/lib/data', 'busybox')) == b'tarball'
+    assert client.created == [('busybox', ['tar', '-c', '-f', '-', '-C', '/var/lib', 'data'],
+                               {'volumes_from': ['app_1:ro'], 'network_mode': 'none'})]
+    assert client.removed == ['helper1']
+
+    client = HelperClient([(b'partial', None), (None, b"tar: can't open 'data': Permission denied")], 1)
+    with raises(SystemExit):
+        list(helper_archive(client, 'app_1', '/data', 'busybox'))
+    assert client.removed == ['helper1']
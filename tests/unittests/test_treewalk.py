@@ -0,0 +1,114 @@
+import io
+import os
+from pathlib import PurePath
+import tarfile
+from types import SimpleNamespace
+
+from compose_dump import storage, treewalk
+from compose_dump.checksums import hash_object
+from compose_dump.storage import ArchiveStorage, FolderStorage
+from compose_dump.tarstream import archive_tree
+from compose_dump.treewalk import open_scanned, ordered_map, scan_tree
+
+
+def make_tree(path):
+    (path / 'b' / 'c').mkdir(parents=True)
+    (path / 'a').write_bytes(b'a' * 100)
+    (path / 'b' / 'large').write_bytes(os.urandom(4096) * 100)
+    (path / 'b' / 'c' / 'd').write_bytes(b'')
+    os.symlink('a', str(path / 'e'))
+    os.link(str(path / 'a'), str(path / 'f'))
+
+
+def digest(data):
+    hash = hash_object()
+    hash.update(data)
+    return hash.hexdigest()
+
+
+def test_scan_tree(temp_dir):
+    make_tree(temp_dir)
+    names = [str(x[1]) for x in scan_tree(temp_dir, PurePath('tree'))]
+    assert names == ['tree', 'tree/a', 'tree/b', 'tree/b/c', 'tree/b/c/d', 'tree/b/large', 'tree/e', 'tree/f']
+
+
+def test_scan_tree_ignores_replaced_entries(temp_dir):
+    make_tree(temp_dir / 'tree')
+    (temp_dir / 'elsewhere').mkdir()
+    (temp_dir / 'elsewhere' / 'secret').write_bytes(b'secret')
+
+    entries = scan_tree(temp_dir / 'tree', PurePath('tree'))
+    names = []
+    for path, name, stat_result in entries:
+        names.append(str(name))
+        if name == PurePath('tree/a'):
+            a = path, stat_result
+        elif name == PurePath('tree/b'):
+            os.rename(str(path), str(temp_dir / 'moved'))
+            os.symlink(str(temp_dir / 'elsewhere'), str(path))
+    assert names == ['tree', 'tree/a', 'tree/b', 'tree/e', 'tree/f']
+
+    os.remove(str(a[0]))
+    os.symlink(str(temp_dir / 'elsewhere' / 'secret'), str(a[0]))
+    assert open_scanned(*a) is None
+
+
+def test_ordered_map():
+    assert list(ordered_map(lambda x: x * 2, range(100), threads=3)) == [(x, x * 2) for x in range(100)]
+
+
+def test_archive_put_folder(monkeypatch, temp_dir):
+    monkeypatch.setattr(treewalk, 'READAHEAD_MAX_SIZE', 1024)
+    source = temp_dir / 'source'
+    source.mkdir()
+    make_tree(source)
+    target = temp_dir / 'dump.tar'
+    archive_storage = ArchiveStorage(SimpleNamespace(options={'target': target, 'compression': 'tar'}))
+    archive_storage.put_folder(source, 'tree', namespace='volumes')
+    archive_storage.finalize()
+
+    with tarfile.open(str(target)) as archive:
+        members = {x.name: x for x in archive}
+        assert sorted(members) == ['volumes/tree', 'volumes/tree/a', 'volumes/tree/b', 'volumes/tree/b/c',
+                                   'volumes/tree/b/c/d', 'volumes/tree/b/large', 'volumes/tree/e', 'volumes/tree/f']
+        assert archive.extractfile('volumes/tree/b/large').read() == (source / 'b' / 'large').read_bytes()
+        assert members['volumes/tree/e'].issym() and members['volumes/tree/e'].linkname == 'a'
+        assert members['volumes/tree/f'].islnk() and members['volumes/tree/f'].linkname == 'volumes/tree/a'
+        assert members['volumes/tree/a'].mtime == (source / 'a').stat().st_mtime
+    assert archive_storage.checksums['volumes/tree/a'] == {'digest': digest(b'a' * 100), 'size': 100}
+    assert set(archive_storage.checksums) == {'volumes/tree/a', 'volumes/tree/b/c/d', 'volumes/tree/b/large'}
+
+
+def test_archive_tree(monkeypatch, temp_dir):
+    monkeypatch.setattr(treewalk, 'READAHEAD_MAX_SIZE', 1024)
+    make_tree(temp_dir)
+    data = b''.join(archive_tree(temp_dir, 'data'))
+    assert data.endswith(bytes(2 * tarfile.BLOCKSIZE))
+
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        members = {x.name: x for x in archive}
+        assert sorted(members) == ['data', 'data/a', 'data/b', 'data/b/c', 'data/b/c/d', 'data/b/large',
+                                   'data/e', 'data/f']
+        assert archive.extractfile('data/b/large').read() == (temp_dir / 'b' / 'large').read_bytes()
+        assert archive.extractfile('data/a').read() == b'a' * 100
+        assert members['data/f'].islnk() and members['data/f'].linkname == 'data/a'
+
+
+def test_folder_put_folder(monkeypatch, temp_dir):
+    monkeypatch.setattr(storage, 'READAHEAD_MAX_SIZE', 1024)
+    source = temp_dir / 'source'
+    source.mkdir()
+    make_tree(source)
+    target = temp_dir / 'target'
+    folder_storage = FolderStorage(SimpleNamespace(options={'target': target}))
+    folder_storage.put_folder(source, 'tree', namespace='volumes')
+
+    tree = target / 'volumes' / 'tree'
+    files = sorted(str(x.relative_to(tree)) for x in tree.rglob('*'))
+    assert files == ['a', 'b', 'b/c', 'b/c/d', 'b/large', 'e', 'f']
+    large = (source / 'b' / 'large').read_bytes()
+    assert (tree / 'b' / 'large').read_bytes() == large
+    assert (tree / 'e').read_bytes() == b'a' * 100 and not (tree / 'e').is_symlink()
+    assert (tree / 'b').stat().st_mtime == (source / 'b').stat().st_mtime
+    assert folder_storage.checksums['volumes/tree/b/large'] == {'digest': digest(large), 'size': len(large)}
+    assert len(folder_storage.checksums) == 5
@@ -1,6 +1,12 @@
+import logging
 from pathlib import Path
+from types import SimpleNamespace
 
-from compose_dump.utils import PathSet
+from compose.config.types import VolumeSpec
+from compose.volume import Volume
+
+from compose_dump.utils import find_projects, get_local_mountpoint, get_services_using_project_volume, PathSet, \
+    ThreadLogFilter, worker_pool
 
 
 def test_pathset():
@@ -15,3 +21,57 @@ def test_pathset():
     assert x not in ps
     ps.add(x)
     assert x in ps
+
+
+def test_find_projects(temp_dir):
+    for path in ('a', 'a/nested', 'b/c', '.hidden', 'd'):
+        (temp_dir / path).mkdir(parents=True)
+    (temp_dir / 'a' / 'docker-compose.yml').touch()
+    (temp_dir / 'a' / 'nested' / 'docker-compose.yaml').touch()
+    (temp_dir / 'b' / 'c' / 'docker-compose.yml').touch()
+    (temp_dir / '.hidden' / 'docker-compose.yml').touch()
+    (temp_dir / 'd' / 'compose.txt').touch()
+
+    assert find_projects(temp_dir) == [temp_dir / 'a', temp_dir / 'a' / 'nested', temp_dir / 'b' / 'c']
+
+
+def test_thread_log_filter():
+    log_filter = ThreadLogFilter()
+
+    def make_record():
+        return logging.LogRecord('test', logging.INFO, __file__, 0, 'message', None, None)
+
+    assert log_filter.filter(make_record())
+    with worker_pool(1) as pool:
+        assert log_filter.filter(pool.submit(make_record).result())
+
+    record = make_record()
+    record.threadName = log_filter.thread_name + '_other'
+    assert not log_filter.filter(record)
+
+
+def test_get_local_mountpoint(temp_dir):
+    mounts = [{'Type': 'volume', 'Driver': 'local', 'Source': str(temp_dir), 'Destination': '/data'},
+              {'Type': 'volume', 'Driver': 'rexray', 'Source': str(temp_dir), 'Destination': '/remote'},
+              {'Type': 'volume', 'Driver': 'local', 'Source': str(temp_dir / 'missing'), 'Destination': '/cache'},
+              {'Type': 'bind', 'Source': str(temp_dir), 'Destination': '/srv/config'}]
+    local_client = SimpleNamespace(base_url='http+docker://localhost')
+
+    assert get_local_mountpoint(local_client, mounts, '/data/') == temp_dir
+    assert get_local_mountpoint(SimpleNamespace(base_url='https://docker:2376'), mounts, '/data') is None
+    for path in ('/remote', '/cache', '/srv', '/srv/config'):
+        assert get_local_mountpoint(local_client, mounts, path) is None
+
+
+def test_get_services_using_project_volume():
+    # service specs refer to volumes by their resolved names, which may be custom
+    volumes = {'data': Volume(None, 'my-project', 'data'),
+               'shared': Volume(None, 'my-project', 'shared-data', custom_name=True)}
+    services = [SimpleNamespace(name='app', options={'volumes': [VolumeSpec('my-project_data', '/data', 'rw'),
+                                                                 VolumeSpec('shared-data', '/shared', 'rw')]}),
+                SimpleNamespace(name='db', options={'volumes': [VolumeSpec('shared-data', '/shared', 'ro')]})]
+    project = SimpleNamespace(name='my-project', services=services, volumes=SimpleNamespace(volumes=volumes))
+
+    assert get_services_using_project_volume(project, 'data') == ['app']
+    assert get_services_using_project_volume(project, 'shared') == ['app', 'db']
+    assert get_services_using_project_volume(project, 'gone') == []
@@ -1,5 +1,7 @@
+import io
 import os
 import re
+import struct
 import sys
 from hashlib import md5
 from types import SimpleNamespace
@@ -96,3 +98,9 @@ def run(args):
         return result
     else:
         raise RuntimeError
+
+
+def multiplex(frames):
+    # a socket that provides stdout and stderr data like Docker does for containers without a tty
+    data = b''.join(struct.pack('>BxxxL', 1 if out else 2, len(out or err)) + (out or err) for out, err in frames)
+    return io.BytesIO(data)